@@ -12,6 +12,27 @@ style:str = p+"source/qt/light.qss" #options: "source/qt/light.qss", "source/qt/
 tempFolder:str = p+"temp/"
 sourceFolder:str = p+"source/"
 outputFolder:str = p+"generated/"
+cacheFolder:str = p+"cache/" #persistent caches (unlike tempFolder, this is NOT cleared on startup)
+probeCacheFile:str = cacheFolder+"probe.sqlite" #on-disk store for media probe results (durations, sizes, keyframes...)
+probeCacheMemorySize:int = 512 #number of probe results kept in memory
+fontIndexFile:str = cacheFolder+"fonts.json" #index of the installed fonts (family names and file names), rebuilt when a font folder changes
+imageCacheFolder:str = cacheFolder+"images/" #resized images, reused when the same picture is resized again to the same size
+imageCacheMaxFiles:int = 1000 #oldest resized images are deleted beyond this number
+assetCacheFolder:str = cacheFolder+"assets/" #preconditioned copies of the configured videos and sounds (see lib/assetcache)
+preconditionAssets:bool = True #convert the configured videos and sounds (videoPool, dingSound, news title video and song) once to a format every render can stream-copy
+preconditionAssetsOnStartup:bool = False #do it in the background when Opifex starts, instead of the first time each asset is used
+canonicalFramerate:int = 30 #framerate of preconditioned videos, which also get a keyframe every second
+workspaceUseRam:bool = True #put the temporary files of each job in RAM (/dev/shm) when there's enough free space
+workspaceRamMinFree:int = 2*1024**3 #minimum free space (in bytes) /dev/shm must have to be used for a job's temporary files
+ffmpegCoreBudget:int = os.cpu_count() or 4 #number of CPU cores all the FFmpeg processes started by Opifex may use at the same time
+ffmpegThreadsPerProcess:int = 4 #threads given to each FFmpeg encode (-threads and -filter_threads), probes always get 1
+nativeCardRenderer:bool = True #draw HTML templates that have a card spec (TEMPLATE NAME.card.json, see lib/cardrenderer) with Pillow instead of Chrome
+chromePoolSize:int = 2 #maximum number of headless Chrome sessions kept open for screenshots at the same time
+chromeIdleTimeout:float = 120.0 #seconds after which an unused headless Chrome session is closed
+chromeStartAttempts:int = 3 #Chrome sometimes fails to start a session for no reason, so it's tried again this number of times
+titleCardSelector:str|None = None #CSS selector of the part of titleHtmlTemplate used as splash image, e.g. "body > *": only the bounding box of its matches is captured instead of the whole window (None)
+recordMode:str = "virtual" #how HTML pages are recorded: "virtual" (headless, frame by frame on a virtual clock, faster than real time) or "x11grab" (real-time screen capture in Xvfb)
+recordLoopMaxPeriod:float = 20.0 #longest animation period a looped recording (see RecordPage) may have, pages with longer ones are recorded whole
 
 #DEFAULT MODULES CONFIGS
 
@@ -34,6 +55,36 @@ class Theme: #DO NOT change this. it's used to define other variables later
         self.contourWidth = contourWidth
         self.contourColor = countourColor
 
+class EncoderProfile: #DO NOT change this. it's used to define other variables later
+    def __init__(self, videoCodec:str="libx264", preset:str|None="medium", crf:int|None=23, pixelFormat:str="yuv420p", audioCodec:str="aac", audioBitrate:str|None=None, extraArgs:list[str]|None=None):
+        """
+        Encoder settings used by FFmpeg operations (see encoderProfiles)
+        Parameters:
+        - videoCodec (str): FFmpeg video encoder (e.g. "libx264", "libx265")
+        - preset (str|None): encoder preset, from "ultrafast" to "veryslow" for x264/x265 (None leaves the encoder's default)
+        - crf (int|None): constant rate factor, lower is better quality and bigger files (None leaves the encoder's default)
+        - pixelFormat (str): output pixel format ("yuv420p" plays everywhere)
+        - audioCodec (str): FFmpeg audio encoder, used when the audio gets re-encoded
+        - audioBitrate (str|None): audio bitrate, e.g. "192k" (None leaves the encoder's default)
+        - extraArgs (list[str]|None): any other output option, e.g. ["-tune", "film"]
+        """
+        self.videoCodec = videoCodec
+        self.preset = preset
+        self.crf = crf
+        self.pixelFormat = pixelFormat
+        self.audioCodec = audioCodec
+        self.audioBitrate = audioBitrate
+        self.extraArgs = extraArgs if extraArgs is not None else []
+
+#profiles used by FFmpeg operations: "intermediate" for temporary files (read again by a later step), "final" for the files Opifex gives you.
+#operations also accept profile="preview" (or any profile added here) to override the choice
+encoderProfiles:dict[str,EncoderProfile] = {
+    "intermediate": EncoderProfile(preset="ultrafast", crf=18), #cheap to encode, but high quality so the final encode doesn't inherit artifacts
+    "preview": EncoderProfile(preset="veryfast", crf=30),
+    "final": EncoderProfile(preset="medium", crf=23),
+    "mezzanine": EncoderProfile(preset="medium", crf=16), #preconditioned assets (see preconditionAssets), re-encoded again by every render
+}
+
 accountName:str = "Fallback account name"
 subtitlesTheme:Theme = Theme(color="&H0000E6FF", 
                          font=p+"source/font/SpecialGothicExpandedOne-Regular.ttf",
@@ -0,0 +1,147 @@
+import os
+import json
+import hashlib
+import threading
+import contextvars
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+import config
+from config import assetCacheFolder, canonicalFramerate, piperModel
+from lib.mediacache import probeCache
+from lib.ffmpeghandler import FFmpeg, FFmpegScheduler, runFFmpeg, activePlan
+
+def ttsAudioFormat(model:str=piperModel) -> tuple[int,int]:
+    """
+    Returns (sample rate, channels) of the audio generated by the given Piper voice model, read from the JSON file
+    next to it (piper voices are mono). Falls back to 22050 Hz if the file can't be read.
+    """
+    try:
+        with open(model+".json", "r", encoding="utf-8") as f:
+            return int(json.load(f)["audio"]["sample_rate"]), 1
+    except (OSError, ValueError, KeyError, TypeError):
+        return 22050, 1
+
+def fileHash(path:str) -> str:
+    """
+    SHA-256 of the file's content, memoised in the probe cache (so big videos are hashed only once, until they change).
+    Inside a FFmpeg.planning() block the probe cache is only read.
+    """
+    def compute() -> str:
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024*1024), b""):
+                digest.update(chunk)
+        return digest.hexdigest()
+    if activePlan.get() is not None:
+        return probeCache.get(path, "sha256") or compute()
+    return probeCache.cached(path, "sha256", compute)
+
+class AssetCache:
+    """
+    Content-addressed cache of preconditioned assets: each video or sound is converted once to a canonical "mezzanine" format
+    (H.264 with a keyframe every second at config.canonicalFramerate fps, audio at the TTS voice's sample rate and channels),
+    so that renders can cut and concatenate it with the TTS audio and with each other using stream copy only.
+    Converted files are named after the hash of the source's content and the conversion parameters, so renamed or duplicated
+    sources are converted once, and a modified source gets converted again.
+    """
+    def __init__(self, folder:str=assetCacheFolder, audioFormat:tuple[int,int]|None=None):
+        self.folder:str = folder
+        self.audioFormat:tuple[int,int] = audioFormat if audioFormat is not None else ttsAudioFormat()
+        self.locks:dict[str,threading.Lock] = {} #one per converted file, so the same asset is never converted twice at the same time
+        self.lock = threading.Lock()
+
+    def convert(self, path:str, tag:str, extension:str, args:list[str]) -> str:
+        """Returns the cached conversion of path with the given FFmpeg output args, converting it first if needed."""
+        target:str = os.path.join(self.folder, f"{fileHash(path)}_{tag}.{extension}")
+        with self.lock:
+            lock = self.locks.setdefault(target, threading.Lock())
+        with lock:
+            plan = activePlan.get()
+            if not os.path.isfile(target) and (plan is None or plan.planned(target) is None):
+                if plan is None:
+                    os.makedirs(self.folder, exist_ok=True)
+                partial:str = f"{target}.{os.getpid()}.partial.{extension}" #renamed when complete, so a crash never leaves a broken asset
+                print(f"Preconditioning '{path}' (only done once)...")
+                try:
+                    runFFmpeg(["ffmpeg", "-v", "error", "-y", "-i", path] + args + [partial], priority=FFmpegScheduler.INTERMEDIATE, operation="AssetCache.convert")
+                    if plan is not None: #dry run, see FFmpeg.planning()
+                        plan.move(partial, target)
+                    else:
+                        os.replace(partial, target)
+                finally:
+                    if os.path.exists(partial):
+                        os.remove(partial)
+        return target
+
+    def video(self, path:str, size:tuple[int,int]|None=None, framerate:int=canonicalFramerate) -> str:
+        """
+        Returns the preconditioned version of the given video, scaled and center-cropped to size (if given, otherwise its resolution is kept).
+        Returns path itself (with a warning) if it can't be converted, so a broken asset fails where it's used, like before.
+        """
+        sampleRate, channels = self.audioFormat
+        filters:list[str] = []
+        if size is not None:
+            filters.append(f"scale={size[0]}:{size[1]}:force_original_aspect_ratio=increase,crop={size[0]}:{size[1]},setsar=1")
+        filters.append(f"fps={framerate}")
+        args:list[str] = ["-vf", ",".join(filters)]
+        args.extend(FFmpeg.encoderArgs("mezzanine"))
+        args.extend(["-g", str(framerate), "-keyint_min", str(framerate), "-sc_threshold", "0", #a keyframe every second, so keyframe-aligned cuts are precise
+                     "-c:a", "aac", "-ar", str(sampleRate), "-ac", str(channels),
+                     "-movflags", "+faststart"])
+        tag:str = f"v{size[0]}x{size[1]}" if size is not None else "v"
+        try:
+            return self.convert(path, f"{tag}_{framerate}fps_{sampleRate}hz{channels}ch", "mp4", args)
+        except Exception as e:
+            print(f"WARNING: unable to precondition '{path}', using it as it is: {e}")
+            return path
+
+    def audio(self, path:str) -> str:
+        """Returns the preconditioned version of the given sound: 16-bit PCM WAV with the sample rate and channels of the TTS voice."""
+        sampleRate, channels = self.audioFormat
+        try:
+            return self.convert(path, f"a_{sampleRate}hz{channels}ch", "wav", ["-vn", "-c:a", "pcm_s16le", "-ar", str(sampleRate), "-ac", str(channels)])
+        except Exception as e:
+            print(f"WARNING: unable to precondition '{path}', using it as it is: {e}")
+            return path
+
+    def videoPool(self, paths:list[str]) -> list[str]:
+        """Precondition a pool of videos to a common resolution (the most common one in the pool), in parallel."""
+        if len(paths) == 0:
+            return paths
+        sizes:list[tuple[int,int]] = []
+        for info in FFmpeg.probeMany(paths):
+            if info.size is not None:
+                sizes.append(info.size)
+        size:tuple[int,int]|None = Counter(sizes).most_common(1)[0][0] if len(sizes) > 0 else None
+        with ThreadPoolExecutor(max_workers=len(paths)) as executor: #the FFmpeg scheduler limits how many run at the same time
+            futures = [executor.submit(contextvars.copy_context().run, self.video, p, size) for p in paths] #copying the context keeps the job's workspace (and plan) in worker threads
+            return [future.result() for future in futures]
+
+assetCache:AssetCache = AssetCache()
+
+def preconditioned(path:str, kind:str="video") -> str:
+    """Returns the preconditioned version of the given asset ("video" or "audio") if config.preconditionAssets is enabled, otherwise path."""
+    if not config.preconditionAssets:
+        return path
+    return assetCache.video(path) if kind == "video" else assetCache.audio(path)
+
+def preconditionedPool(paths:list[str]) -> list[str]:
+    """Returns the preconditioned version of a video pool if config.preconditionAssets is enabled, otherwise paths."""
+    if not config.preconditionAssets:
+        return paths
+    return assetCache.videoPool(paths)
+
+def preconditionAll() -> None:
+    """Precondition every asset referenced in config.py."""
+    preconditionedPool(config.videoPool)
+    preconditioned(config.dingSound, "audio")
+    preconditioned(config.newsTitleBackgroundVideo, "video")
+    preconditioned(config.newsTitleSong, "audio")
+
+def preconditionOnStartup() -> threading.Thread|None:
+    """Start preconditionAll() in a background thread if config.preconditionAssetsOnStartup is enabled."""
+    if not (config.preconditionAssets and config.preconditionAssetsOnStartup):
+        return None
+    thread = threading.Thread(target=preconditionAll, name="precondition", daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,147 @@
+import os
+import json
+import threading
+from PIL import Image, ImageDraw, ImageFont, ImageColor
+from lib.fontindex import fontIndex
+
+class CardRenderer:
+    """
+    Draws simple "cards" (text on flat or rounded panels, like the Reddit title card) straight into a transparent RGBA image
+    with Pillow, in milliseconds and without a browser. A card is described by a JSON spec, kept next to the HTML template
+    it replaces (see specPath), using this subset of features:
+
+        {
+            "background": "#00000000",                          (optional, transparent by default)
+            "elements": [
+                {"type": "panel", "box": [x, y, width, height], "color": "#1a1a1b", "radius": 24, "padding": 32,
+                 "valign": "center", "elements": [...]},        (children are placed inside the padding, height may be "auto")
+                {"type": "text", "box": [x, y, width, height], "text": "{content}", "font": "Arial", "size": 48,
+                 "minSize": 24, "color": "#ffffff", "align": "left", "valign": "top", "lineSpacing": 1.2, "wrap": true}
+            ]
+        }
+
+    Boxes are in pixels, relative to the parent (the card or the panel's padded area); "auto" heights fit the content.
+    "valign" of a panel with "auto" height centers/aligns it vertically in its box height ("top", "center", "bottom") using "maxHeight".
+    Text is formatted with str.format(**data), like HTML templates; fonts are looked up by name in the font index (or used as a path),
+    and text too big for a fixed height box is shrunk down to minSize. Unsupported features raise ValueError.
+    """
+    def __init__(self):
+        self.fonts:dict[tuple[str,int],ImageFont.FreeTypeFont] = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def specPath(template:str) -> str:
+        """Path of the card spec of an HTML template: same name, with the ".card.json" extension."""
+        return os.path.splitext(template)[0] + ".card.json"
+
+    @staticmethod
+    def hasSpec(template:str) -> bool:
+        return os.path.isfile(CardRenderer.specPath(template))
+
+    def font(self, name:str, size:int) -> ImageFont.FreeTypeFont:
+        with self.lock:
+            if (name, size) not in self.fonts:
+                path:str|None = name if os.path.isfile(name) else fontIndex.find(name)
+                if path is None:
+                    raise ValueError(f"Font '{name}' not found.")
+                self.fonts[(name, size)] = ImageFont.truetype(path, size)
+            return self.fonts[(name, size)]
+
+    @staticmethod
+    def wrap(text:str, font:ImageFont.FreeTypeFont, width:int) -> list[str]:
+        """Split text into lines no wider than width pixels, breaking between words (and inside words longer than a line)."""
+        lines:list[str] = []
+        for paragraph in text.split("\n"):
+            line:str = ""
+            for word in paragraph.split(" "):
+                candidate:str = word if line == "" else f"{line} {word}"
+                if font.getlength(candidate) <= width:
+                    line = candidate
+                    continue
+                if line != "":
+                    lines.append(line)
+                line = ""
+                for char in word: #the word alone doesn't fit
+                    if line != "" and font.getlength(line+char) > width:
+                        lines.append(line)
+                        line = ""
+                    line += char
+            lines.append(line)
+        return lines
+
+    def layoutText(self, element:dict, data:dict, width:int) -> tuple[ImageFont.FreeTypeFont,list[str],int]:
+        """Returns the font, lines and line height of a text element, shrinking the font until it fits a fixed height."""
+        try:
+            text:str = str(element.get("text", "")).format(**data)
+        except (KeyError, IndexError) as e:
+            raise ValueError(f"Card text '{element.get('text')}' uses a missing placeholder: {e}") from e
+        size:int = int(element.get("size", 16))
+        minSize:int = int(element.get("minSize", size))
+        height = element["box"][3]
+        spacing:float = float(element.get("lineSpacing", 1.2))
+        while True:
+            font = self.font(element.get("font", "Arial"), size)
+            lines:list[str] = CardRenderer.wrap(text, font, width) if element.get("wrap", True) else text.split("\n")
+            lineHeight:int = round(size*spacing)
+            if height == "auto" or len(lines)*lineHeight <= height or size <= minSize:
+                return font, lines, lineHeight
+            size = max(minSize, size-2)
+
+    def measure(self, element:dict, data:dict) -> int:
+        """Height of an element, resolving "auto"."""
+        x, y, width, height = element["box"]
+        if height != "auto":
+            return int(height)
+        if element.get("type") == "text":
+            _, lines, lineHeight = self.layoutText(element, data, width)
+            return len(lines)*lineHeight
+        padding:int = int(element.get("padding", 0))
+        children:list[dict] = element.get("elements", [])
+        return max((int(child["box"][1])+self.measure(child, data) for child in children), default=0) + 2*padding
+
+    def draw(self, canvas:Image.Image, element:dict, data:dict, origin:tuple[int,int]) -> None:
+        kind:str|None = element.get("type")
+        if kind not in ("panel", "text"):
+            raise ValueError(f"Unsupported card element type '{kind}'.")
+        x, y, width, _ = element["box"]
+        height:int = self.measure(element, data)
+        left:int = origin[0]+int(x)
+        top:int = origin[1]+int(y)
+        if kind == "panel":
+            if element["box"][3] == "auto" and "maxHeight" in element:
+                space:int = int(element["maxHeight"])-height
+                top += {"top":0, "center":space//2, "bottom":space}.get(element.get("valign", "top"), 0)
+            layer = Image.new("RGBA", canvas.size, (0, 0, 0, 0)) #drawn on its own layer, so translucent panels blend instead of replacing
+            ImageDraw.Draw(layer).rounded_rectangle((left, top, left+int(width)-1, top+height-1), radius=int(element.get("radius", 0)), fill=ImageColor.getrgb(element.get("color", "#00000000")))
+            canvas.alpha_composite(layer)
+            padding:int = int(element.get("padding", 0))
+            for child in element.get("elements", []):
+                self.draw(canvas, child, data, (left+padding, top+padding))
+            return
+        font, lines, lineHeight = self.layoutText(element, data, int(width))
+        space:int = height-len(lines)*lineHeight
+        top += {"top":0, "center":space//2, "bottom":space}.get(element.get("valign", "top"), 0)
+        align:str = element.get("align", "left")
+        layer = Image.new("RGBA", canvas.size, (0, 0, 0, 0))
+        pen = ImageDraw.Draw(layer)
+        for i, line in enumerate(lines):
+            lineWidth:float = font.getlength(line)
+            lineLeft:float = left + {"left":0, "center":(int(width)-lineWidth)/2, "right":int(width)-lineWidth}.get(align, 0)
+            pen.text((lineLeft, top+i*lineHeight+(lineHeight-font.size)/2), line, font=font, fill=ImageColor.getrgb(element.get("color", "#000000")), anchor="la")
+        canvas.alpha_composite(layer)
+
+    def render(self, spec:dict, data:dict, size:tuple[int,int], outputPath:str) -> str:
+        """Draw the card described by spec, filled with data, as a size[0]xsize[1] RGBA PNG at outputPath."""
+        canvas = Image.new("RGBA", tuple(size), ImageColor.getrgb(spec.get("background", "#00000000")))
+        for element in spec.get("elements", []):
+            self.draw(canvas, element, data, (0, 0))
+        canvas.save(outputPath, "PNG", compress_level=1)
+        return outputPath
+
+    def renderTemplate(self, template:str, data:dict, size:tuple[int,int], outputPath:str) -> str:
+        """render() with the card spec of the given HTML template (see specPath)."""
+        with open(CardRenderer.specPath(template), "r", encoding="utf-8") as f:
+            spec:dict = json.load(f)
+        return self.render(spec, data, size, outputPath)
+
+cardRenderer:CardRenderer = CardRenderer()
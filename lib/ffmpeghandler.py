@@ -1,141 +1,1092 @@
 import os
-import platform
+import io
+import sys
+import stat
+import time
+import signal
+import tempfile
 import subprocess
-import random
 from fontTools.misc.arrayTools import offsetRect
-from fontTools.ttLib import TTFont
 import datetime
 import re
+import json
+import contextvars
+import contextlib
+import threading
+import hashlib
+import shutil
+import shlex
+import itertools
+import heapq
+import asyncio
+import functools
+import bisect
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
 from PIL import Image
-from config import Theme, tempFolder
+from config import Theme, EncoderProfile, encoderProfiles, ffmpegCoreBudget, ffmpegThreadsPerProcess, imageCacheFolder, imageCacheMaxFiles
+from lib.mediacache import probeCache
+from lib.fontindex import fontIndex, readFamilyName
+from lib.workspace import Workspace, currentWorkspace, consumes, deferConsumption, operationDepth, currentOperation
 
 #vars used for ffmpeg processing
-tempFiles:list[str] = []
+normalisedFiles:set[str] = set() #absolute paths of files written by FFmpeg.concatenate(reencode=True), which are already in the common format
+maxParallelEncodes:int = max(1, (os.cpu_count() or 2)//2) #maximum number of FFmpeg encodes run at the same time by a single operation
 
 class ImageProcessing:
     @staticmethod
-    def resize(image_path, output_path, target_size, method='stretch'):
-        """Resize image and save to file using PIL"""
+    def resizeImage(img:Image.Image, target_size:tuple[int,int], method:str='stretch', fast:bool=False) -> Image.Image:
+        """
+        Returns the given image resized with the given method ('stretch', 'cut' or 'borders', see resize).
+        With fast=True, big downscales are first reduced by whole factors (reducing_gap), which is quicker but gives slightly different pixels.
+        """
+        reducingGap:float|None = 3.0 if fast else None
+        # Convert to RGB if necessary (handles RGBA, P, etc.)
+        if img.mode not in ('RGB', 'L'):  # L is grayscale
+            img = img.convert('RGB')
+
+        if method == 'stretch':
+            # Stretch/scale to exact dimensions
+            return img.resize(target_size, Image.Resampling.LANCZOS, reducing_gap=reducingGap)
+
+        elif method == 'cut':
+            # Center crop to target aspect ratio, then resize
+            img_ratio = img.width / img.height
+            target_ratio = target_size[0] / target_size[1]
+
+            if img_ratio > target_ratio:
+                # Image is wider than target
+                new_height = img.height
+                new_width = int(target_ratio * new_height)
+                left = (img.width - new_width) // 2
+                crop_box = (left, 0, left + new_width, new_height)
+            else:
+                # Image is taller than target
+                new_width = img.width
+                new_height = int(new_width / target_ratio)
+                top = (img.height - new_height) // 2
+                crop_box = (0, top, new_width, top + new_height)
+
+            if fast:
+                # resizing with a box crops without copying the image first
+                return img.resize(target_size, Image.Resampling.LANCZOS, box=crop_box, reducing_gap=reducingGap)
+            return img.crop(crop_box).resize(target_size, Image.Resampling.LANCZOS)
+
+        elif method == 'borders':
+            # Maintain aspect ratio, add black borders
+            img.thumbnail(target_size, Image.Resampling.LANCZOS, reducing_gap=reducingGap or 2.0) #2.0 is thumbnail's default
+
+            # Create new image with black background
+            new_img = Image.new("RGB", target_size, (0, 0, 0))
+
+            # Calculate position to center the thumbnail
+            paste_x = (target_size[0] - img.width) // 2
+            paste_y = (target_size[1] - img.height) // 2
+
+            # Paste the thumbnail onto the black background
+            new_img.paste(img, (paste_x, paste_y))
+            return new_img
+
+        raise ValueError(f"Unknown resize method '{method}', use 'stretch', 'cut' or 'borders'.")
+
+    @staticmethod
+    def resize(image_path, output_path, target_size, method='stretch', fast=False):
+        """
+        Resize image and save to file using PIL.
+        - 'stretch' scales to the exact size
+        - 'cut' crops the center to the target aspect ratio, then scales
+        - 'borders' scales keeping the aspect ratio and fills the rest with black
+        With fast=True, JPEGs are decoded directly at a reduced scale (still at least as big as the target) when they're much bigger
+        than needed, and resizeImage takes its fast path: quicker, with slightly different pixels.
+        """
         with Image.open(image_path) as img:
-            # Convert to RGB if necessary (handles RGBA, P, etc.)
-            if img.mode not in ('RGB', 'L'):  # L is grayscale
-                img = img.convert('RGB')
-            
-            if method == 'stretch':
-                # Stretch/scale to exact dimensions
-                resized = img.resize(target_size, Image.Resampling.LANCZOS)
-                resized.save(output_path)
-                
-            elif method == 'cut':
-                # Center crop to target aspect ratio, then resize
-                img_ratio = img.width / img.height
-                target_ratio = target_size[0] / target_size[1]
-                
-                if img_ratio > target_ratio:
-                    # Image is wider than target
-                    new_height = img.height
-                    new_width = int(target_ratio * new_height)
-                    left = (img.width - new_width) // 2
-                    crop_box = (left, 0, left + new_width, new_height)
+            if fast and img.format == "JPEG":
+                img.draft("RGB", tuple(target_size))
+            ImageProcessing.resizeImage(img, target_size, method, fast).save(output_path)
+
+    @staticmethod
+    def imageSize(image_path:str) -> tuple[int,int]:
+        """Returns (width, height) of the given image, reading only its header."""
+        plan:FFmpegPlan|None = activePlan.get()
+        planned:PlannedCommand|None = plan.planned(image_path) if plan is not None else None
+        if planned is not None:
+            return planned.info.size
+        with Image.open(image_path) as img:
+            return img.size
+
+    @staticmethod
+    def cachePath(image_path:str, output_path:str, target_size:tuple[int,int], method:str, fast:bool=False) -> str:
+        """Path of the cached result of resizing image_path, keyed by (content hash, target size, method, fast, output format)."""
+        digest = hashlib.sha256()
+        with open(image_path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024*1024), b""):
+                digest.update(chunk)
+        extension:str = os.path.splitext(output_path)[1].lower()
+        return os.path.join(imageCacheFolder, f"{digest.hexdigest()}_{target_size[0]}x{target_size[1]}_{method}{'_fast' if fast else ''}{extension}")
+
+    @staticmethod
+    def resizeCached(image_path:str, output_path:str, target_size:tuple[int,int], method:str='stretch', fast:bool=False) -> None:
+        """resize(), reusing the result of a previous resize of the same picture (even from another path) when there is one."""
+        cached:str = ImageProcessing.cachePath(image_path, output_path, target_size, method, fast)
+        if not os.path.isfile(cached):
+            os.makedirs(imageCacheFolder, exist_ok=True)
+            partial:str = f"{cached}.{os.getpid()}.{threading.get_ident()}{os.path.splitext(cached)[1]}" #written aside, so readers never see half a file
+            ImageProcessing.resize(image_path, partial, target_size, method, fast)
+            os.replace(partial, cached)
+        else:
+            os.utime(cached) #keep recently used results when pruning
+        shutil.copyfile(cached, output_path)
+
+    @staticmethod
+    def pruneCache(maxFiles:int=imageCacheMaxFiles) -> None:
+        """Delete the least recently used resized images beyond maxFiles."""
+        try:
+            entries = [entry for entry in os.scandir(imageCacheFolder) if entry.is_file()]
+        except OSError:
+            return
+        entries.sort(key=lambda entry: entry.stat().st_mtime, reverse=True)
+        for entry in entries[maxFiles:]:
+            try:
+                os.remove(entry.path)
+            except OSError:
+                pass
+
+    @staticmethod
+    def resizeMany(image_paths:list[str], output_paths:list[str], target_size:tuple[int,int], method:str='stretch', workers:int|None=None, cache:bool=True) -> list[str]:
+        """
+        Resize many images at the same time (Pillow releases the GIL while decoding and resizing), with the same methods as resize(),
+        taking its fast path (draft decoding of big JPEGs and reducing_gap).
+        With cache=True, results are kept in config.imageCacheFolder and reused for pictures that were already resized to the same size.
+        Returns output_paths.
+        """
+        if len(image_paths) != len(output_paths):
+            raise ValueError("image_paths and output_paths must have same length")
+        if len(image_paths) == 0:
+            return output_paths
+        plan:FFmpegPlan|None = activePlan.get()
+        if plan is not None: #dry run, see FFmpeg.planning()
+            for output_path in output_paths:
+                extension:str = os.path.splitext(output_path)[1].lower()
+                codec:str = "mjpeg" if extension in (".jpg", ".jpeg") else extension[1:]
+                plan.placeholder(output_path, MediaInfo(width=target_size[0], height=target_size[1], videoCodec=codec), "ImageProcessing.resizeMany")
+            return output_paths
+        operation = ImageProcessing.resizeCached if cache else ImageProcessing.resize
+        with ThreadPoolExecutor(max_workers=max(1, min(workers or os.cpu_count() or 4, len(image_paths)))) as executor:
+            futures = [executor.submit(operation, src, dst, target_size, method, True) for src, dst in zip(image_paths, output_paths)]
+            for future in futures:
+                future.result() # re-raises resize errors
+        if cache:
+            ImageProcessing.pruneCache()
+        return output_paths
+
+class MediaInfo:
+    """
+    Stream metadata of a media file, as returned by FFmpeg.probe().
+    Values that don't apply to the file (e.g. sampleRate for a picture) are None.
+    """
+    __slots__ = ("duration", "width", "height", "fps", "videoCodec", "audioCodec", "sampleRate", "channels", "pixelFormat",
+                 "videoProfile", "level", "refs", "bFrames", "timeBase", "channelLayout")
+
+    def __init__(self, duration:float|None=None, width:int|None=None, height:int|None=None, fps:float|None=None, videoCodec:str|None=None, audioCodec:str|None=None, sampleRate:int|None=None, channels:int|None=None, pixelFormat:str|None=None,
+                 videoProfile:str|None=None, level:int|None=None, refs:int|None=None, bFrames:int|None=None, timeBase:str|None=None, channelLayout:str|None=None):
+        self.duration:float|None = duration
+        self.width:int|None = width
+        self.height:int|None = height
+        self.fps:float|None = fps
+        self.videoCodec:str|None = videoCodec
+        self.audioCodec:str|None = audioCodec
+        self.sampleRate:int|None = sampleRate
+        self.channels:int|None = channels
+        self.pixelFormat:str|None = pixelFormat
+        self.videoProfile:str|None = videoProfile #e.g. "High" or "Constrained Baseline" for H.264
+        self.level:int|None = level #codec level, as reported by ffprobe (41 is level 4.1 for H.264)
+        self.refs:int|None = refs #reference frames
+        self.bFrames:int|None = bFrames #frame reordering delay ("has_b_frames"), 0 without B-frames
+        self.timeBase:str|None = timeBase #of the video stream, e.g. "1/15360"
+        self.channelLayout:str|None = channelLayout #e.g. "stereo"
+
+    def __str__(self):
+        return "MediaInfo: " + " ".join(f"{name}={getattr(self, name)}" for name in self.__slots__)
+
+    @property
+    def size(self) -> tuple[int,int]|None:
+        return None if self.width is None else (self.width, self.height)
+
+    @property
+    def hasVideo(self) -> bool:
+        return self.videoCodec is not None
+
+    @property
+    def hasAudio(self) -> bool:
+        return self.audioCodec is not None
+
+    def toDict(self) -> dict:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    @staticmethod
+    def fromDict(data:dict) -> "MediaInfo":
+        return MediaInfo(**{name: value for name, value in data.items() if name in MediaInfo.__slots__})
+
+    @staticmethod
+    def fromFFprobe(data:dict) -> "MediaInfo":
+        """Build a MediaInfo from the JSON output of 'ffprobe -show_format -show_streams -of json'."""
+        info = MediaInfo()
+        duration = data.get("format", {}).get("duration")
+        if duration not in (None, "N/A"):
+            info.duration = float(duration)
+        for stream in data.get("streams", []):
+            if stream.get("codec_type") == "video" and info.videoCodec is None:
+                info.videoCodec = stream.get("codec_name")
+                info.width = stream.get("width")
+                info.height = stream.get("height")
+                info.pixelFormat = stream.get("pix_fmt")
+                info.videoProfile = stream.get("profile")
+                info.level = stream.get("level")
+                info.refs = stream.get("refs")
+                info.bFrames = stream.get("has_b_frames")
+                info.timeBase = stream.get("time_base")
+                rate:list[str] = stream.get("r_frame_rate", "0/0").split("/")
+                if len(rate) == 2 and float(rate[1]) != 0:
+                    info.fps = float(rate[0])/float(rate[1])
+            elif stream.get("codec_type") == "audio" and info.audioCodec is None:
+                info.audioCodec = stream.get("codec_name")
+                if stream.get("sample_rate") is not None:
+                    info.sampleRate = int(stream["sample_rate"])
+                info.channels = stream.get("channels")
+                info.channelLayout = stream.get("channel_layout")
+        return info
+
+class FFmpegScheduler:
+    """
+    Shares a budget of CPU cores between all the FFmpeg and ffprobe processes started by Opifex, from any thread.
+    Each process reserves as many cores as the threads it's given; when the budget is exhausted, new processes wait
+    and are started by priority class (PROBE first, then INTERMEDIATE, then FINAL), in request order within a class.
+    A process is always allowed to start when nothing else is running, even if it needs more than the whole budget.
+    Processes started inside a FFmpeg.streaming() block never wait (see slot()): the block's stages may hold the whole budget
+    until the block exits, so waiting for them from inside the block would deadlock.
+    """
+    PROBE:int = 0
+    INTERMEDIATE:int = 1
+    FINAL:int = 2
+
+    def __init__(self, cores:int=ffmpegCoreBudget, threadsPerProcess:int=ffmpegThreadsPerProcess):
+        self.cores:int = max(1, cores)
+        self.threadsPerProcess:int = max(1, threadsPerProcess)
+        self.used:int = 0
+        self.waiting:list[tuple[int,int]] = [] #heap of (priority, ticket number)
+        self.counter = itertools.count()
+        self.condition = threading.Condition()
+
+    def threadsFor(self, priority:int) -> int:
+        return 1 if priority == FFmpegScheduler.PROBE else min(self.threadsPerProcess, self.cores)
+
+    def acquire(self, cores:int, priority:int) -> None:
+        with self.condition:
+            ticket:tuple[int,int] = (priority, next(self.counter))
+            heapq.heappush(self.waiting, ticket)
+            while self.waiting[0] != ticket or (self.used > 0 and self.used + cores > self.cores):
+                self.condition.wait()
+            heapq.heappop(self.waiting)
+            self.used += cores
+            self.condition.notify_all()
+
+    def take(self, cores:int) -> None:
+        """Reserve cores without waiting, used by processes that must never block (see FFmpegStream)."""
+        with self.condition:
+            self.used += cores
+
+    def release(self, cores:int) -> None:
+        with self.condition:
+            self.used -= cores
+            self.condition.notify_all()
+
+    @contextlib.contextmanager
+    def slot(self, priority:int, wait:bool=True):
+        """
+        Wait for a free slot of the given priority class; yields the number of threads the process should use.
+        With wait=False the cores are reserved without waiting (see take()).
+        """
+        threads:int = self.threadsFor(priority)
+        if wait:
+            self.acquire(threads, priority)
+        else:
+            self.take(threads)
+        try:
+            yield threads
+        finally:
+            self.release(threads)
+
+    @staticmethod
+    def withThreads(cmd:list[str], threads:int) -> list[str]:
+        """Returns the given ffmpeg command with -filter_threads (global) and -threads (output option) set, unless it already has them."""
+        if not isFFmpeg(cmd) or "-threads" in cmd:
+            return cmd
+        return [cmd[0], "-filter_threads", str(threads)] + cmd[1:-1] + ["-threads", str(threads), cmd[-1]]
+
+scheduler:FFmpegScheduler = FFmpegScheduler()
+
+def isFFmpeg(cmd:list[str]) -> bool:
+    """Whether the command runs ffmpeg (by name or by path, e.g. a specific build)."""
+    return os.path.basename(cmd[0]) == "ffmpeg"
+
+def mayWait() -> bool:
+    """Whether a process started now may wait for the scheduler: not inside a FFmpeg.streaming() block (see FFmpegScheduler)."""
+    return activeStream.get() is None
+
+def outputPriority(isTemp:bool) -> int:
+    return FFmpegScheduler.INTERMEDIATE if isTemp else FFmpegScheduler.FINAL
+
+class ProgressEvent:
+    """
+    Progress report of a running FFmpeg process, as sent to the listeners added with FFmpeg.addProgressListener().
+    Values FFmpeg didn't report yet are None. outTime is the position reached in the output, in seconds.
+    """
+    __slots__ = ("operation", "frame", "fps", "speed", "outTime", "totalSize", "done")
+
+    def __init__(self, operation:str, frame:int|None=None, fps:float|None=None, speed:float|None=None, outTime:float|None=None, totalSize:int|None=None, done:bool=False):
+        self.operation:str = operation
+        self.frame:int|None = frame
+        self.fps:float|None = fps
+        self.speed:float|None = speed
+        self.outTime:float|None = outTime
+        self.totalSize:int|None = totalSize #bytes written so far
+        self.done:bool = done
+
+    def __str__(self):
+        return f"ProgressEvent({', '.join(f'{name}={getattr(self, name)}' for name in self.__slots__)})"
+
+    @staticmethod
+    def fromFields(operation:str, fields:dict[str,str]) -> "ProgressEvent":
+        """Build an event from a block of key=value lines written by "-progress"."""
+        def number(key:str, kind:type=float):
+            try:
+                return kind(fields[key].strip().rstrip("x"))
+            except (KeyError, ValueError):
+                return None
+        outTime:int|None = number("out_time_us", int)
+        if outTime is None:
+            outTime = number("out_time_ms", int) #also in microseconds, despite the name
+        return ProgressEvent(operation, number("frame", int), number("fps"), number("speed"),
+                             None if outTime is None else outTime/1000000, number("total_size", int), fields.get("progress") == "end")
+
+progressListeners:list[Callable[[ProgressEvent], None]] = []
+
+def notifyProgress(event:ProgressEvent) -> None:
+    for listener in progressListeners.copy():
+        try:
+            listener(event)
+        except Exception as e:
+            print(f"WARNING: progress listener {listener} failed: {e}")
+
+def waitWithUsage(process:subprocess.Popen) -> tuple[int,float]:
+    """Wait for the given process, returning its exit code and the CPU time (user+system, in seconds) it used."""
+    if not hasattr(os, "wait4"): #Windows
+        return process.wait(), 0.0
+    try:
+        _, status, usage = os.wait4(process.pid, 0)
+    except ChildProcessError: #already reaped by Popen itself (e.g. by poll()), its exit code is there but the CPU time is lost
+        return process.wait(), 0.0
+    process.returncode = os.waitstatus_to_exitcode(status)
+    return process.returncode, usage.ru_utime + usage.ru_stime
+
+class FFmpegProcess:
+    """
+    FFmpeg process started with "-progress pipe:1": a monitor thread parses its progress reports into ProgressEvents,
+    and when it exits its wall and CPU time get recorded in the current workspace's stats under the operation's name.
+    With captureErrors=True, stderr is kept (see errors()) instead of being printed.
+    """
+    def __init__(self, cmd:list[str], operation:str, stdin:int=subprocess.DEVNULL, captureErrors:bool=False):
+        self.cmd:list[str] = cmd
+        self.operation:str = operation
+        self.workspace:Workspace = currentWorkspace()
+        self.returncode:int|None = None
+        if isFFmpeg(cmd) and "-progress" not in cmd:
+            cmd = [cmd[0], "-progress", "pipe:1", "-nostats"] + cmd[1:]
+        self.errorFile = tempfile.TemporaryFile() if captureErrors else None #a file, so it can't fill up
+        self.errorText:str = ""
+        self.startTime:float = time.perf_counter()
+        self.process = subprocess.Popen(cmd, stdin=stdin, stdout=subprocess.PIPE, stderr=self.errorFile) #binary, so stdin can be fed raw data (see feedFFmpeg)
+        self.monitor = threading.Thread(target=self.run, daemon=True)
+        self.monitor.start()
+
+    def run(self) -> None:
+        try:
+            fields:dict[str,str] = {}
+            for line in io.TextIOWrapper(self.process.stdout, encoding="utf-8", errors="replace"):
+                key, _, value = line.strip().partition("=")
+                fields[key] = value
+                if key == "progress": #last line of each report
+                    notifyProgress(ProgressEvent.fromFields(self.operation, fields))
+                    fields = {}
+        finally:
+            returncode, cpu = waitWithUsage(self.process) #always reaped, so poll() and wait() never hang
+            self.returncode = returncode
+            self.workspace.record(self.operation, time.perf_counter()-self.startTime, cpu)
+
+    def poll(self) -> int|None:
+        return self.returncode
+
+    def errors(self) -> str:
+        """What the process wrote to stderr, if it was started with captureErrors=True. Read it once it has exited."""
+        if self.errorFile is not None and not self.errorFile.closed:
+            with self.errorFile:
+                self.errorFile.seek(0)
+                self.errorText = self.errorFile.read().decode("utf-8", errors="replace")
+        return self.errorText
+
+    def brokenPipe(self) -> bool:
+        """Whether the process failed because the reader of its output went away (SIGPIPE, or EPIPE when FFmpeg ignores the signal)."""
+        sigpipe:int|None = getattr(signal, "SIGPIPE", None)
+        return self.returncode not in (None, 0) and ((sigpipe is not None and self.returncode == -sigpipe) or "Broken pipe" in self.errors())
+
+    def wait(self) -> int:
+        self.monitor.join()
+        return self.returncode
+
+    def kill(self) -> None:
+        if not hasattr(os, "wait4"): #Windows
+            self.process.kill()
+            return
+        if self.returncode is None:
+            try:
+                os.kill(self.process.pid, signal.SIGKILL) #not Popen.kill(): it polls first and could reap the process before the monitor's wait4
+            except ProcessLookupError:
+                pass
+
+def runFFprobe(cmd:list[str]) -> str:
+    """Run an ffprobe command in a PROBE slot of the scheduler and return its output, raising CalledProcessError if it fails."""
+    with scheduler.slot(FFmpegScheduler.PROBE, wait=mayWait()), tempfile.TemporaryFile() as errorFile: #stderr in a file, so it can't fill up while stdout is read
+        startTime:float = time.perf_counter()
+        process = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=errorFile)
+        with process.stdout:
+            output:str = process.stdout.read().decode("utf-8", errors="replace")
+        returncode, cpu = waitWithUsage(process) #not communicate(), which reaps the process and loses its CPU time
+        currentWorkspace().record("ffprobe", time.perf_counter()-startTime, cpu)
+        errorFile.seek(0)
+        errors:str = errorFile.read().decode("utf-8", errors="replace")
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, cmd, output, errors)
+    return output
+
+def runFFmpeg(cmd:list[str], background:bool=True, priority:int=FFmpegScheduler.INTERMEDIATE, operation:str|None=None) -> None:
+    """
+    Run an FFmpeg command, raising CalledProcessError if it fails. Every FFmpeg operation goes through here:
+    the process waits for a slot of the given priority class of the scheduler and gets its share of threads.
+    Inside a FFmpeg.streaming() block the process is started in the background and waited for at the end of the block.
+    Steps of composite operations (called by another operation) and commands run with background=False are always waited for,
+    since the operation itself reads their output.
+    Progress is sent to the progress listeners and timings are recorded under operation (by default the running FFmpeg operation).
+    Inside a FFmpeg.planning() block nothing is run: the command is only recorded.
+    """
+    operation = operation or currentOperation.get() or "ffmpeg"
+    plan:FFmpegPlan|None = activePlan.get()
+    stream:FFmpegStream|None = activeStream.get()
+    if plan is not None:
+        plan.add(cmd, operation, priority)
+    elif stream is not None and background and operationDepth.get() <= 1:
+        stream.start(cmd, priority, operation)
+    else:
+        with scheduler.slot(priority, wait=mayWait()) as threads:
+            process = FFmpegProcess(FFmpegScheduler.withThreads(cmd, threads), operation)
+            if process.wait() != 0:
+                raise subprocess.CalledProcessError(process.returncode, cmd)
+
+@contextlib.contextmanager
+def feedFFmpeg(cmd:list[str], priority:int=FFmpegScheduler.INTERMEDIATE, operation:str|None=None):
+    """
+    Run an FFmpeg command reading "-i -" from the binary file object yielded to the block, like runFFmpeg:
+    the process is closed and waited for when the block exits, raising CalledProcessError if it fails.
+    Inside a FFmpeg.planning() block the command is only recorded, and what's written is discarded.
+    """
+    operation = operation or currentOperation.get() or "ffmpeg"
+    plan:FFmpegPlan|None = activePlan.get()
+    if plan is not None:
+        plan.add(cmd, operation, priority)
+        with open(os.devnull, "wb") as sink:
+            yield sink
+        return
+    with scheduler.slot(priority, wait=mayWait()) as threads:
+        process = FFmpegProcess(FFmpegScheduler.withThreads(cmd, threads), operation, stdin=subprocess.PIPE)
+        try:
+            yield process.process.stdin
+            process.process.stdin.close()
+        except BrokenPipeError:
+            pass #FFmpeg exited early, its exit code tells why
+        except BaseException:
+            process.kill()
+            process.wait()
+            raise
+        if process.wait() != 0:
+            raise subprocess.CalledProcessError(process.returncode, cmd)
+
+async def runFFmpegAsync(cmd:list[str], priority:int=FFmpegScheduler.INTERMEDIATE, operation:str|None=None) -> None:
+    """Async runFFmpeg: waits for the scheduler and the process in a worker thread."""
+    await asyncio.to_thread(runFFmpeg, cmd, False, priority, operation)
+
+class FFmpegStream:
+    """
+    Streaming session returned by FFmpeg.streaming(): FFmpeg operations run inside it start immediately without waiting
+    for each other, and the pipes created with pipe() connect them, so a stage reads what the previous one writes while it's
+    being produced instead of going through an encoded file on disk.
+    Each pipe must be written by exactly one operation and read by exactly one other.
+    """
+    def __init__(self):
+        self.workspace:Workspace = currentWorkspace()
+        self.processes:list[tuple[list[str],FFmpegProcess,int]] = [] #(command, process, threads reserved on the scheduler)
+        self.pipes:list[str] = []
+
+    def pipe(self, prefix:str="stream") -> str:
+        """
+        Returns the path of a new named pipe, to be used as endPath of one operation and as input of another.
+        Operations writing to it use uncompressed video and audio in NUT instead of their usual encoders.
+        Operations reading it must not need to probe it (e.g. give FFmpegGraph.input() an explicit size).
+        """
+        path:str = self.workspace.path("nut", prefix, consumers=1)
+        os.mkfifo(path)
+        self.pipes.append(path)
+        return path
+
+    def start(self, cmd:list[str], priority:int=FFmpegScheduler.INTERMEDIATE, operation:str="ffmpeg") -> None:
+        # Stages of a stream depend on each other through the pipes, so they never wait for the budget (that could deadlock):
+        # their cores are reserved anyway, so other jobs see the load
+        threads:int = scheduler.threadsFor(priority)
+        scheduler.take(threads)
+        try:
+            process = FFmpegProcess(FFmpegScheduler.withThreads(cmd, threads), operation, captureErrors=True) #see wait()
+        except BaseException:
+            scheduler.release(threads)
+            raise
+        self.processes.append((cmd, process, threads))
+
+    def wait(self, kill:bool=False) -> None:
+        """
+        Wait for every started process. If one of them fails, the others are killed (they may be blocked on a pipe
+        that will never be opened) and CalledProcessError is raised. kill=True kills everything without raising.
+        A process writing a pipe that fails on a broken pipe isn't a failure if the reader succeeded: readers like
+        overlay=shortest=1 or -shortest may stop reading before the end, once their output is complete.
+        """
+        for pipe in self.pipes:
+            if sum(pipe in cmd for cmd, _, _ in self.processes) == 1:
+                kill = True
+                print(f"WARNING: pipe '{pipe}' was opened by a single FFmpeg process, killing the stream.")
+        if kill:
+            for _, process, _ in self.processes:
+                process.kill()
+        failed:subprocess.CalledProcessError|None = None
+        brokenWriters:list[tuple[list[str],FFmpegProcess]] = [] #judged once their reader has exited
+        pending:list[tuple[list[str],FFmpegProcess,int]] = list(self.processes)
+        while len(pending) > 0:
+            for entry in pending.copy():
+                cmd, process, threads = entry
+                if process.poll() is None:
+                    continue
+                pending.remove(entry)
+                scheduler.release(threads)
+                if process.returncode != 0 and cmd[-1] in self.pipes and not kill and process.brokenPipe():
+                    brokenWriters.append((cmd, process))
+                    continue
+                sys.stderr.write(process.errors())
+                if process.returncode != 0 and failed is None:
+                    failed = subprocess.CalledProcessError(process.returncode, cmd)
+                    for _, other, _ in pending:
+                        other.kill()
+            if len(pending) > 0:
+                time.sleep(0.05)
+        for cmd, process in brokenWriters:
+            readers:list[FFmpegProcess] = [other for otherCmd, other, _ in self.processes if cmd[-1] in otherCmd[:-1]]
+            if failed is None and any(reader.returncode != 0 for reader in readers):
+                sys.stderr.write(process.errors())
+                failed = subprocess.CalledProcessError(process.returncode, cmd)
+        self.processes.clear()
+        if failed is not None and not kill:
+            raise failed
+
+activeStream:contextvars.ContextVar[FFmpegStream|None] = contextvars.ContextVar("activeStream", default=None)
+
+class PlannedCommand:
+    """An FFmpeg command recorded by FFmpeg.planning() instead of being run, with its estimated cost."""
+    __slots__ = ("cmd", "operation", "priority", "info", "bytesRead", "bytesWritten", "encodedSeconds", "streamed")
+
+    def __init__(self, cmd:list[str], operation:str, priority:int, info:MediaInfo, bytesRead:int, bytesWritten:int, encodedSeconds:float, streamed:bool):
+        self.cmd:list[str] = cmd
+        self.operation:str = operation
+        self.priority:int = priority
+        self.info:MediaInfo = info #estimated format of the output
+        self.bytesRead:int = bytesRead #from files on disk (pipes excluded)
+        self.bytesWritten:int = bytesWritten #estimated size of the output (0 when it's a pipe)
+        self.encodedSeconds:float = encodedSeconds #seconds of video encoded (0 for stream copies and pipes)
+        self.streamed:bool = streamed #whether the output is a pipe of FFmpeg.streaming()
+
+class FFmpegPlan:
+    """
+    Dry run returned by FFmpeg.planning(): FFmpeg commands are recorded instead of being run, together with an estimate
+    (from probe data and command-line options) of the bytes they read and write and of the seconds of video they encode.
+    The estimated format of each planned output is returned when it's probed, so later steps can be planned too.
+    """
+    defaultBitrate:int = 128000 #bit/s of audio outputs without an explicit bitrate
+    videoCodecNames:dict[str,str] = {"libx264":"h264", "libx265":"hevc", "libvpx-vp9":"vp9", "libaom-av1":"av1", "libsvtav1":"av1"}
+
+    def __init__(self):
+        self.commands:list[PlannedCommand] = []
+        self.outputs:dict[str,PlannedCommand] = {} #absolute output path -> command writing it
+        self.lock = threading.Lock()
+
+    def planned(self, path:str) -> PlannedCommand|None:
+        with self.lock:
+            return self.outputs.get(os.path.abspath(path))
+
+    def move(self, source:str, destination:str) -> None:
+        """Planned os.replace(): the planned output at source is now at destination."""
+        with self.lock:
+            command:PlannedCommand|None = self.outputs.pop(os.path.abspath(source), None)
+            if command is not None:
+                self.outputs[os.path.abspath(destination)] = command
+
+    @staticmethod
+    def option(args:list[str], *names:str) -> str|None:
+        """Value of the last of the given options in args."""
+        value:str|None = None
+        for i, arg in enumerate(args[:-1]):
+            if arg in names:
+                value = args[i+1]
+        return value
+
+    @staticmethod
+    def parseCommand(cmd:list[str]) -> tuple[list[tuple[str,list[str]]],list[str],str]:
+        """Splits an FFmpeg command into its inputs (path, input options), output options and output path."""
+        inputs:list[tuple[str,list[str]]] = []
+        pending:list[str] = []
+        i:int = 1
+        while i < len(cmd)-1:
+            if cmd[i] == "-i":
+                inputs.append((cmd[i+1], pending))
+                pending = []
+                i += 2
+            else:
+                pending.append(cmd[i])
+                i += 1
+        return inputs, pending, cmd[-1]
+
+    def fileInfo(self, path:str) -> tuple[MediaInfo,int]:
+        """MediaInfo and size in bytes of a file, planned or on disk."""
+        command:PlannedCommand|None = self.planned(path)
+        if command is not None:
+            return command.info, command.bytesWritten
+        try:
+            info:MediaInfo = FFmpeg.probe(path)
+        except Exception:
+            info = MediaInfo()
+        try:
+            size:int = 0 if FFmpeg.isPipe(path) else os.path.getsize(path)
+        except OSError:
+            size = 0
+        return info, size
+
+    def concatInfo(self, listPath:str) -> tuple[MediaInfo,int]:
+        """MediaInfo and bytes read of a concat demuxer input, from its list of files and their inpoint/outpoint/duration directives."""
+        entries:list[dict] = []
+        try:
+            with open(listPath, "r") as f:
+                for line in f:
+                    key, _, value = line.strip().partition(" ")
+                    if key == "file":
+                        entries.append({"file":value.strip("'")})
+                    elif key in ("inpoint", "outpoint", "duration") and len(entries) > 0:
+                        entries[-1][key] = float(value)
+        except (OSError, ValueError):
+            return MediaInfo(), 0
+        result:MediaInfo|None = None
+        total:float = 0.0
+        bytesRead:float = 0.0
+        for entry in entries:
+            info, size = self.fileInfo(entry["file"])
+            if result is None:
+                result = MediaInfo(**info.toDict())
+            full:float|None = info.duration
+            length:float|None = entry.get("duration")
+            if length is None and full is not None:
+                length = entry.get("outpoint", full) - entry.get("inpoint", 0.0)
+            total += length or 0.0
+            bytesRead += size*min(1.0, length/full) if (length is not None and full) else size
+        if result is None:
+            return MediaInfo(), 0
+        result.duration = total
+        return result, int(bytesRead)
+
+    def inputInfo(self, path:str, options:list[str]) -> tuple[MediaInfo,int]:
+        """Estimated MediaInfo of what FFmpeg reads from the given input (its duration limited by input options) and bytes read from disk."""
+        if FFmpegPlan.option(options, "-f") == "concat":
+            info, size = self.concatInfo(path)
+        else:
+            info, size = self.fileInfo(path)
+            info = MediaInfo(**info.toDict())
+        full:float|None = info.duration
+        if FFmpegPlan.option(options, "-loop") == "1" or FFmpegPlan.option(options, "-stream_loop") == "-1":
+            info.duration = None #endless until limited below
+        begin:float = float(FFmpegPlan.option(options, "-ss") or 0.0)
+        limit:str|None = FFmpegPlan.option(options, "-t")
+        end:str|None = FFmpegPlan.option(options, "-to")
+        if limit is not None:
+            info.duration = float(limit) if info.duration is None else min(info.duration-begin, float(limit))
+        elif end is not None:
+            info.duration = float(end)-begin if info.duration is None else min(info.duration, float(end))-begin
+        elif info.duration is not None:
+            info.duration = max(0.0, info.duration-begin)
+        if full and info.duration is not None and info.duration < full:
+            size = int(size*info.duration/full)
+        return info, size
+
+    def estimate(self, cmd:list[str], operation:str, priority:int) -> PlannedCommand:
+        inputs, options, outputPath = FFmpegPlan.parseCommand(cmd)
+        infos:list[tuple[MediaInfo,int]] = [self.inputInfo(path, inputOptions) for path, inputOptions in inputs]
+        bytesRead:int = sum(size for _, size in infos)
+        filters:str = " ".join(value for value in (FFmpegPlan.option(options, "-vf", "-filter:v"), FFmpegPlan.option(options, "-filter_complex")) if value is not None)
+        script:str|None = FFmpegPlan.option(options, "-filter_complex_script")
+        if script is not None:
+            try:
+                with open(script, "r") as f:
+                    filters += " " + f.read()
+            except OSError:
+                pass
+        video:MediaInfo|None = next((info for info, _ in infos if info.hasVideo), None)
+        audio:MediaInfo|None = next((info for info, _ in infos if info.hasAudio), None)
+        out = MediaInfo()
+
+        #duration: explicit limits, then trims in the filters, then the inputs (the shortest one with -shortest)
+        durations:list[float] = [info.duration for info, _ in infos if info.duration is not None]
+        if len(durations) > 0:
+            out.duration = min(durations) if "-shortest" in options or "shortest=1" in filters else max(durations)
+        trims:list[float] = [float(end)-float(start) for start, end in re.findall(r"(?<![a-z])trim=start=([\d.]+):end=([\d.]+)", filters)]
+        if len(trims) > 0:
+            out.duration = max(trims) if out.duration is None else min(out.duration, max(trims))
+        begin:float = float(FFmpegPlan.option(options, "-ss") or 0.0)
+        if FFmpegPlan.option(options, "-t") is not None:
+            out.duration = float(FFmpegPlan.option(options, "-t"))
+        elif FFmpegPlan.option(options, "-to") is not None:
+            out.duration = float(FFmpegPlan.option(options, "-to"))-begin
+        elif out.duration is not None:
+            out.duration = max(0.0, out.duration-begin)
+        duration:float = out.duration or 0.0
+
+        streamed:bool = FFmpeg.isPipe(outputPath)
+        bitrate:float = 0.0 #bit/s of the output
+        encodedSeconds:float = 0.0
+        if video is not None and "-vn" not in options:
+            codec:str = FFmpegPlan.option(options, "-c:v", "-vcodec", "-c") or "libx264"
+            scales:list[tuple[str,str]] = re.findall(r"(?:scale|s)=(\d+)[:x](\d+)", filters)
+            explicitSize:str|None = FFmpegPlan.option(options, "-s")
+            if explicitSize is not None:
+                out.width, out.height = (int(x) for x in explicitSize.split("x"))
+            elif len(scales) > 0:
+                out.width, out.height = int(scales[-1][0]), int(scales[-1][1])
+            else:
+                out.width, out.height = video.width, video.height
+            rates:list[str] = re.findall(r"fps=([\d.]+)", filters)
+            rate:str|None = FFmpegPlan.option(options, "-r") or (rates[-1] if len(rates) > 0 else None)
+            out.fps = float(rate) if rate is not None else video.fps
+            out.pixelFormat = FFmpegPlan.option(options, "-pix_fmt") or video.pixelFormat
+            if codec == "copy":
+                out.videoCodec = video.videoCodec
+                source:tuple[MediaInfo,int] = next(entry for entry in infos if entry[0] is video)
+                bitrate += source[1]*8/source[0].duration if source[0].duration else 0.0
+            else:
+                out.videoCodec = FFmpegPlan.videoCodecNames.get(codec, codec)
+                pixels:float = (out.width or 0)*(out.height or 0)*(out.fps or 30.0)
+                if codec == "rawvideo":
+                    bitrate += pixels*12 #yuv420p
                 else:
-                    # Image is taller than target
-                    new_width = img.width
-                    new_height = int(new_width / target_ratio)
-                    top = (img.height - new_height) // 2
-                    crop_box = (0, top, new_width, top + new_height)
-                
-                cropped = img.crop(crop_box)
-                resized = cropped.resize(target_size, Image.Resampling.LANCZOS)
-                resized.save(output_path)
-                
-            elif method == 'borders':
-                # Maintain aspect ratio, add black borders
-                img.thumbnail(target_size, Image.Resampling.LANCZOS)
-                
-                # Create new image with black background
-                new_img = Image.new("RGB", target_size, (0, 0, 0))
-                
-                # Calculate position to center the thumbnail
-                paste_x = (target_size[0] - img.width) // 2
-                paste_y = (target_size[1] - img.height) // 2
-                
-                # Paste the thumbnail onto the black background
-                new_img.paste(img, (paste_x, paste_y))
-                new_img.save(output_path)
+                    #~0.08 bits per pixel at crf 23 for x264, doubling every 6 crf steps down (x265 and AV1 need about half)
+                    crf:float = float(FFmpegPlan.option(options, "-crf") or 23)
+                    bitrate += pixels*0.08*2**((23-crf)/6)*(0.5 if out.videoCodec in ("hevc", "av1", "vp9") else 1.0)
+                    encodedSeconds = duration
+        if audio is not None and "-an" not in options:
+            codec:str = FFmpegPlan.option(options, "-c:a", "-acodec", "-c") or "aac"
+            out.sampleRate = int(FFmpegPlan.option(options, "-ar") or audio.sampleRate or 44100)
+            out.channels = int(FFmpegPlan.option(options, "-ac") or audio.channels or 2)
+            if codec == "copy":
+                out.audioCodec = audio.audioCodec
+                if out.videoCodec is None or video is not audio: #otherwise it's already counted in the file's bitrate
+                    source:tuple[MediaInfo,int] = next(entry for entry in infos if entry[0] is audio)
+                    bitrate += source[1]*8/source[0].duration if source[0].duration else 0.0
+            elif codec.startswith("pcm_"):
+                out.audioCodec = codec
+                bitrate += out.sampleRate*out.channels*int(re.sub(r"\D", "", codec) or 16)
+            else:
+                out.audioCodec = codec
+                audioBitrate:str|None = FFmpegPlan.option(options, "-b:a")
+                bitrate += float(audioBitrate.lower().replace("k", "e3").replace("m", "e6")) if audioBitrate is not None else FFmpegPlan.defaultBitrate
+
+        bytesWritten:int = 0 if streamed else int(bitrate*duration/8)
+        return PlannedCommand(cmd, operation, priority, out, bytesRead, bytesWritten, encodedSeconds, streamed)
+
+    def placeholder(self, path:str, info:MediaInfo, operation:str, size:int=0) -> None:
+        """
+        Plan a file that work skipped while planning (text to speech, browser recordings, image resizing...) would write:
+        probing it returns info. It isn't a command, so it's not in the reports.
+        """
+        with self.lock:
+            self.outputs[os.path.abspath(path)] = PlannedCommand([], operation, FFmpegScheduler.INTERMEDIATE, info, 0, size, 0.0, False)
+
+    def add(self, cmd:list[str], operation:str, priority:int) -> None:
+        """Record a command instead of running it (see runFFmpeg)."""
+        command:PlannedCommand = self.estimate(cmd, operation, priority)
+        with self.lock:
+            self.commands.append(command)
+            self.outputs[os.path.abspath(cmd[-1])] = command
+
+    def keyframes(self, path:str) -> array|None:
+        """Estimated keyframes of a planned output: one every GOP (-g, 250 frames by default), or None if path isn't planned."""
+        command:PlannedCommand|None = self.planned(path)
+        if command is None:
+            return None
+        gop:float = float(FFmpegPlan.option(command.cmd, "-g") or 250)/(command.info.fps or 30.0)
+        return array("d", (i*gop for i in range(int((command.info.duration or 0.0)/gop)+1)))
+
+    def commandsReport(self) -> str:
+        """Returns the planned commands, one per line, in the order they would run."""
+        return "\n".join(shlex.join(command.cmd) for command in self.commands)
+
+    def report(self) -> str:
+        """Returns a table of the planned commands' estimated cost, per operation, with the totals."""
+        rows:dict[str,dict[str,float]] = {}
+        with self.lock:
+            commands:list[PlannedCommand] = list(self.commands)
+        for command in commands:
+            totals:dict[str,float] = rows.setdefault(command.operation, {"runs":0, "encodes":0, "encoded":0.0, "read":0, "written":0})
+            totals["runs"] += 1
+            totals["encodes"] += 1 if command.encodedSeconds > 0 else 0
+            totals["encoded"] += command.encodedSeconds
+            totals["read"] += command.bytesRead
+            totals["written"] += command.bytesWritten
+        header:str = f"{'OPERATION':<28}{'RUNS':>6}{'ENCODES':>9}{'ENCODED (s)':>13}{'READ (MB)':>11}{'WRITTEN (MB)':>14}"
+        def line(name:str, totals:dict[str,float]) -> str:
+            return f"{name:<28}{int(totals['runs']):>6}{int(totals['encodes']):>9}{totals['encoded']:>13.1f}{totals['read']/1e6:>11.1f}{totals['written']/1e6:>14.1f}"
+        lines:list[str] = [header]
+        for operation, totals in sorted(rows.items(), key=lambda item: item[1]["encoded"], reverse=True):
+            lines.append(line(operation, totals))
+        overall:dict[str,float] = {key:sum(totals[key] for totals in rows.values()) for key in ("runs", "encodes", "encoded", "read", "written")}
+        lines.append(line("TOTAL", overall))
+        intermediates:int = sum(command.bytesWritten for command in commands if command.priority != FFmpegScheduler.FINAL)
+        streamed:int = sum(1 for command in commands if command.streamed)
+        lines.append(f"Intermediate files: {intermediates/1e6:.1f} MB, final outputs: {(overall['written']-intermediates)/1e6:.1f} MB, streamed stages: {streamed}")
+        return "\n".join(lines)
+
+activePlan:contextvars.ContextVar[FFmpegPlan|None] = contextvars.ContextVar("activePlan", default=None)
 
 class FFmpeg:
+    @staticmethod
+    @contextlib.contextmanager
+    def streaming():
+        """
+        Run the FFmpeg operations of the block as concurrent processes connected by named pipes, see FFmpegStream.
+        Waits for all of them when the block exits; files consumed inside the block are deleted only then.
+
+            with FFmpeg.streaming() as stream:
+                bg = stream.pipe()
+                FFmpeg.imagesToVideo(images, durations, 0.5, 30, bg)
+                FFmpeg.overlayVideo(bg, overlay, endPath)
+        """
+        stream = FFmpegStream()
+        token = activeStream.set(stream)
+        try:
+            with deferConsumption():
+                try:
+                    yield stream
+                except BaseException:
+                    activeStream.reset(token)
+                    stream.wait(kill=True)
+                    raise
+                activeStream.reset(token)
+                stream.wait()
+        finally:
+            stream.workspace.consumed(*stream.pipes)
+
+    @staticmethod
+    @contextlib.contextmanager
+    def planning():
+        """
+        Dry run: FFmpeg commands issued inside the block are recorded instead of being run, see FFmpegPlan.
+        Probing a planned output returns its estimated format, so whole jobs can be planned without encoding anything.
+        Expensive work that doesn't go through FFmpeg (text to speech, alignment, browser screenshots and recordings,
+        image resizing) is skipped too, leaving planned placeholders (see FFmpegPlan.placeholder) or blank images,
+        and nothing is written to the caches.
+
+            with FFmpeg.planning() as plan:
+                computeVideo(...)
+            print(plan.report())
+        """
+        plan = FFmpegPlan()
+        token = activePlan.set(plan)
+        try:
+            yield plan
+        finally:
+            activePlan.reset(token)
+
+    @staticmethod
+    def addProgressListener(listener:Callable[[ProgressEvent], None]) -> None:
+        """
+        Call listener with a ProgressEvent (frame, fps, speed, output time and size) about twice a second for every running FFmpeg process,
+        and once more when it ends. Listeners are called from monitor threads, so they must be quick and thread-safe.
+        """
+        progressListeners.append(listener)
+
+    @staticmethod
+    def removeProgressListener(listener:Callable[[ProgressEvent], None]) -> None:
+        if listener in progressListeners:
+            progressListeners.remove(listener)
+
+    @staticmethod
+    @contextlib.contextmanager
+    def progressListener(listener:Callable[[ProgressEvent], None]):
+        """Add the listener for the duration of the block."""
+        FFmpeg.addProgressListener(listener)
+        try:
+            yield listener
+        finally:
+            FFmpeg.removeProgressListener(listener)
+
+    @staticmethod
+    def printProgress(event:ProgressEvent) -> None:
+        """Ready-made progress listener that keeps a single status line updated on the console."""
+        outTime:str = "-" if event.outTime is None else str(datetime.timedelta(seconds=int(event.outTime)))
+        print(f"\r[{event.operation}] time={outTime} frame={event.frame} fps={event.fps} speed={event.speed}x".ljust(79), end="\n" if event.done else "", flush=True)
+
+    @staticmethod
+    def isPipe(path:str) -> bool:
+        try:
+            return stat.S_ISFIFO(os.stat(path).st_mode)
+        except OSError:
+            return False
+
+    @staticmethod
+    def encoderProfile(profile:str|None=None, isTemp:bool=True) -> EncoderProfile:
+        """
+        Returns the named profile of config.encoderProfiles. With profile=None, temporary outputs (read again by a later step)
+        get the cheap "intermediate" profile and the others get "final".
+        """
+        if profile is None:
+            profile = "intermediate" if isTemp else "final"
+        if profile not in encoderProfiles:
+            raise ValueError(f"Unknown encoder profile '{profile}', available profiles are: {', '.join(encoderProfiles)}.")
+        return encoderProfiles[profile]
+
+    @staticmethod
+    def encoderArgs(profile:str|None=None, isTemp:bool=True, video:bool=True, audio:bool=False) -> list[str]:
+        """Output options encoding video (and audio, if audio=True) with the given profile, chosen as in encoderProfile()."""
+        settings:EncoderProfile = FFmpeg.encoderProfile(profile, isTemp)
+        args:list[str] = []
+        if video:
+            args.extend(["-c:v", settings.videoCodec])
+            if settings.preset is not None:
+                args.extend(["-preset", settings.preset])
+            if settings.crf is not None:
+                args.extend(["-crf", str(settings.crf)])
+            args.extend(["-pix_fmt", settings.pixelFormat])
+        if audio:
+            args.extend(["-c:a", settings.audioCodec])
+            if settings.audioBitrate is not None:
+                args.extend(["-b:a", settings.audioBitrate])
+        return args + settings.extraArgs
+
+    @staticmethod
+    def pipeCodecArgs(endPath:str, audio:bool=False) -> list[str]:
+        """
+        Output options for an intermediate written to a pipe of FFmpeg.streaming(): uncompressed video (and audio, if audio=True)
+        in NUT, so the middle step costs no encode and loses no quality. Returns an empty list when endPath is a regular file.
+        """
+        if not FFmpeg.isPipe(endPath):
+            return []
+        return ["-c:v", "rawvideo", "-pix_fmt", "yuv420p"] + (["-c:a", "pcm_s16le"] if audio else []) + ["-f", "nut", "-y"]
+
+    @staticmethod
+    def probe(path:str) -> MediaInfo:
+        """
+        Returns duration, resolution, framerate, codecs, sample rate, channels and pixel format of the given file,
+        using a single ffprobe process (results are cached, see lib/mediacache).
+        Inside a FFmpeg.planning() block, outputs of planned commands return their estimated format.
+        """
+        plan:FFmpegPlan|None = activePlan.get()
+        if plan is not None and plan.planned(path) is not None:
+            return MediaInfo.fromDict(plan.planned(path).info.toDict())
+        if FFmpeg.isPipe(path):
+            raise ValueError(f"Unable to probe '{path}': it's a pipe, reading it would steal the data of its consumer.")
+        def probe() -> dict:
+            output:str = runFFprobe([
+                "ffprobe",
+                "-v", "error",
+                "-show_format",
+                "-show_streams",
+                "-of", "json",
+                path
+            ])
+            return MediaInfo.fromFFprobe(json.loads(output)).toDict()
+        return MediaInfo.fromDict(probeCache.cached(path, "mediainfo", probe)) #not "info" anymore: results cached before codec profiles were probed lack them
+
+    @staticmethod
+    def probeMany(paths:list[str], workers:int=8) -> list[MediaInfo]:
+        """
+        Probe many files concurrently. Returns their MediaInfo in the same order as paths.
+        """
+        with ThreadPoolExecutor(max_workers=max(1, min(workers, len(paths)))) as executor:
+            futures = [executor.submit(contextvars.copy_context().run, FFmpeg.probe, path) for path in paths] #keeps the job's workspace (and plan) in worker threads
+            return [future.result() for future in futures]
+
     @staticmethod
     def getLength(path:str) -> float:
-        result = subprocess.run(
-            ["ffprobe", 
-            "-v", "error", 
-            "-show_entries", "format=duration", 
-            "-of", "default=noprint_wrappers=1:nokey=1", 
-            path],
-            capture_output=True,
-            text=True,
-            check=True
-        )
-        return float(result.stdout.strip())
+        duration:float|None = FFmpeg.probe(path).duration
+        if duration is None:
+            raise ValueError(f"Unable to get the duration of '{path}'.")
+        return duration
     
     @staticmethod
     def getSize(path:str) -> tuple[int,int]: #returns (width,height), works for both pictures and videos
-        result = subprocess.run([
-            "ffprobe", 
-            "-v", "error",
-            "-select_streams", "v:0", 
-            "-show_entries", "stream=width,height", 
-            "-of", "csv=p=0", 
-            path
-        ], capture_output=True, text=True, check=True)
-        result = result.stdout.strip().split(",")
-        return (int(result[0]),int(result[1]))
+        size:tuple[int,int]|None = FFmpeg.probe(path).size
+        if size is None:
+            raise ValueError(f"Unable to get the size of '{path}': it has no video stream.")
+        return size
 
     @staticmethod
     def getFramerate(path:str) -> int:
-        result = subprocess.run([
-            "ffprobe",
-            "-v", "error",
-            "-select_streams", "v",
-            "-of", "default=noprint_wrappers=1:nokey=1",
-            "-show_entries", "stream=r_frame_rate",
-            path
-        ], capture_output=True, text=True, check=True)
-        result = result.stdout.strip().split("/")
-        return round(float(result[0])/float(result[1]))
-
-    @staticmethod
-    def getKeyframes(path:str) -> list[float]:
-        # Run ffprobe to print keyframe timestamps as plain text
-        cmd = [
-            "ffprobe",
-            "-select_streams", "v:0",
-            "-v", "error",              # suppress info logs
-            "-skip_frame", "nokey",
-            "-show_frames",
-            "-show_entries", "frame=best_effort_timestamp_time",
-            "-of", "csv=p=0",
-            path
-        ]
-
-        result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, check=True)
-
-        # Filter output lines to keep only numeric timestamps
-        timestamps = []
-        for line in result.stdout.splitlines():
-            match = re.match(r'^(\d+(?:\.\d+)?)', line)
-            if match:
-                timestamps.append(float(match.group(1)))
-        
-        return timestamps
+        fps:float|None = FFmpeg.probe(path).fps
+        if fps is None:
+            raise ValueError(f"Unable to get the framerate of '{path}': it has no video stream.")
+        return round(fps)
 
     @staticmethod
-    def getClosestKeyframe(keyframes:list[float], time:float, direction:str="down") -> float: #direction="down" will round down, direction="up" will round up
+    def getKeyframes(path:str) -> array:
+        """
+        Returns the sorted timestamps (seconds) of the keyframes of the first video stream, as a compact array('d').
+        Keyframes are found from packet flags, so nothing gets decoded, and the index is cached on disk with the other probe data.
         """
-        Gets the closest keyframe to the given time.
+        plan:FFmpegPlan|None = activePlan.get()
+        if plan is not None and plan.planned(path) is not None:
+            return plan.keyframes(path)
+        def probe() -> array:
+            output:str = runFFprobe([
+                "ffprobe",
+                "-v", "error",
+                "-select_streams", "v:0",
+                "-show_entries", "packet=pts_time,flags",
+                "-of", "csv=p=0",
+                path
+            ])
+
+            timestamps = array("d")
+            for line in output.splitlines():
+                fields:list[str] = line.split(",")
+                if len(fields) >= 2 and "K" in fields[1] and fields[0] not in ("", "N/A"):
+                    timestamps.append(float(fields[0]))
+            return array("d", sorted(timestamps)) #packets are in decoding order, which might differ from presentation order
+        return probeCache.cached(path, "keyframeindex", probe, encode=lambda a: a.tobytes(), decode=lambda b: array("d", b))
+
+    @staticmethod
+    def getClosestKeyframe(keyframes:array|list[float], time:float, direction:str="down") -> float: #direction="down" will round down, direction="up" will round up
+        """
+        Gets the closest keyframe to the given time, with a binary search.
         
         Args:
-            keyframes (list): List of keyframe timestamps in seconds.
+            keyframes (array|list): Sorted keyframe timestamps in seconds (as returned by getKeyframes).
             time (float): Time in seconds to find closest keyframe.
             direction (str): "down" for rounding down, "up" for rounding up.
         
@@ -143,14 +1094,22 @@ class FFmpeg:
             float: Closest keyframe timestamp.
         """
         if direction == "down":
-            return max([kf for kf in keyframes if kf <= time], default=keyframes[0])
+            i:int = bisect.bisect_right(keyframes, time) - 1
+            return keyframes[max(i, 0)]
         elif direction == "up":
-            return min([kf for kf in keyframes if kf >= time], default=keyframes[-1])
+            i:int = bisect.bisect_left(keyframes, time)
+            return keyframes[min(i, len(keyframes)-1)]
         else:
             raise ValueError("Direction must be 'down' or 'up'")
 
     @staticmethod
-    def clearTemp(files:list[str]=tempFiles) -> None:
+    def clearTemp(files:list[str]|None=None) -> None:
+        """
+        Delete the given files, or all temporary files of the current workspace (see lib/workspace) if files is None.
+        """
+        if files is None:
+            currentWorkspace().clear()
+            return
         for file in files:
             try:
                 os.remove(file)
@@ -159,56 +1118,16 @@ class FFmpeg:
 
     @staticmethod
     def getFontNameFromFile(font_path):
-        font = TTFont(font_path)
-        for record in font["name"].names:
-            if record.nameID == 1:  # Font Family name
-                return record.toUnicode()
-        return None
+        """Returns the family name of the given font file (memoised in the probe cache, so each file is parsed only once)."""
+        return probeCache.cached(font_path, "fontfamily", lambda: readFamilyName(font_path))
 
     @staticmethod
     def getFontPath(font_name, extensions=None) -> None | str:
-        if extensions is None:
-            extensions = ['.ttf', '.otf', '.ttc']
-        
-        system = platform.system()
-        font_dirs = []
-        
-        if system == "Windows":
-            font_dirs = [
-                os.path.join(os.environ.get('WINDIR', 'C:\\Windows'), 'Fonts'),
-                os.path.join(os.environ.get('LOCALAPPDATA', ''), 'Microsoft', 'Windows', 'Fonts')
-            ]
-        elif system == "Darwin":  # macOS
-            font_dirs = [
-                '/Library/Fonts/',
-                '/System/Library/Fonts/',
-                os.path.expanduser('~/Library/Fonts/')
-            ]
-        else:  # Linux and others
-            font_dirs = [
-                '/usr/share/fonts/',
-                '/usr/local/share/fonts/',
-                os.path.expanduser('~/.fonts/'),
-                os.path.expanduser('~/.local/share/fonts/')
-            ]
-        
-        # Search for font
-        for font_dir in font_dirs:
-            if os.path.exists(font_dir):
-                for root, dirs, files in os.walk(font_dir):
-                    for file in files:
-                        file_lower = file.lower()
-                        font_lower = font_name.lower()
-                        
-                        # Check if filename contains font name (with or without extension)
-                        base_name = os.path.splitext(file_lower)[0]
-                        if font_lower in base_name:
-                            # Check if it's a valid font extension
-                            if any(file_lower.endswith(ext) for ext in extensions):
-                                full_path = os.path.join(root, file)
-                                return full_path
-        
-        return None
+        """
+        Returns the path of an installed font, looked up by family name, then by exact file name, then by partial file name
+        (see lib/fontindex, the installed fonts are indexed once and the index is kept on disk).
+        """
+        return fontIndex.find(font_name, extensions)
 
     @staticmethod
     def shiftTimestamp(ts, offset) -> str:
@@ -225,6 +1144,25 @@ class FFmpeg:
         cs = int(td.microseconds / 10000)
         return f"{hours:01d}:{minutes:02d}:{seconds:02d}.{cs:03d}"
 
+    @staticmethod
+    def srtWindows(srt_file, offset:float=0.0) -> list[tuple[float,float]]:
+        """
+        Returns the (begin time, end time) of every cue of the given SRT file, in seconds, delayed by offset.
+        While planning, subtitles that aren't written yet (see alignSRT) are assumed to cover the whole video.
+        """
+        if activePlan.get() is not None and not os.path.exists(srt_file):
+            return [(offset, float("inf"))]
+        def seconds(ts:str) -> float:
+            h, m, rest = ts.strip().replace(",", ".").split(":")
+            return int(h)*3600 + int(m)*60 + float(rest)
+        windows:list[tuple[float,float]] = []
+        with open(srt_file, "r", encoding="utf-8") as f:
+            for line in f:
+                if "-->" in line:
+                    begin, end = line.split("-->")
+                    windows.append((seconds(begin)+offset, seconds(end.split()[0])+offset))
+        return windows
+
     @staticmethod
     def srtToAss(resolution:tuple[int,int],srt_file,ass_file,font_path,font_size=48,text_color="&H00FFFFFF",outline_color="&H00000000",outline_width=2,alignment=5,time_offset=0.0):
         """
@@ -322,92 +1260,154 @@ class FFmpeg:
             return f"0x{rr}{gg}{bb}"
 
     @staticmethod
-    def concatenate(paths: list[str], endPath: str, reencode=False, isTemp=True) -> None:
+    def formatSignature(info:MediaInfo) -> tuple:
+        """
+        Returns the codec parameters that must be identical between files for them to be concatenated with stream copy.
+        """
+        return (info.videoCodec, info.width, info.height, info.pixelFormat, None if info.fps is None else round(info.fps, 3), info.audioCodec, info.sampleRate, info.channels,
+                info.videoProfile, info.level, info.timeBase, info.channelLayout)
+
+    @staticmethod
+    @consumes("path")
+    def normalise(path:str, endPath:str, size:tuple[int,int]|None=None, framerate:float|None=None, sampleRate:int=44100, channels:int=2, profile:str|None="intermediate", reference:MediaInfo|None=None, silence:bool=True) -> None:
+        """
+        Re-encode a file to the common format used by concatenate (H.264, yuv420p, AAC, by default stereo at 44.1 kHz),
+        optionally scaling it to the given size and converting it to the given framerate, with the given encoder profile.
+        If reference is given, the H.264 profile, level and timescale are those of the reference, so the result can be joined to it with stream copy.
+        If silence=True, a silent audio track is added to files without audio.
+        """
+        cmd:list[str] = ["ffmpeg", "-v", "error", "-i", path]
+        if silence and FFmpeg.probe(path).audioCodec is None:
+            cmd.extend(["-f", "lavfi", "-i", "anullsrc", "-map", "0:v:0", "-map", "1:a", "-shortest"]) #-ac and -ar below give it the right format
+        filters:list[str] = []
+        if size is not None:
+            filters.append(f"scale={size[0]}:{size[1]},setsar=1")
+        if framerate is not None:
+            filters.append(f"fps={framerate}")
+        if len(filters) > 0:
+            cmd.extend(["-vf", ",".join(filters)])
+        cmd.extend(FFmpeg.encoderArgs(profile, audio=True))
+        if reference is not None:
+            cmd.extend(FFmpeg.matchingEncoderArgs(reference)) #overrides the profile's H.264 parameters
+        cmd.extend([
+            "-ac", str(channels),
+            "-ar", str(sampleRate),
+            "-y",                  # overwrite if exists
+            endPath
+        ])
+        runFFmpeg(cmd)
+
+    @staticmethod
+    @consumes("paths")
+    def concatenate(paths: list[str], endPath: str, reencode=False, isTemp=True, profile:str|None=None) -> None:
         """
         Concatenate multiple video files.
     
         If reencode=False, inputs must already have identical codec parameters.
-        If reencode=True, each input is re-encoded to a common format (H.264, yuv420p,
-        stereo AAC at 44.1 kHz) before concatenation. The temporary normalised files
-        are automatically cleaned up.
+        If reencode=True, inputs are compared using their probe data: if they already share codec parameters they are
+        concatenated with stream copy, otherwise only the outliers are re-encoded, in parallel, to the common format (H.264, yuv420p, AAC)
+        with the resolution, framerate and audio parameters of the other inputs (stereo at 44.1 kHz when no input is in the common format),
+        getting a silent audio track if they have none. If a normalised input still doesn't match, every input is normalised.
+        Files previously written by concatenate(reencode=True) are only normalised again in that case.
+        The temporary normalised files are automatically cleaned up.
     
         Args:
             paths: List of input file paths.
             endPath: Output file path.
-            reencode: If True, normalise all inputs to a common format.
-            isTemp: If True, endPath will be added to tempFiles for later cleanup.
+            reencode: If True, normalise incompatible inputs to a common format.
+            isTemp: If True, endPath will be tracked by the current workspace for later cleanup.
+            profile: Encoder profile of the normalised inputs, which end up in endPath (by default chosen from isTemp, see encoderProfile).
         """
         # Create the concat list file
-        textFile = tempFolder + os.path.splitext(os.path.basename(endPath))[0] + ".txt"
-        tempFiles.append(textFile)
+        workspace = currentWorkspace()
+        textFile = workspace.path("txt", "concat", consumers=1)
 
+        concatPaths:list[str] = list(paths)
         if reencode:
-            # Normalise each input to a common format
-            normalised_paths = []
-            for i, p in enumerate(paths):
-                norm = f"{tempFolder}norm_{random.randint(10000,99999)}_{i}.mp4"
-                subprocess.run([
-                    "ffmpeg",
-                    "-v", "error",
-                    "-i", p,
-                    "-c:v", "libx264",
-                    "-pix_fmt", "yuv420p",
-                    "-c:a", "aac",
-                    "-ac", "2",           # force stereo
-                    "-ar", "44100",        # force 44.1 kHz sample rate
-                    "-y",                  # overwrite if exists
-                    norm
-                ], check=True)
-                normalised_paths.append(norm)
-                tempFiles.append(norm)     # mark for cleanup
-
-            # Write the list of normalised files
-            with open(textFile, "w") as f:
-                for item in normalised_paths:
-                    f.write(f"file '{item}'\n")
-
-            # Concatenate using stream copy (all files are now compatible)
-            subprocess.run([
-                "ffmpeg",
-                "-v", "error",
-                "-safe", "0",
-                "-f", "concat",
-                "-i", textFile,
-                "-c", "copy",              # no re-encoding needed
-                endPath
-            ], check=True)
-        else:
-            # No normalisation: assume inputs are already compatible
-            with open(textFile, "w") as f:
-                for item in paths:
-                    f.write(f"file '{item}'\n")
-            subprocess.run([
-                "ffmpeg",
-                "-v", "error",
-                "-safe", "0",
-                "-f", "concat",
-                "-i", textFile,
-                "-c", "copy",
-                endPath
-            ], check=True)
+            infos:list[MediaInfo] = FFmpeg.probeMany(paths)
+            signatures:list[tuple] = [FFmpeg.formatSignature(info) for info in infos]
+            if len(set(signatures)) > 1:
+                # Pick the reference format among inputs that already use the common codecs:
+                # a file previously written by this function if there is one, otherwise the most common format
+                common:list[tuple] = [sig for sig in signatures if sig[0] == "h264" and sig[3] == "yuv420p" and sig[5] == "aac"]
+                reference:tuple|None = None
+                for p, sig in zip(paths, signatures):
+                    if os.path.abspath(p) in normalisedFiles and sig in common:
+                        reference = sig
+                        break
+                if reference is None and len(common) > 0:
+                    reference = max(set(common), key=common.count)
+                referenceInfo:MediaInfo|None = None if reference is None else infos[signatures.index(reference)]
+                # Outliers get the resolution and framerate of the reference (or of most inputs if there is none)
+                geometries:list[tuple] = [(sig[1], sig[2], sig[4]) for sig in signatures]
+                geometry:tuple = (reference[1], reference[2], reference[4]) if reference is not None else max(set(geometries), key=geometries.count)
+
+                normaliseProfile:str = profile or ("intermediate" if isTemp else "final")
+                size:tuple[int,int]|None = None if geometry[0] is None else (geometry[0], geometry[1])
+                audio:tuple[int,int] = (reference[6], reference[7]) if reference is not None else (44100, 2)
+                silence:bool = reference[5] is not None if reference is not None else any(info.audioCodec is not None for info in infos)
+
+                def normaliseInputs(indices:list[int], match:MediaInfo|None) -> set[tuple]:
+                    """Normalise the inputs at the given indices in parallel, returning the signatures of the results."""
+                    with ThreadPoolExecutor(max_workers=max(1, min(maxParallelEncodes, len(indices)))) as executor:
+                        futures = []
+                        for i in indices:
+                            concatPaths[i] = workspace.path("mp4", f"norm-{i}", consumers=1) # deleted right after the concatenation
+                            futures.append(executor.submit(contextvars.copy_context().run, FFmpeg.normalise, paths[i], concatPaths[i], size, geometry[2], audio[0], audio[1], normaliseProfile, match, silence)) #copying the context keeps the job's workspace in worker threads
+                        for future in futures:
+                            future.result() # re-raises normalisation errors
+                    if activePlan.get() is not None: #planned outputs have no codec parameters to compare
+                        return set()
+                    return {FFmpeg.formatSignature(FFmpeg.probe(concatPaths[i])) for i in indices}
+
+                results:set[tuple] = normaliseInputs([i for i, sig in enumerate(signatures) if sig != reference], referenceInfo)
+                if len(results | ({reference} if reference is not None else set())) > 1:
+                    print("WARNING: normalised inputs don't match the reference format, normalising every input.")
+                    silence = any(info.audioCodec is not None for info in infos)
+                    workspace.consumed(*[p for p in concatPaths if p not in paths])
+                    concatPaths = list(paths)
+                    results = normaliseInputs(list(range(len(paths))), None)
+                    if len(results) > 1:
+                        workspace.consumed(*[p for p in concatPaths if p not in paths], textFile)
+                        raise RuntimeError(f"Unable to normalise the inputs to a single format: {results}")
+
+        # Write the list of files
+        with open(textFile, "w") as f:
+            for item in concatPaths:
+                f.write(f"file '{item}'\n")
+
+        # Concatenate using stream copy (all files are compatible)
+        runFFmpeg([
+            "ffmpeg",
+            "-v", "error",
+            "-safe", "0",
+            "-f", "concat",
+            "-i", textFile,
+            "-c", "copy",              # no re-encoding needed
+            endPath
+        ], priority=outputPriority(isTemp))
+
+        workspace.consumed(textFile, *[p for p in concatPaths if p not in paths])
+        if reencode and activePlan.get() is None: #a planned output was never written
+            normalisedFiles.add(os.path.abspath(endPath))
 
         # If the output is temporary, add it to the cleanup list
         if isTemp:
-            tempFiles.append(endPath)
+            currentWorkspace().track(endPath)
 
     @staticmethod
-    def cut(ogPath:str, begin:float, end:float, endPath:str, reencode:bool=True, roundUpOrDown:tuple[bool,bool]=(True,True), isTemp=True) -> None: #if reencode=True, the video will be reencoded so the cut will be frame-perfect. else, the video will get rounded to the nearest keyframe. set roundUpOrDown to True to add excess frames, set it to False to cut them: since it's a tuple, this applies to both begin and end time
+    @consumes("ogPath")
+    def cut(ogPath:str, begin:float, end:float, endPath:str, reencode:bool=True, roundUpOrDown:tuple[bool,bool]=(True,True), isTemp=True, profile:str|None=None) -> None: #if reencode=True, the video will be reencoded so the cut will be frame-perfect. else, the video will get rounded to the nearest keyframe. set roundUpOrDown to True to add excess frames, set it to False to cut them: since it's a tuple, this applies to both begin and end time
         if reencode:
-            subprocess.run([
+            runFFmpeg([
                 "ffmpeg",
                 "-v", "error",
                 "-ss", str(begin), 
                 "-to", str(end),
                 "-i", ogPath,
-                "-c:v", "libx264", 
-                "-c:a", "aac",
+                *FFmpeg.encoderArgs(profile, isTemp, audio=True),
                 endPath
-            ], check=True)
+            ], priority=outputPriority(isTemp))
         else:
             keyframes:list[float] = FFmpeg.getKeyframes(ogPath)
             if roundUpOrDown[0]:
@@ -418,7 +1418,7 @@ class FFmpeg:
                 endClosestKeyframe:float = FFmpeg.getClosestKeyframe(keyframes, end, direction="up")
             else:
                 endClosestKeyframe:float = FFmpeg.getClosestKeyframe(keyframes, end, direction="down")
-            subprocess.run([
+            runFFmpeg([
                 "ffmpeg",
                 "-v", "error",
                 "-ss", str(beginClosestKeyframe), 
@@ -426,14 +1426,15 @@ class FFmpeg:
                 "-i", ogPath,
                 "-c", "copy",
                 endPath
-            ], check=True)
+            ], priority=outputPriority(isTemp))
         
         if isTemp:
-            tempFiles.append(endPath)
+            currentWorkspace().track(endPath)
 
     @staticmethod
+    @consumes("audioPath", "videoPath")
     def addAudioToVideo(audioPath:str, videoPath:str, endPath:str, isTemp=True) -> None: #will cut the longest of video or audio to fit the lenght of the shortes of the two
-        subprocess.run([
+        runFFmpeg([
             "ffmpeg",
             "-v", "error",
             "-i", videoPath, 
@@ -443,31 +1444,32 @@ class FFmpeg:
             "-map", "1:a:0",
             "-shortest", 
             endPath
-        ], check=True)
+        ], priority=outputPriority(isTemp))
         if isTemp:
-            tempFiles.append(endPath)
+            currentWorkspace().track(endPath)
 
     @staticmethod
-    def imageToVideo(imagePath:str, endPath:str, duration:float, framerate:int=30, isTemp=True) -> None:
+    @consumes("imagePath")
+    def imageToVideo(imagePath:str, endPath:str, duration:float, framerate:int=30, isTemp=True, profile:str|None=None) -> None:
         """
         Convert a given image to a video of given duration and frame rate.
         """
-        subprocess.run([
+        runFFmpeg([
             "ffmpeg",
             "-v", "error",
             "-loop", "1",
             "-i", imagePath,
             "-t", str(duration),
             "-r", str(framerate),
-            "-c:v", "libx264",
-            "-pix_fmt", "yuv420p",
+            *(FFmpeg.pipeCodecArgs(endPath) or FFmpeg.encoderArgs(profile, isTemp)),
             endPath
-        ], check=True)
+        ], priority=outputPriority(isTemp))
         if isTemp:
-            tempFiles.append(endPath)
+            currentWorkspace().track(endPath)
 
     @staticmethod
-    def imagesToVideo(images: list[str], durations: list[float], fade_duration: float, framerate: int, output_path: str, isTemp=True) -> None:
+    @consumes("images")
+    def imagesToVideo(images: list[str], durations: list[float], fade_duration: float, framerate: int, output_path: str, isTemp=True, profile:str|None=None) -> None:
         """
         Create a video from multiple images, each shown for a specified duration,
         with fade-in and fade-out on each segment. All segments are concatenated.
@@ -478,7 +1480,8 @@ class FFmpeg:
             fade_duration: Duration of fade in/out for each segment.
             framerate: Output framerate.
             output_path: Destination video file.
-            isTemp: If True, output_path will be added to tempFiles.
+            isTemp: If True, output_path will be tracked by the current workspace for later cleanup.
+            profile: Encoder profile (by default chosen from isTemp, see encoderProfile).
         """
         if len(images) != len(durations):
             raise ValueError("images and durations must have same length")
@@ -502,59 +1505,240 @@ class FFmpeg:
         filter_complex = ";".join(filter_parts + [concat_filter])
     
         cmd.extend(["-filter_complex", filter_complex,
-                    "-map", "[bg]", "-r", str(framerate),
-                    "-c:v", "libx264", "-pix_fmt", "yuv420p",
-                    "-preset", "fast", "-crf", "23",  # optional quality tuning
-                    output_path])
+                    "-map", "[bg]", "-r", str(framerate)])
+        cmd.extend(FFmpeg.pipeCodecArgs(output_path) or FFmpeg.encoderArgs(profile, isTemp))
+        cmd.append(output_path)
     
-        subprocess.run(cmd, check=True)
+        runFFmpeg(cmd, priority=outputPriority(isTemp))
     
         if isTemp:
-            tempFiles.append(output_path)
+            currentWorkspace().track(output_path)
 
     @staticmethod
-    def applyVideoEffect(sourcePath:str, endPath:str, filter:str, isTemp=True) -> None:
+    @consumes("images")
+    def slideshow(images: list[str], durations: list[float], fade_duration: float, framerate: int, output_path: str, isTemp=True, profile:str|None=None) -> None:
+        """
+        Same result as imagesToVideo (each image shown for its duration, with a fade in and a fade out), for any number of images:
+        images are read one at a time through a single concat demuxer input and the filtergraph is written to a script file,
+        so memory use and the command line don't grow with the number of images.
+        Images should already have the same size (e.g. from ImageProcessing.resizeMany), others are scaled to the size of the first one.
+        They must all have the same format (extension): the concat demuxer decodes every entry with the codec of the first one.
+
+        Args:
+            images: List of image file paths.
+            durations: List of durations (seconds) for each image (same length as images).
+            fade_duration: Duration of fade in/out for each segment.
+            framerate: Output framerate.
+            output_path: Destination video file.
+            isTemp: If True, output_path will be tracked by the current workspace for later cleanup.
+            profile: Encoder profile (by default chosen from isTemp, see encoderProfile).
+        """
+        if len(images) != len(durations):
+            raise ValueError("images and durations must have same length")
+        if len(images) == 0:
+            raise ValueError("at least one image is needed")
+        if len({os.path.splitext(img)[1].lower() for img in images}) > 1:
+            raise ValueError("images must all have the same format, convert them first (e.g. with ImageProcessing.resizeMany)")
+
+        workspace = currentWorkspace()
+        listFile:str = workspace.path("txt", "slideshow", consumers=1)
+        scriptFile:str = workspace.path("txt", "slideshow-filter", consumers=1)
+
+        with open(listFile, "w") as f:
+            f.write("ffconcat version 1.0\n")
+            for img, dur in zip(images, durations):
+                f.write(f"file '{os.path.abspath(img)}'\nduration {dur}\n")
+            f.write(f"file '{os.path.abspath(images[-1])}'\n") #the concat demuxer ignores the duration of the last entry
+
+        # Each fade only applies during its own image (timeline "enable" option), so a fade out doesn't black out the following images
+        size:tuple[int,int] = ImageProcessing.imageSize(images[0])
+        filters:list[str] = [f"scale={size[0]}:{size[1]},setsar=1,fps={framerate},format=yuv420p"]
+        start:float = 0.0
+        for dur in durations:
+            filters.append(f"fade=t=in:st={start}:d={fade_duration}:enable='between(t,{start},{start+fade_duration})'")
+            filters.append(f"fade=t=out:st={start+dur-fade_duration}:d={fade_duration}:enable='between(t,{start+dur-fade_duration},{start+dur})'")
+            start += dur
+        with open(scriptFile, "w") as f:
+            f.write("[0:v]" + ",\n".join(filters) + "[bg]")
+
+        cmd = ["ffmpeg", "-v", "error",
+               "-f", "concat", "-safe", "0", "-i", listFile,
+               "-filter_complex_script", scriptFile,
+               "-map", "[bg]", "-t", str(sum(durations))]
+        cmd.extend(FFmpeg.pipeCodecArgs(output_path) or FFmpeg.encoderArgs(profile, isTemp))
+        cmd.append(output_path)
+
+        runFFmpeg(cmd, priority=outputPriority(isTemp))
+        workspace.consumed(listFile, scriptFile)
+
+        if isTemp:
+            currentWorkspace().track(output_path)
+
+    @staticmethod
+    @consumes("sourcePath")
+    def applyVideoEffect(sourcePath:str, endPath:str, filter:str, isTemp=True, windows:list[tuple[float,float]]|None=None, profile:str|None=None) -> None:
         """
         Apply given filter effect (in standard FFmpeg notation) to a given video.
+        If the effect only changes the video inside some time windows (list of (begin time, end time)), pass them as "windows":
+        only the GOPs they touch get re-encoded, see smartRender.
         """
-        subprocess.run([
+        if windows is not None:
+            FFmpeg.smartRender(sourcePath, endPath, filter, windows, isTemp, profile=profile)
+            return
+        runFFmpeg([
             "ffmpeg",
             "-v", "error",
             "-i", sourcePath,
             "-vf", filter,
             "-c:a", "copy",
+            *(FFmpeg.pipeCodecArgs(endPath) or FFmpeg.encoderArgs(profile, isTemp)),
             endPath
-        ], check=True)
+        ], priority=outputPriority(isTemp))
         if isTemp:
-            tempFiles.append(endPath)
+            currentWorkspace().track(endPath)
+
+    @staticmethod
+    def gopRanges(keyframes:array|list[float], duration:float, windows:list[tuple[float,float]]) -> list[tuple[float,float]]:
+        """
+        Expand the given time windows (inclusive, like between() in filters) to the GOPs they touch, merging the ones that overlap.
+        Ranges are half-open: they end on the first keyframe after the window, which isn't part of them, or at duration for the last GOP.
+        """
+        ranges:list[tuple[float,float]] = []
+        for begin, end in sorted(windows):
+            if end < begin or begin >= duration:
+                continue
+            begin = FFmpeg.getClosestKeyframe(keyframes, max(begin, 0), direction="down")
+            i:int = bisect.bisect_right(keyframes, end) #a frame exactly at the end of the window is still in it
+            end = keyframes[i] if i < len(keyframes) else duration
+            if len(ranges) > 0 and begin <= ranges[-1][1]:
+                ranges[-1] = (ranges[-1][0], max(ranges[-1][1], end))
+            else:
+                ranges.append((begin, end))
+        return ranges
+
+    @staticmethod
+    @consumes("sourcePath")
+    def smartRender(sourcePath:str, endPath:str, filter:str, windows:list[tuple[float,float]], isTemp=True, maxCoverage:float=0.6, profile:str|None=None) -> None:
+        """
+        Apply a video filter that only changes the frames inside the given time windows (list of (begin time, end time), in seconds
+        of the source), re-encoding only the GOPs the windows touch and stream-copying the rest of the video.
+        The filter sees the original timestamps, so expressions like "enable='between(t,10,12)'" or "fade=...:st=170" work unchanged.
+
+        Falls back to a normal full re-encode when the source isn't H.264, when endPath is a pipe, when the re-encoded GOPs
+        would cover more than maxCoverage of the video (splitting would cost more than it saves), or when the re-encoded GOPs
+        don't come out with the source's codec parameters (see matchingEncoderArgs), which would break decoders at the joins;
+        profile is only used by the full re-encode. When no window touches the video, it's copied as it is.
+        """
+        workspace = currentWorkspace()
+        info:MediaInfo = FFmpeg.probe(sourcePath)
+        if info.duration is not None and not FFmpeg.isPipe(endPath) and not any(end >= begin and end >= 0 and begin < info.duration for begin, end in windows):
+            runFFmpeg(["ffmpeg", "-v", "error", "-i", sourcePath, "-map", "0", "-c", "copy", "-y", endPath], background=False, priority=outputPriority(isTemp)) #the filter changes nothing
+            if isTemp:
+                workspace.track(endPath)
+            return
+        ranges:list[tuple[float,float]] = []
+        if info.videoCodec == "h264" and info.duration is not None and not FFmpeg.isPipe(endPath):
+            ranges = FFmpeg.gopRanges(FFmpeg.getKeyframes(sourcePath), info.duration, windows)
+        if len(ranges) == 0 or sum(end-begin for begin, end in ranges) > maxCoverage*info.duration:
+            FFmpeg.applyVideoEffect(sourcePath, endPath, filter, isTemp, profile=profile)
+            return
+
+        # Alternate stream-copied and re-encoded segments, all cut on keyframes
+        segments:list[tuple[float,float,bool]] = []
+        position:float = 0.0
+        for begin, end in ranges:
+            if begin > position:
+                segments.append((position, begin, False))
+            segments.append((begin, end, True))
+            position = end
+        if position < info.duration:
+            segments.append((position, info.duration, False))
+
+        segmentPaths:list[str] = []
+        encodedPaths:list[str] = []
+        for i, (begin, end, reencode) in enumerate(segments):
+            segmentPath:str = workspace.path("mp4", f"smart-{i}", consumers=1)
+            cmd:list[str] = ["ffmpeg", "-v", "error", "-ss", str(begin), "-to", str(end), "-i", sourcePath]
+            if reencode:
+                # Shift timestamps back to the source's timeline for the filter, then restart from 0 like the copied segments;
+                # the encoder matches the source so the segments can be joined with stream copy
+                cmd.extend(["-vf", f"setpts=PTS+{begin}/TB,{filter},setpts=PTS-STARTPTS",
+                            *FFmpeg.matchingEncoderArgs(info),
+                            "-c:a", "copy"])
+                encodedPaths.append(segmentPath)
+            else:
+                cmd.extend(["-c", "copy"])
+            cmd.append(segmentPath)
+            runFFmpeg(cmd, background=False, priority=outputPriority(isTemp))
+            segmentPaths.append(segmentPath)
+
+        if activePlan.get() is None and any(not FFmpeg.sameEncoding(info, FFmpeg.probe(p)) for p in encodedPaths): #planned outputs have no codec parameters to compare
+            print("WARNING: smart render couldn't match the source's codec parameters, re-encoding the whole video.")
+            workspace.consumed(*segmentPaths)
+            FFmpeg.applyVideoEffect(sourcePath, endPath, filter, isTemp, profile=profile)
+            return
+        FFmpeg.concatenate(segmentPaths, endPath, reencode=False, isTemp=isTemp)
+        workspace.consumed(*segmentPaths)
+
+    @staticmethod
+    def matchingEncoderArgs(info:MediaInfo) -> list[str]:
+        """
+        libx264 output options reproducing the codec parameters of an H.264 source (profile, level, pixel format, reference frames,
+        B-frames, entropy coding and timescale), so segments encoded with them can be stream-copy concatenated with the source's.
+        """
+        profile:str = (info.videoProfile or "high").lower()
+        args:list[str] = ["-c:v", "libx264", "-pix_fmt", info.pixelFormat or "yuv420p"]
+        x264:list[str] = ["cabac=0" if "baseline" in profile else "cabac=1"] #ffprobe can't see it, but x264 only turns CABAC off for baseline
+        if profile in FFmpeg.x264Profiles:
+            args.extend(["-profile:v", FFmpeg.x264Profiles[profile]])
+        if info.level is not None and info.level > 0:
+            args.extend(["-level", f"{info.level/10:g}"])
+        if info.refs is not None:
+            x264.append(f"ref={info.refs}")
+        if info.bFrames == 0:
+            x264.append("bframes=0")
+        args.extend(["-x264-params", ":".join(x264)])
+        if info.timeBase is not None and "/" in info.timeBase:
+            args.extend(["-video_track_timescale", info.timeBase.split("/")[1]])
+        return args
+
+    x264Profiles:dict[str,str] = {"constrained baseline":"baseline", "baseline":"baseline", "main":"main", "high":"high", "high 10":"high10", "high 4:2:2":"high422", "high 4:4:4 predictive":"high444"}
+
+    @staticmethod
+    def sameEncoding(a:MediaInfo, b:MediaInfo) -> bool:
+        """Whether two H.264 streams have the codec parameters that must match to join them with stream copy (see matchingEncoderArgs)."""
+        return all(getattr(a, name) == getattr(b, name) for name in ("videoCodec", "width", "height", "pixelFormat", "videoProfile", "level", "refs", "bFrames", "timeBase"))
 
     @staticmethod
-    def overlayImage(videoPath:str, imagePath:str, endPath:str, duration:tuple[float,float]=(0,0.1), position:tuple[int,int]=(0,0), scale:float=1, center=False, isTemp=True): #duration=(begin time, end time) | position=(x,y) | scale changes the image size keeping it in proportion | if center=True the image will be centered in the video | isTemp=True will add the path to tempFiles, deleting it when clearTemp is called
+    @consumes("videoPath", "imagePath")
+    def overlayImage(videoPath:str, imagePath:str, endPath:str, duration:tuple[float,float]=(0,0.1), position:tuple[int,int]=(0,0), scale:float=1, center=False, isTemp=True, profile:str|None=None): #duration=(begin time, end time) | position=(x,y) | scale changes the image size keeping it in proportion | if center=True the image will be centered in the video | isTemp=True will track the path in the current workspace, deleting it when the workspace is cleared
         #cut video into parts to apply the overlay only on the interested one, makes processing quicker
         videoDuration:float = FFmpeg.getLength(videoPath)
         matchesVideo:bool = False
         concatList:list[str] = []
-        ovPath:str = f"{tempFolder}ovr_{random.randint(10000,99999)}.mp4"
+        workspace = currentWorkspace()
+        ovPath:str = workspace.path("mp4", "ovr", consumers=1)
         if duration[0] == 0 and duration[1] == videoDuration:
             matchesVideo = True
             vPath:str = videoPath
+            workspace.consumed(ovPath)
             ovPath = endPath
         elif duration[0] == 0:
-            after = f"{tempFolder}ovr-after_{random.randint(10000,99999)}.mp4"
-            vPath = f"{tempFolder}ovr-during_{random.randint(10000,99999)}.mp4"
+            after = workspace.path("mp4", "ovr-after", consumers=1)
+            vPath = workspace.path("mp4", "ovr-during", consumers=1)
             FFmpeg.cut(videoPath,0,duration[1],vPath,reencode=False,roundUpOrDown=(False,True))
             FFmpeg.cut(videoPath,duration[1],videoDuration,after,reencode=False,roundUpOrDown=(True,True))
             concatList = [ovPath,after]
         elif duration[1] == videoDuration:
-            before = f"{tempFolder}ovr-before_{random.randint(10000,99999)}.mp4"
-            vPath = f"{tempFolder}ovr-during_{random.randint(10000,99999)}.mp4"
+            before = workspace.path("mp4", "ovr-before", consumers=1)
+            vPath = workspace.path("mp4", "ovr-during", consumers=1)
             FFmpeg.cut(videoPath,0,duration[0],before,reencode=False,roundUpOrDown=(False,False))
             FFmpeg.cut(videoPath,duration[0],videoDuration,vPath,reencode=False,roundUpOrDown=(False,True))
             concatList = [before,ovPath]
         else:
-            before = f"{tempFolder}ovr-before_{random.randint(10000,99999)}.mp4"
-            vPath = f"{tempFolder}ovr-during_{random.randint(10000,99999)}.mp4"
-            after = f"{tempFolder}ovr-after_{random.randint(10000,99999)}.mp4"
+            before = workspace.path("mp4", "ovr-before", consumers=1)
+            vPath = workspace.path("mp4", "ovr-during", consumers=1)
+            after = workspace.path("mp4", "ovr-after", consumers=1)
             FFmpeg.cut(videoPath,0,duration[0],before,reencode=False,roundUpOrDown=(False,False))
             FFmpeg.cut(videoPath,duration[0],duration[1],vPath,reencode=False,roundUpOrDown=(False,True))
             FFmpeg.cut(videoPath,duration[1],videoDuration,after,reencode=False,roundUpOrDown=(True,True))
@@ -571,33 +1755,40 @@ class FFmpeg:
             posY = int((videoSize[1]-overlayY)/2)
         # Build the filter string dynamically
         filter_complex = f"[1:v] scale={overlayX}:{overlayY} [ovrl];[0:v][ovrl] overlay={posX}:{posY}:enable='between(t,{duration[0]},{duration[1]})'"
+        encoder:list[str] = FFmpeg.encoderArgs(profile, isTemp) #the overlaid part ends up in endPath as it is
+        if not matchesVideo:
+            info:MediaInfo = FFmpeg.probe(vPath)
+            if info.videoCodec == "h264":
+                encoder = FFmpeg.matchingEncoderArgs(info) #so it can be joined to the copied parts with stream copy (concatenate normalises them if it still doesn't match)
         # Assemble the FFmpeg command
-        subprocess.run([
+        runFFmpeg([
             "ffmpeg",
             "-v", "error",
             "-i", vPath,
             "-i", imagePath,
             "-filter_complex", filter_complex,
             "-c:a", "copy",
+            *encoder,
             ovPath
-        ], check=True)
-
-        tempFiles.append(ovPath)
+        ], background=matchesVideo, priority=outputPriority(isTemp))
 
         if not matchesVideo:
-            FFmpeg.concatenate(concatList,endPath,isTemp)
+            workspace.consumed(vPath)
+            FFmpeg.concatenate(concatList,endPath,reencode=True,isTemp=isTemp,profile=profile)
+            workspace.consumed(*concatList)
 
-        if isTemp and (not endPath in tempFiles):
-            tempFiles.append(endPath)
+        if isTemp:
+            currentWorkspace().track(endPath)
 
     @staticmethod
-    def overlayVideo(backgroundVideo:str, foregroundVideo:str, endPath:str, chromakey:str = "&HFF00FF00", similarity:float=0.1, blend:float=0.1, isTemp=True) -> None:
+    @consumes("backgroundVideo", "foregroundVideo")
+    def overlayVideo(backgroundVideo:str, foregroundVideo:str, endPath:str, chromakey:str = "&HFF00FF00", similarity:float=0.1, blend:float=0.1, isTemp=True, profile:str|None=None) -> None:
         """
         Overlays a 'foregroundVideo' onto a 'backgroundVideo', saving the final result to 'endPath'.
         Will apply a chroma-key filter with the color 'chromakey' (in BGR) and apply parameters 'similarity' and 'blend' to better specify the interested area.
         """
         filter:str = f"[1:v]chromakey=color={FFmpeg.bgrToHex(chromakey)}:similarity={similarity}:blend={blend}[ckout];[0:v][ckout]overlay[out]"
-        subprocess.run([
+        runFFmpeg([
             "ffmpeg",
             "-v", "error",
             "-i", backgroundVideo,
@@ -606,33 +1797,17 @@ class FFmpeg:
             "-map", "[out]",
             "-map", "0:a?", #?=makes audio optional
             "-c:a", "copy",
+            *(FFmpeg.pipeCodecArgs(endPath) or FFmpeg.encoderArgs(profile, isTemp)),
             endPath
-        ], check=True)
+        ], priority=outputPriority(isTemp))
 
-        if isTemp and (not endPath in tempFiles):
-            tempFiles.append(endPath)
+        if isTemp:
+            currentWorkspace().track(endPath)
 
     @staticmethod
-    def addText(videoPath:str, text:str, duration:tuple[float,float], endPath:str, position:tuple[int,int]|int = (0,0), margin:int = 0,  font:str="Arial", fontSize:int=16, color:str = "&HFF000000", isTemp=True) -> None:
+    def drawtextFilter(text:str, duration:tuple[float,float], position:tuple[int,int]|int = (0,0), margin:int = 0, font:str="Arial", fontSize:int=16, color:str = "&HFF000000") -> str:
         """
-        Add text to a video.
-
-        Parameter "position" can either be a tuple[int,int] containing X and Y coordinates or can be one of the following ints:
-        - '1' for top left
-        - '2' for top center      Visualization: +-------------+
-        - '3' for top right                      | 1    2    3 |
-        - '4' for middle left                    | 4    5    6 |
-        - '5' for middle center                  | 7    8    9 |
-        - '6' for middle right                   +-------------+
-        - '7' for bottom left
-        - '8' for bottom center
-        - '9' for bottom right
-
-        Parameter "margin" (int, representing pixels) is only used when position isn't tuple[int,int]. It defines an offset from borders.
-
-        Parameter "duration" is tuple[float,float] of (begin time, end time)
-
-        Parameter "color" is in BGR, formatted &HAABBGGRR, &H=hex, AA=alpha(FF is opaque)
+        Build the drawtext filter used by addText (see addText for the meaning of each parameter).
         """
         coordsExpression:tuple[str,str] = ("0", "0")
         if type(position) == int:
@@ -670,31 +1845,309 @@ class FFmpeg:
 
         escapedText = text.replace("'", "'\"'\"'")
 
-        subprocess.run([
+        return f"drawtext=fontfile='{fontFile}':text='{escapedText}':x={coordsExpression[0]}:y={coordsExpression[1]}:fontsize={fontSize}:fontcolor={FFmpeg.bgrToHex(color)}:enable='between(t,{duration[0]},{duration[1]})'"
+
+    @staticmethod
+    @consumes("videoPath")
+    def addText(videoPath:str, text:str, duration:tuple[float,float], endPath:str, position:tuple[int,int]|int = (0,0), margin:int = 0,  font:str="Arial", fontSize:int=16, color:str = "&HFF000000", isTemp=True, smart:bool=False, profile:str|None=None) -> None:
+        """
+        Add text to a video.
+
+        Parameter "position" can either be a tuple[int,int] containing X and Y coordinates or can be one of the following ints:
+        - '1' for top left
+        - '2' for top center      Visualization: +-------------+
+        - '3' for top right                      | 1    2    3 |
+        - '4' for middle left                    | 4    5    6 |
+        - '5' for middle center                  | 7    8    9 |
+        - '6' for middle right                   +-------------+
+        - '7' for bottom left
+        - '8' for bottom center
+        - '9' for bottom right
+
+        Parameter "margin" (int, representing pixels) is only used when position isn't tuple[int,int]. It defines an offset from borders.
+
+        Parameter "duration" is tuple[float,float] of (begin time, end time)
+
+        Parameter "color" is in BGR, formatted &HAABBGGRR, &H=hex, AA=alpha(FF is opaque)
+
+        If smart=True, only the GOPs overlapping "duration" get re-encoded (see smartRender).
+        """
+        if smart:
+            FFmpeg.smartRender(videoPath, endPath, FFmpeg.drawtextFilter(text, duration, position, margin, font, fontSize, color), [duration], isTemp, profile=profile)
+            return
+        runFFmpeg([
             "ffmpeg",
             "-v", "error",
             "-i", videoPath,
-            "-vf", f"drawtext=fontfile='{fontFile}':text='{escapedText}':x={coordsExpression[0]}:y={coordsExpression[1]}:fontsize={fontSize}:fontcolor={FFmpeg.bgrToHex(color)}:enable='between(t,{duration[0]},{duration[1]})'",
+            "-vf", FFmpeg.drawtextFilter(text, duration, position, margin, font, fontSize, color),
             "-c:a", "copy",
+            *(FFmpeg.pipeCodecArgs(endPath) or FFmpeg.encoderArgs(profile, isTemp)),
             endPath
-        ], check=True) 
+        ], priority=outputPriority(isTemp))
 
         if isTemp:
-            tempFiles.append(endPath)
+            currentWorkspace().track(endPath)
+
+    @staticmethod
+    def subtitlesFilter(videoSize:tuple[int,int], subtitlesPath:str, theme:Theme, offset:float=0) -> str:
+        """
+        Convert the given SRT file to a themed ASS file (marked as temporary) and return the subtitles filter that burns it in.
+        While planning, the ASS file isn't written: only the filter is needed, and the SRT file might not exist yet.
+        """
+        assFile = currentWorkspace().path("ass", "subtitles")
+        if activePlan.get() is None:
+            FFmpeg.srtToAss(videoSize,subtitlesPath,assFile,theme.font,theme.fontSize,theme.color,theme.contourColor,theme.contourWidth,theme.alignment,offset)
+        return f"subtitles='{assFile}':fontsdir='{os.path.dirname(theme.font)}'"
 
     @staticmethod
-    def addSubtitles(videoPath:str, subtitlesPath:str, theme:Theme, endPath:str, offset:float=0, isTemp=True):
-        assFile = tempFolder + os.path.splitext(os.path.basename(subtitlesPath))[0] + ".ass" #obtain the file path for the ass subtitles file by concatenating tempFolder, the subtitlesPath file name (with no extension) and the extension ".ass"
-        FFmpeg.srtToAss(FFmpeg.getSize(videoPath),subtitlesPath,assFile,theme.font,theme.fontSize,theme.color,theme.contourColor,theme.contourWidth,theme.alignment,offset)
-        tempFiles.append(assFile)
-        subprocess.run([
+    @consumes("videoPath")
+    def addSubtitles(videoPath:str, subtitlesPath:str, theme:Theme, endPath:str, offset:float=0, isTemp=True, smart:bool=False, profile:str|None=None):
+        """
+        Burn the given SRT subtitles into a video, themed with theme and delayed by offset seconds.
+        If smart=True, only the GOPs where a subtitle is shown get re-encoded (see smartRender).
+        """
+        if smart:
+            FFmpeg.smartRender(videoPath, endPath, FFmpeg.subtitlesFilter(FFmpeg.getSize(videoPath), subtitlesPath, theme, offset), FFmpeg.srtWindows(subtitlesPath, offset), isTemp, profile=profile)
+            return
+        runFFmpeg([
             "ffmpeg",
             "-v", "error",
             "-i", videoPath, 
-            "-vf", f"subtitles='{assFile}':fontsdir='{os.path.dirname(theme.font)}'",
+            "-vf", FFmpeg.subtitlesFilter(FFmpeg.getSize(videoPath), subtitlesPath, theme, offset),
             "-c:a", "copy",
+            *(FFmpeg.pipeCodecArgs(endPath) or FFmpeg.encoderArgs(profile, isTemp)),
             endPath
-        ], check=True)
+        ], priority=outputPriority(isTemp))
+        if isTemp:
+            currentWorkspace().track(endPath)
+
+def asyncOperation(operation:Callable) -> Callable:
+    """Wrap a blocking operation in a coroutine function that runs it in a worker thread (which keeps the caller's workspace)."""
+    @functools.wraps(operation)
+    async def wrapper(*args, **kwargs):
+        return await asyncio.to_thread(operation, *args, **kwargs)
+    return wrapper
+
+class AsyncFFmpeg:
+    """
+    Async variants of the FFmpeg operations, with the same names and parameters:
+
+        await asyncio.gather(AsyncFFmpeg.addText(a, ...), AsyncFFmpeg.concatenate(paths, endPath))
+
+    Operations awaited together run in parallel, and the scheduler keeps the number of busy cores within the budget.
+    """
+for name in ("probe", "probeMany", "getLength", "getSize", "getFramerate", "getKeyframes", "normalise", "concatenate", "cut",
+             "addAudioToVideo", "imageToVideo", "imagesToVideo", "slideshow", "applyVideoEffect", "smartRender", "overlayImage", "overlayVideo",
+             "addText", "addSubtitles"):
+    setattr(AsyncFFmpeg, name, staticmethod(asyncOperation(getattr(FFmpeg, name))))
+
+class GraphInput:
+    """
+    Input file of a FFmpegGraph, together with the input options (e.g. ["-loop", "1"]) that should precede its "-i".
+    """
+    def __init__(self, path:str, options:list[str]|None=None):
+        self.path:str = path
+        self.options:list[str] = options if options is not None else []
+
+class GraphStream:
+    """
+    Single stream of a FFmpegGraph: either a stream of an input file (source != None) or the output of a filter applied to other streams.
+    mediaType is "v" for video and "a" for audio.
+    """
+    def __init__(self, mediaType:str, source:GraphInput|None=None, filter:str="", inputs:list["GraphStream"]|None=None):
+        self.mediaType:str = mediaType
+        self.source:GraphInput|None = source
+        self.filter:str = filter
+        self.inputs:list[GraphStream] = inputs if inputs is not None else []
+
+class MediaHandle:
+    """
+    Deferred media returned by FFmpegGraph operations: a video stream, an audio stream (either can be None) and what is known about them.
+    Nothing is computed until FFmpegGraph.render() is called on a handle.
+    """
+    def __init__(self, video:GraphStream|None, audio:GraphStream|None, sizeSource:str|None=None, size:tuple[int,int]|None=None, shortest:bool=False):
+        self.video:GraphStream|None = video
+        self.audio:GraphStream|None = audio
+        self.sizeSource:str|None = sizeSource #path of a file that has the same resolution as this handle's video, used to find its size lazily
+        self.size:tuple[int,int]|None = size
+        self.shortest:bool = shortest #whether the output should stop at the end of its shortest stream
+
+    def getSize(self) -> tuple[int,int]:
+        if self.size is None:
+            if self.sizeSource is None:
+                raise ValueError("Unable to determine the size of a handle with no size source.")
+            self.size = FFmpeg.getSize(self.sizeSource)
+        return self.size
+
+    def derive(self, video:GraphStream|None=None, audio:GraphStream|None=None) -> "MediaHandle":
+        """Returns a new handle with the given streams replaced, keeping everything else."""
+        return MediaHandle(video if video is not None else self.video,
+                           audio if audio is not None else self.audio,
+                           self.sizeSource, self.size, self.shortest)
+
+class FFmpegGraph:
+    """
+    Deferred counterpart of the FFmpeg class: operations are recorded on MediaHandles instead of being run one by one,
+    and render() compiles everything needed for the requested handle into a single '-filter_complex' invocation,
+    so the whole chain costs one decode and one encode and writes no intermediate files.
+
+    Example:
+        graph = FFmpegGraph()
+        video = graph.input(backgroundPath)
+        video = graph.overlayImage(video, imagePath, duration=(0, 3), center=True)
+        video = graph.addSubtitles(video, srtPath, theme)
+        graph.render(graph.addAudioToVideo(graph.input(audioPath), video), endPath)
+    """
+    def __init__(self):
+        self.labelNum:int = 0
+
+    def newLabel(self) -> str:
+        self.labelNum += 1
+        return f"g{self.labelNum}"
+
+    def input(self, path:str, options:list[str]|None=None, size:tuple[int,int]|None=None) -> MediaHandle:
+        """
+        Add an input file to the graph. Unused streams of the file (e.g. its audio when it gets replaced) are never read.
+        """
+        source = GraphInput(path, options)
+        return MediaHandle(GraphStream("v", source=source), GraphStream("a", source=source), sizeSource=path, size=size)
+
+    def cut(self, handle:MediaHandle, begin:float, end:float) -> MediaHandle:
+        """Frame-perfect cut of the handle between begin and end (seconds)."""
+        video = GraphStream("v", filter=f"trim=start={begin}:end={end},setpts=PTS-STARTPTS", inputs=[handle.video]) if handle.video is not None else None
+        audio = GraphStream("a", filter=f"atrim=start={begin}:end={end},asetpts=PTS-STARTPTS", inputs=[handle.audio]) if handle.audio is not None else None
+        return MediaHandle(video, audio, handle.sizeSource, handle.size, handle.shortest)
+
+    def applyVideoEffect(self, handle:MediaHandle, filter:str) -> MediaHandle:
+        """Apply given filter effect (in standard FFmpeg notation) to the handle's video."""
+        return handle.derive(video=GraphStream("v", filter=filter, inputs=[handle.video]))
+
+    def addText(self, handle:MediaHandle, text:str, duration:tuple[float,float], position:tuple[int,int]|int = (0,0), margin:int = 0, font:str="Arial", fontSize:int=16, color:str = "&HFF000000") -> MediaHandle:
+        """Deferred FFmpeg.addText, same parameters."""
+        return self.applyVideoEffect(handle, FFmpeg.drawtextFilter(text, duration, position, margin, font, fontSize, color))
+
+    def addSubtitles(self, handle:MediaHandle, subtitlesPath:str, theme:Theme, offset:float=0) -> MediaHandle:
+        """Deferred FFmpeg.addSubtitles, same parameters."""
+        return self.applyVideoEffect(handle, FFmpeg.subtitlesFilter(handle.getSize(), subtitlesPath, theme, offset))
+
+    def overlayImage(self, handle:MediaHandle, imagePath:str, duration:tuple[float,float]=(0,0.1), position:tuple[int,int]=(0,0), scale:float=1, center=False) -> MediaHandle:
+        """
+        Deferred FFmpeg.overlayImage, same parameters.
+        If center=True, position is used as an offset from the centered position.
+        """
+        image = self.input(imagePath)
+        scaled = GraphStream("v", filter=f"scale=iw*{scale}:ih*{scale}", inputs=[image.video])
+        posX:str = str(position[0])
+        posY:str = str(position[1])
+        if center:
+            posX = f"(main_w-overlay_w)/2+{position[0]}"
+            posY = f"(main_h-overlay_h)/2+{position[1]}"
+        overlay = GraphStream("v", filter=f"overlay={posX}:{posY}:enable='between(t,{duration[0]},{duration[1]})'", inputs=[handle.video, scaled])
+        return handle.derive(video=overlay)
+
+    def overlayVideo(self, background:MediaHandle, foreground:MediaHandle, chromakey:str = "&HFF00FF00", similarity:float=0.1, blend:float=0.1, shortest:bool=False) -> MediaHandle:
+        """
+        Deferred FFmpeg.overlayVideo, same parameters. The result keeps the background's audio.
+        shortest=True ends the result with the shortest of the two, needed when the foreground is looped endlessly (input option "-stream_loop -1").
+        """
+        keyed = GraphStream("v", filter=f"chromakey=color={FFmpeg.bgrToHex(chromakey)}:similarity={similarity}:blend={blend}", inputs=[foreground.video])
+        return background.derive(video=GraphStream("v", filter="overlay=shortest=1" if shortest else "overlay", inputs=[background.video, keyed]))
+
+    def addAudioToVideo(self, audio:MediaHandle, video:MediaHandle) -> MediaHandle:
+        """Deferred FFmpeg.addAudioToVideo: the result stops at the end of the shortest between video and audio."""
+        return MediaHandle(video.video, audio.audio, video.sizeSource, video.size, shortest=True)
+
+    def compile(self, handle:MediaHandle) -> list[str]:
+        """
+        Returns the FFmpeg arguments (inputs, filtergraph and mappings, without the output options) needed to produce the given handle.
+        Only the inputs and filters the handle actually depends on are included.
+        """
+        outputs:list[GraphStream] = [s for s in (handle.video, handle.audio) if s is not None]
+        if len(outputs) == 0:
+            raise ValueError("Nothing to render: the handle has neither video nor audio.")
+
+        #find every filter the outputs depend on (in dependency order) and how many times each one is consumed
+        ordered:list[GraphStream] = []
+        consumers:dict[int,int] = {}
+        visited:set[int] = set()
+        def visit(stream:GraphStream) -> None:
+            consumers[id(stream)] = consumers.get(id(stream), 0) + 1
+            if id(stream) in visited:
+                return
+            visited.add(id(stream))
+            for inp in stream.inputs:
+                visit(inp)
+            ordered.append(stream)
+        for stream in outputs:
+            visit(stream)
+
+        inputs:list[GraphInput] = []
+        for stream in ordered:
+            if stream.source is not None and stream.source not in inputs:
+                inputs.append(stream.source)
+
+        #assign labels, splitting filter outputs that are consumed more than once
+        pendingLabels:dict[int,list[str]] = {}
+        filters:list[str] = []
+        def take(stream:GraphStream) -> str:
+            if stream.source is not None:
+                return f"[{inputs.index(stream.source)}:{stream.mediaType}]"
+            return pendingLabels[id(stream)].pop(0)
+        for stream in ordered:
+            if stream.source is not None:
+                continue
+            label:str = self.newLabel()
+            filters.append("".join(take(inp) for inp in stream.inputs) + f"{stream.filter}[{label}]")
+            count:int = consumers[id(stream)]
+            if count > 1:
+                splits:list[str] = [self.newLabel() for _ in range(count)]
+                filters.append(f"[{label}]{'split' if stream.mediaType == 'v' else 'asplit'}={count}" + "".join(f"[{s}]" for s in splits))
+                pendingLabels[id(stream)] = [f"[{s}]" for s in splits]
+            else:
+                pendingLabels[id(stream)] = [f"[{label}]"]
+
+        args:list[str] = []
+        for inp in inputs:
+            args.extend(inp.options + ["-i", inp.path])
+        if len(filters) > 0:
+            args.extend(["-filter_complex", ";".join(filters)])
+        for stream in outputs:
+            label:str = take(stream)
+            if stream.source is not None:
+                label = label.strip("[]") + ("?" if stream.mediaType == "a" else "") #unfiltered input audio is optional, like in FFmpeg.overlayVideo
+            args.extend(["-map", label])
+        return args
+
+    def inputPaths(self, handle:MediaHandle) -> list[str]:
+        """Returns the paths of the input files the given handle depends on."""
+        paths:list[str] = []
+        pending:list[GraphStream] = [s for s in (handle.video, handle.audio) if s is not None]
+        while len(pending) > 0:
+            stream:GraphStream = pending.pop()
+            if stream.source is not None and stream.source.path not in paths:
+                paths.append(stream.source.path)
+            pending.extend(stream.inputs)
+        return paths
+
+    def render(self, handle:MediaHandle, endPath:str, isTemp=True, profile:str|None=None) -> None:
+        """
+        Run a single FFmpeg process producing the given handle at endPath, encoded with the given profile
+        (by default chosen from isTemp, see FFmpeg.encoderProfile).
+        """
+        cmd:list[str] = ["ffmpeg", "-v", "error"] + self.compile(handle)
+        if FFmpeg.isPipe(endPath):
+            cmd.extend(FFmpeg.pipeCodecArgs(endPath, audio=handle.audio is not None))
+        else:
+            cmd.extend(FFmpeg.encoderArgs(profile, isTemp, video=handle.video is not None, audio=handle.audio is not None))
+        if handle.shortest:
+            cmd.append("-shortest")
+        cmd.append(endPath)
+        runFFmpeg(cmd, priority=outputPriority(isTemp), operation="FFmpegGraph.render")
+
+        currentWorkspace().consumed(*self.inputPaths(handle))
         if isTemp:
-            tempFiles.append(endPath)
+            currentWorkspace().track(endPath)
 
+    async def renderAsync(self, handle:MediaHandle, endPath:str, isTemp=True, profile:str|None=None) -> None:
+        """Async render(): the FFmpeg process runs in a worker thread, so several graphs can be rendered at the same time."""
+        await asyncio.to_thread(self.render, handle, endPath, isTemp, profile)
@@ -0,0 +1,138 @@
+import os
+import json
+import platform
+import threading
+from fontTools.ttLib import TTFont
+from config import fontIndexFile
+
+fontExtensions:list[str] = ['.ttf', '.otf', '.ttc']
+
+def systemFontDirs() -> list[str]:
+    """Returns the folders where fonts are installed on this system."""
+    system = platform.system()
+    if system == "Windows":
+        return [
+            os.path.join(os.environ.get('WINDIR', 'C:\\Windows'), 'Fonts'),
+            os.path.join(os.environ.get('LOCALAPPDATA', ''), 'Microsoft', 'Windows', 'Fonts')
+        ]
+    elif system == "Darwin":  # macOS
+        return [
+            '/Library/Fonts/',
+            '/System/Library/Fonts/',
+            os.path.expanduser('~/Library/Fonts/')
+        ]
+    else:  # Linux and others
+        return [
+            '/usr/share/fonts/',
+            '/usr/local/share/fonts/',
+            os.path.expanduser('~/.fonts/'),
+            os.path.expanduser('~/.local/share/fonts/')
+        ]
+
+def readFamilyName(path:str) -> str|None:
+    """Returns the family name (name ID 1) of the given font file, or None if it can't be read. Only the name table is parsed."""
+    try:
+        font = TTFont(path, lazy=True, fontNumber=0) #fontNumber picks the first font of .ttc collections
+        try:
+            for record in font["name"].names:
+                if record.nameID == 1:  # Font Family name
+                    return record.toUnicode()
+        finally:
+            font.close()
+    except Exception:
+        pass
+    return None
+
+class FontIndex:
+    """
+    Index of the installed fonts, mapping family names and file names to paths, so that looking a font up by name
+    doesn't walk every font folder each time.
+
+    The index is built lazily on the first lookup and saved to disk together with the modification time of every folder it walked:
+    on later runs it's reused as long as no font folder changed (adding or removing a font updates its folder's modification time).
+    """
+    def __init__(self, indexPath:str, fontDirs:list[str]|None=None):
+        self.indexPath:str = indexPath
+        self.fontDirs:list[str] = fontDirs if fontDirs is not None else systemFontDirs()
+        self.fonts:list[tuple[str,str,str|None]]|None = None #(path, lowercase file stem, lowercase family name), in walk order
+        self.lock = threading.Lock()
+
+    def isValid(self, mtimes:dict[str,int]) -> bool:
+        """Whether folders saved with the index are unchanged, and no font folder appeared since."""
+        for fontDir in self.fontDirs:
+            if os.path.exists(fontDir) and fontDir not in mtimes:
+                return False
+        for folder, mtime in mtimes.items():
+            try:
+                if os.stat(folder).st_mtime_ns != mtime:
+                    return False
+            except OSError:
+                return False
+        return True
+
+    def build(self) -> tuple[list[tuple[str,str,str|None]], dict[str,int]]:
+        fonts:list[tuple[str,str,str|None]] = []
+        mtimes:dict[str,int] = {}
+        for fontDir in self.fontDirs:
+            if os.path.exists(fontDir):
+                for root, dirs, files in os.walk(fontDir):
+                    mtimes[root] = os.stat(root).st_mtime_ns
+                    for file in files:
+                        base_name, extension = os.path.splitext(file.lower())
+                        if extension in fontExtensions:
+                            path:str = os.path.join(root, file)
+                            family:str|None = readFamilyName(path)
+                            fonts.append((path, base_name, family.lower() if family is not None else None))
+        return fonts, mtimes
+
+    def load(self) -> list[tuple[str,str,str|None]]:
+        with self.lock:
+            if self.fonts is not None:
+                return self.fonts
+            try:
+                with open(self.indexPath, "r", encoding="utf-8") as f:
+                    saved:dict = json.load(f)
+                if saved["fontDirs"] == self.fontDirs and self.isValid(saved["mtimes"]):
+                    self.fonts = [tuple(font) for font in saved["fonts"]]
+                    return self.fonts
+            except (OSError, ValueError, KeyError):
+                pass
+            self.fonts, mtimes = self.build()
+            try:
+                os.makedirs(os.path.dirname(self.indexPath), exist_ok=True)
+                with open(self.indexPath, "w", encoding="utf-8") as f:
+                    json.dump({"fontDirs":self.fontDirs, "mtimes":mtimes, "fonts":self.fonts}, f)
+            except OSError:
+                print(f"WARNING: unable to save the font index to {self.indexPath}")
+            return self.fonts
+
+    def find(self, fontName:str, extensions:list[str]|None=None) -> str|None:
+        """
+        Returns the path of the font with the given name, looking for (in this order, case-insensitively):
+        a font with that family name, a font file with that name, a font file whose name contains it.
+        """
+        if extensions is None:
+            extensions = fontExtensions
+        name:str = fontName.lower()
+        fonts = [font for font in self.load() if any(font[0].lower().endswith(ext) for ext in extensions)]
+        for path, stem, family in fonts:
+            if family == name:
+                return path
+        for path, stem, family in fonts:
+            if stem == name:
+                return path
+        for path, stem, family in fonts:
+            if name in stem:
+                return path
+        return None
+
+    def clear(self) -> None:
+        """Forget the index (in memory and on disk), so that it gets rebuilt on the next lookup."""
+        with self.lock:
+            self.fonts = None
+            try:
+                os.remove(self.indexPath)
+            except OSError:
+                pass
+
+fontIndex:FontIndex = FontIndex(fontIndexFile)
@@ -0,0 +1,154 @@
+import os
+import json
+import time
+import atexit
+import sqlite3
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import Any, Callable
+from config import probeCacheFile, probeCacheMemorySize, tempFolder
+
+_MISS:object = object() #returned by ProbeCache.get to cached(), since None can be a cached value
+
+class ProbeCache:
+    """
+    Cache for media probe results (durations, sizes, keyframes...), shared by every module and persisted across restarts.
+
+    Entries are keyed by (absolute path, file size, modification time) plus a "kind" string naming the probed value,
+    so a file that gets modified or replaced is automatically probed again.
+    Lookups hit an in-memory LRU first, then the on-disk SQLite store.
+    Temporary files (see isTemporary) are only cached in memory, and writes to the store are committed in batches
+    (every commitEvery entries or commitInterval seconds, and at exit). prune() removes entries of deleted files.
+    """
+    def __init__(self, dbPath:str, memorySize:int=512, commitEvery:int=64, commitInterval:float=5.0):
+        self.dbPath:str = dbPath
+        self.memorySize:int = memorySize
+        self.memory:OrderedDict[tuple, Any] = OrderedDict()
+        self.lock = threading.Lock()
+        self.db:sqlite3.Connection|None = None #opened lazily, so that importing this library costs nothing
+        self.commitEvery:int = commitEvery
+        self.commitInterval:float = commitInterval
+        self.uncommitted:int = 0
+        self.firstUncommitted:float = 0.0
+        self.temporaryFolders:tuple[str,...] = tuple(os.path.join(os.path.abspath(folder), "") for folder in (tempFolder, "/dev/shm", tempfile.gettempdir()))
+
+    def connect(self) -> sqlite3.Connection:
+        if self.db is None:
+            os.makedirs(os.path.dirname(self.dbPath), exist_ok=True)
+            self.db = sqlite3.connect(self.dbPath, check_same_thread=False, timeout=30)
+            self.db.execute("PRAGMA journal_mode=WAL") #lets multiple Opifex processes read and write at the same time
+            self.db.execute("""CREATE TABLE IF NOT EXISTS probe (
+                path TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                mtime INTEGER NOT NULL,
+                kind TEXT NOT NULL,
+                value NOT NULL, --JSON text or raw bytes, depending on the kind
+                PRIMARY KEY (path, kind)
+            )""")
+            self.db.commit()
+        return self.db
+
+    @staticmethod
+    def fileKey(path:str) -> tuple[str,int,int]|None:
+        """Returns (absolute path, size, mtime in ns) for the given file, or None if it isn't a regular file (e.g. a pipe)."""
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        if not os.path.isfile(path):
+            return None
+        return (os.path.abspath(path), st.st_size, st.st_mtime_ns)
+
+    def isTemporary(self, absolutePath:str) -> bool:
+        """Whether the file is in a temporary folder (workspaces, RAM, system temp): it won't outlive the job, so it isn't worth storing."""
+        return absolutePath.startswith(self.temporaryFolders)
+
+    def get(self, path:str, kind:str, decode:Callable[[Any], Any]=json.loads, default:Any=None) -> Any:
+        """
+        Returns the cached value for the given file and kind, or default if it isn't cached (or the file changed).
+        decode converts the stored value (str or bytes) back to the cached object and must match the encode used by put().
+        """
+        key = self.fileKey(path)
+        if key is None:
+            return default
+        with self.lock:
+            if key + (kind,) in self.memory:
+                self.memory.move_to_end(key + (kind,))
+                return self.memory[key + (kind,)]
+            if self.isTemporary(key[0]):
+                return default
+            row = self.connect().execute("SELECT size, mtime, value FROM probe WHERE path=? AND kind=?", (key[0], kind)).fetchone()
+        if row is None or row[0] != key[1] or row[1] != key[2]:
+            return default
+        value = decode(row[2])
+        self.remember(key + (kind,), value)
+        return value
+
+    def put(self, path:str, kind:str, value:Any, encode:Callable[[Any], str|bytes]=json.dumps) -> None:
+        """
+        Stores the value for the given file and kind. By default values must be JSON serializable,
+        otherwise encode must convert them to str or bytes (e.g. array.tobytes for compact numeric data).
+        """
+        key = self.fileKey(path)
+        if key is None:
+            return
+        if not self.isTemporary(key[0]):
+            with self.lock:
+                db = self.connect()
+                db.execute("INSERT OR REPLACE INTO probe (path, size, mtime, kind, value) VALUES (?, ?, ?, ?, ?)", (key[0], key[1], key[2], kind, encode(value)))
+                if self.uncommitted == 0:
+                    self.firstUncommitted = time.monotonic()
+                self.uncommitted += 1
+                if self.uncommitted >= self.commitEvery or time.monotonic()-self.firstUncommitted >= self.commitInterval:
+                    self.commitLocked()
+        self.remember(key + (kind,), value)
+
+    def commitLocked(self) -> None:
+        if self.db is not None and self.uncommitted > 0:
+            self.db.commit()
+        self.uncommitted = 0
+
+    def flush(self) -> None:
+        """Commit the pending writes to the store."""
+        with self.lock:
+            self.commitLocked()
+
+    def remember(self, key:tuple, value:Any) -> None:
+        with self.lock:
+            self.memory[key] = value
+            self.memory.move_to_end(key)
+            while len(self.memory) > self.memorySize:
+                self.memory.popitem(last=False)
+
+    def cached(self, path:str, kind:str, compute:Callable[[], Any], encode:Callable[[Any], str|bytes]=json.dumps, decode:Callable[[Any], Any]=json.loads) -> Any:
+        """Returns the cached value for the given file and kind, computing (and storing) it with compute() if needed."""
+        value = self.get(path, kind, decode, _MISS)
+        if value is _MISS:
+            value = compute()
+            self.put(path, kind, value, encode)
+        return value
+
+    def prune(self) -> int:
+        """Delete the stored entries of files that don't exist anymore (and of temporary files stored by older versions). Returns how many files were forgotten."""
+        if not os.path.isfile(self.dbPath):
+            return 0
+        with self.lock:
+            db = self.connect()
+            paths:list[str] = [row[0] for row in db.execute("SELECT DISTINCT path FROM probe")]
+        gone:list[tuple[str]] = [(path,) for path in paths if self.isTemporary(path) or not os.path.isfile(path)]
+        with self.lock:
+            db.executemany("DELETE FROM probe WHERE path=?", gone)
+            db.commit() #also commits the pending writes
+            self.uncommitted = 0
+        return len(gone)
+
+    def clear(self) -> None:
+        with self.lock:
+            self.memory.clear()
+            self.connect().execute("DELETE FROM probe")
+            self.db.commit()
+            self.uncommitted = 0
+
+probeCache:ProbeCache = ProbeCache(probeCacheFile, probeCacheMemorySize)
+atexit.register(probeCache.flush)
@@ -0,0 +1,254 @@
+import os
+import shutil
+import tempfile
+import itertools
+import threading
+import functools
+import inspect
+import json
+import contextvars
+import contextlib
+from typing import Callable
+from config import tempFolder, workspaceUseRam, workspaceRamMinFree
+
+ramFolder:str = "/dev/shm/"
+workspacePrefix:str = "opifex_" #workspace folders are named opifex_[PID]_[NAME]_[RANDOM], so stale ones can be recognised
+
+class Workspace:
+    """
+    Scoped folder for the temporary files of a single job.
+
+    Paths given out by path() never collide, even between jobs running at the same time (in the same process or not),
+    and every tracked file is deleted when the workspace is cleaned up. Files can also be given a number of consumers:
+    each consumed() call (done automatically by FFmpeg operations reading the file) decrements it, and the file is deleted
+    as soon as its last consumer has run, keeping peak disk usage low.
+
+    Use it as a context manager: inside the "with" block it becomes the current workspace (see currentWorkspace()),
+    which is where FFmpeg operations and modules put their intermediate files.
+
+        with Workspace("video") as ws:
+            audio = ws.path("wav", "audio", consumers=1)
+    """
+    def __init__(self, name:str="job", useRam:bool=workspaceUseRam, dir:str|None=None):
+        """
+        Parameters:
+        - name: short name of the job, used in the folder name
+        - useRam: put the workspace on /dev/shm (RAM) when it has at least config.workspaceRamMinFree bytes free
+        - dir: use this existing folder instead of creating a new one (the folder itself is never deleted)
+        """
+        self.owned:bool = dir is None
+        if dir is None:
+            base:str = tempFolder
+            if useRam and os.path.isdir(ramFolder) and shutil.disk_usage(ramFolder).free >= workspaceRamMinFree:
+                base = ramFolder
+            os.makedirs(base, exist_ok=True)
+            dir = tempfile.mkdtemp(prefix=f"{workspacePrefix}{os.getpid()}_{name}_", dir=base)
+        self.dir:str = os.path.join(dir, "")
+        self.files:list[str] = [] #tracked files, deleted on clear()
+        self.consumers:dict[str,int] = {} #remaining consumers of reference-counted files
+        self.counter = itertools.count()
+        self.lock = threading.Lock()
+        self.tokens:list[contextvars.Token] = []
+        self.stats:dict[str,dict[str,float]] = {} #operation name -> {"runs", "wall", "cpu"}, see record()
+
+    def __enter__(self) -> "Workspace":
+        self.tokens.append(activeWorkspace.set(self))
+        return self
+
+    def __exit__(self, excType, excValue, traceback) -> None:
+        activeWorkspace.reset(self.tokens.pop())
+        self.cleanup()
+
+    def path(self, extension:str, prefix:str="tmp", consumers:int=0) -> str:
+        """
+        Returns a new, collision-free path inside the workspace and tracks it.
+        If consumers > 0 the file gets deleted after that many consumed() calls, otherwise it's kept until clear().
+        """
+        path:str = f"{self.dir}{prefix}_{next(self.counter)}.{extension}"
+        self.track(path, consumers)
+        return path
+
+    def track(self, path:str, consumers:int=0) -> None:
+        """
+        Track an existing (or future) file, even outside the workspace folder, so that it gets deleted on clear().
+        consumers works like in path(), and adds up if the file is already tracked.
+        """
+        with self.lock:
+            if path not in self.files:
+                self.files.append(path)
+            if consumers > 0:
+                self.consumers[path] = self.consumers.get(path, 0) + consumers
+
+    def consumed(self, *paths:str) -> None:
+        """
+        Signal that a consumer of each of the given files has run. Reference-counted files are deleted when no consumers are left,
+        other paths are ignored.
+        """
+        held:list|None = heldConsumption.get()
+        if held is not None:
+            held.append((self, paths))
+            return
+        for path in paths:
+            with self.lock:
+                if path not in self.consumers:
+                    continue
+                self.consumers[path] -= 1
+                if self.consumers[path] > 0:
+                    continue
+                del self.consumers[path]
+                self.files.remove(path)
+            try:
+                os.remove(path)
+            except FileNotFoundError: #never written, e.g. planned by FFmpeg.planning()
+                pass
+            except OSError:
+                print(f"WARNING: unable to delete temporary file {path}")
+
+    def record(self, operation:str, wall:float, cpu:float) -> None:
+        """Add a process run by the given operation, with its wall and CPU (user+system) time in seconds, to the job's totals."""
+        with self.lock:
+            totals:dict[str,float] = self.stats.setdefault(operation, {"runs":0, "wall":0.0, "cpu":0.0})
+            totals["runs"] += 1
+            totals["wall"] += wall
+            totals["cpu"] += cpu
+
+    def statsReport(self) -> str:
+        """Returns a table of the per-operation totals, slowest first."""
+        with self.lock:
+            rows = sorted(self.stats.items(), key=lambda item: item[1]["wall"], reverse=True)
+        lines:list[str] = [f"{'OPERATION':<28}{'RUNS':>6}{'WALL (s)':>11}{'CPU (s)':>11}"]
+        for operation, totals in rows:
+            lines.append(f"{operation:<28}{int(totals['runs']):>6}{totals['wall']:>11.2f}{totals['cpu']:>11.2f}")
+        return "\n".join(lines)
+
+    def dumpStats(self, path:str) -> None:
+        """Write the per-operation totals to the given path as JSON."""
+        with self.lock:
+            stats:dict = {operation:dict(totals) for operation, totals in self.stats.items()}
+        with open(path, "w") as f:
+            json.dump(stats, f, indent=4)
+
+    def clear(self) -> None:
+        """Delete all tracked files."""
+        with self.lock:
+            files:list[str] = self.files.copy()
+            self.files.clear()
+            self.consumers.clear()
+        for file in files:
+            try:
+                os.remove(file)
+            except FileNotFoundError:
+                pass
+            except OSError:
+                print(f"WARNING: unable to delete temporary file {file}")
+
+    def cleanup(self) -> None:
+        """Delete all tracked files and, if the workspace created its own folder, the folder with anything left in it."""
+        self.clear()
+        if self.owned:
+            shutil.rmtree(self.dir, ignore_errors=True)
+
+activeWorkspace:contextvars.ContextVar[Workspace|None] = contextvars.ContextVar("activeWorkspace", default=None)
+defaultWorkspace:Workspace|None = None
+defaultWorkspaceLock = threading.Lock()
+
+def currentWorkspace() -> Workspace:
+    """
+    Returns the workspace of the job running in the current thread/task, or the process-wide default workspace
+    (the temporary folder itself, cleared only explicitly) when no job workspace is active.
+    """
+    global defaultWorkspace
+    ws:Workspace|None = activeWorkspace.get()
+    if ws is not None:
+        return ws
+    with defaultWorkspaceLock:
+        if defaultWorkspace is None:
+            os.makedirs(tempFolder, exist_ok=True)
+            defaultWorkspace = Workspace("default", dir=tempFolder)
+        return defaultWorkspace
+
+heldConsumption:contextvars.ContextVar[list|None] = contextvars.ContextVar("heldConsumption", default=None)
+
+@contextlib.contextmanager
+def deferConsumption():
+    """
+    Queue the consumed() calls made inside the block (in any workspace) and run them when it exits.
+    Used while background processes may still be reading the consumed files (see FFmpeg.streaming()).
+    """
+    held:list[tuple[Workspace,tuple[str,...]]] = []
+    token = heldConsumption.set(held)
+    try:
+        yield
+    finally:
+        heldConsumption.reset(token)
+        for workspace, paths in held:
+            workspace.consumed(*paths)
+
+operationDepth:contextvars.ContextVar[int] = contextvars.ContextVar("operationDepth", default=0)
+currentOperation:contextvars.ContextVar[str|None] = contextvars.ContextVar("currentOperation", default=None) #outermost running operation, used to name process stats
+
+def consumes(*argNames:str) -> Callable:
+    """
+    Decorator for operations that read files: once the decorated function returns successfully, the files passed in the
+    named arguments (str or list of str) are marked as consumed in the current workspace.
+    Operations called by other decorated operations don't consume anything, so the outer one only counts once.
+    The outermost operation is also set as currentOperation while it runs.
+    """
+    def decorator(function:Callable) -> Callable:
+        signature = inspect.signature(function)
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            outermost:bool = operationDepth.get() == 0
+            token = operationDepth.set(operationDepth.get() + 1)
+            nameToken = currentOperation.set(function.__qualname__) if outermost else None
+            try:
+                result = function(*args, **kwargs)
+            finally:
+                if nameToken is not None:
+                    currentOperation.reset(nameToken)
+                operationDepth.reset(token)
+            if operationDepth.get() == 0:
+                arguments = signature.bind(*args, **kwargs).arguments
+                paths:list[str] = []
+                for name in argNames:
+                    value = arguments.get(name)
+                    if isinstance(value, str):
+                        paths.append(value)
+                    elif isinstance(value, list):
+                        paths.extend(value)
+                currentWorkspace().consumed(*paths)
+            return result
+        return wrapper
+    return decorator
+
+def isAlive(pid:int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+def clearStale(dir:str=tempFolder) -> None:
+    """
+    Empty the given temporary folder (and remove stale workspaces from /dev/shm), keeping the workspaces of running processes.
+    """
+    os.makedirs(dir, exist_ok=True)
+    folders:list[tuple[str,bool]] = [(dir, True)] + ([(ramFolder, False)] if os.path.isdir(ramFolder) else [])
+    for folder, removeOther in folders:
+        for entry in os.listdir(folder):
+            path:str = os.path.join(folder, entry)
+            if entry.startswith(workspacePrefix):
+                pid:str = entry[len(workspacePrefix):].split("_")[0]
+                if pid.isdigit() and isAlive(int(pid)):
+                    continue
+            elif not removeOther:
+                continue
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
@@ -3,6 +3,9 @@ import shutil
 import basemodule
 import config
 import sys
+from lib.workspace import clearStale
+from lib.mediacache import probeCache
+from lib.assetcache import preconditionOnStartup
 from io import TextIOBase
 import modules
 from PySide6 import QtCore, QtWidgets, QtGui
@@ -13,8 +16,8 @@ VERSION = "0.1.9" #current version to show and use in the project, [MAIN].[MINOR
 AUTHORS = "prtp (Vprtp on GitHub)"
 
 def clearTemp(dir:str=config.tempFolder):
-    shutil.rmtree(dir)
-    os.mkdir(dir)
+    clearStale(dir) #workspaces of other running Opifex processes are kept
+    probeCache.prune() #forget probe results of deleted files
 
 def loadStylesheet(path: str) -> str:
     with open(path, "r", encoding="utf-8") as f:
@@ -394,6 +397,7 @@ class MainWindow(QtWidgets.QMainWindow):
 
 def main(mode:str, gui:bool):
     clearTemp()
+    preconditionOnStartup()
     match mode:
         case "single":
             if gui:
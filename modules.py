@@ -5,6 +5,7 @@ import sys
 import gc
 import inspect
 from main import VERSION
+from lib.ffmpeghandler import FFmpeg
 
 p = os.path.abspath(__file__).replace(os.path.basename(__file__),"")
 
@@ -123,8 +124,21 @@ def loadModules(dir:str = modulesDir, checkForDependencies:bool = True) -> None:
     modules.clear()
     modules.update(temp)
 
-def executeModule(name:str, **kwargs) -> ModuleResultType:
-    return modules[name].execute(VERSION,**kwargs)
+def executeModule(name:str, plan:bool=False, **kwargs) -> ModuleResultType:
+    """
+    Executes the given module with the given arguments.
+    If plan=True, FFmpeg commands are only planned (see FFmpeg.planning()): they're printed with a summary table
+    of the estimated encodes and bytes read and written instead of being run. Text to speech, alignment, screenshots,
+    recordings and image resizing are skipped too, so the result only contains placeholders.
+    """
+    if not plan:
+        return modules[name].execute(VERSION,**kwargs)
+    with FFmpeg.planning() as ffmpegPlan:
+        result:ModuleResultType = modules[name].execute(VERSION,**kwargs)
+    print(f"Planned FFmpeg commands of '{name}':")
+    print(ffmpegPlan.commandsReport())
+    print(ffmpegPlan.report())
+    return result
 
 if __name__ == "__main__":
     try:
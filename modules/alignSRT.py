@@ -4,6 +4,7 @@ import shutil
 import re
 from typing import List
 import config
+from lib.ffmpeghandler import activePlan
 from basemodule import BaseModule, ModuleResultType
 
 def generateSubtitles(audioPath: str, transcript: str, outputDir: str|Path, convertToSRT:bool = True) -> tuple[str,str]:
@@ -19,6 +20,10 @@ def generateSubtitles(audioPath: str, transcript: str, outputDir: str|Path, conv
     input_dir = Path(config.tempFolder)
     outputDir = Path(outputDir)
     
+    if activePlan.get() is not None: #dry run (see FFmpeg.planning()): MFA isn't run, only the paths are returned
+        stem = Path(audioPath).stem
+        return (outputDir / (stem + '.TextGrid'), outputDir / (stem + '.srt'))
+    
     input_dir.mkdir(exist_ok=True)
     outputDir.mkdir(exist_ok=True)
     
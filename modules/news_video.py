@@ -7,6 +7,8 @@ import screenshot
 import tts
 from basemodule import BaseModule, ModuleResultType
 from lib.ffmpeghandler import *
+from lib.workspace import Workspace, currentWorkspace
+from lib.assetcache import preconditioned
 import config
 
 class Article:
@@ -25,16 +27,13 @@ class Article:
         self.source:str = source
         self.publishTime:int = publishTime
 
-newsTempNum:int = 0
-def genTempPath(extension:str) -> str:
+def genTempPath(extension:str, consumers:int=0) -> str:
     """
-    Generates a file name for a temporary file with the following formatting:
-        [TEMPORARY DIRECTORY PATH]/news_[LAST 5 DIGITS OF CURRENT UNIX TIMESTAMP]-[NUMBER INCREASING FROM 0 FOR EACH CALL].[extension]
+    Generates a collision-free path for a temporary file in the current job's workspace (see lib/workspace), formatted as:
+        [WORKSPACE DIRECTORY PATH]/news_[NUMBER INCREASING FROM 0 FOR EACH CALL].[extension]
+    If consumers > 0, the file is deleted as soon as that many FFmpeg operations have read it.
     """
-    global newsTempNum
-    path:str = f"{config.tempFolder}news_{str(int(time.time()))[-5:]}-{newsTempNum}.{extension}"
-    newsTempNum += 1
-    return path 
+    return currentWorkspace().path(extension, "news", consumers)
 
 def generate(newsName:str, articles:list[Article], endPath:str, showTitle:bool=True, graphicModel:str=config.newsHtmlTemplate, titleBgVideo:str=config.newsTitleBackgroundVideo, titleBgAudio:str=config.newsTitleSong, titleTheme:config.Theme=config.newsTitleTheme, fadeEffect:str="fade=t=in:st=0:d={fadeDuration},fade=t=out:st={imgDurationMinusFadeDuration}:d={fadeDuration}") -> None:
     """
@@ -45,113 +44,106 @@ def generate(newsName:str, articles:list[Article], endPath:str, showTitle:bool=T
     - showTitle: whether or not to show the title you gave to your news broadcast
     - graphicModel
     """
-    print("NEWS VIDEO GENERATOR") 
-    #this will get changed to the title's background video size later if a title is generated
-    newsSize:tuple[int,int]=(1920,1080) 
-    newsFps:int = 30
-    seleniumExecutionAttempts:int = 3 #if selenium crashes, tries to reboot it this number of times. often it crashes for no reason so this might be useful. 
+    with Workspace("news") as workspace:
+        print("NEWS VIDEO GENERATOR") 
+        #this will get changed to the title's background video size later if a title is generated
+        newsSize:tuple[int,int]=(1920,1080) 
+        newsFps:int = 30
+        seleniumExecutionAttempts:int = 3 #if selenium crashes, tries to reboot it this number of times. often it crashes for no reason so this might be useful. 
 
-    print("Generating title video...")
-    #generate title
-    titlePath:str = genTempPath("mp4")
-    if showTitle:
-        titleNoAudio:str = genTempPath("mp4")
-        bgVideoDuration:float = FFmpeg.getLength(titleBgVideo)
-        bgVideoSize:tuple[int,int] = FFmpeg.getSize(titleBgVideo)
-        bgVideoFramerate:int = FFmpeg.getFramerate(titleBgVideo)
-        newsSize = bgVideoSize
-        newsFps = bgVideoFramerate
-        FFmpeg.addText(titleBgVideo,newsName,(0.0, bgVideoDuration), titleNoAudio, position=titleTheme.alignment, margin=int(bgVideoSize[0]/20), font=titleTheme.font, fontSize=titleTheme.fontSize, color=titleTheme.color)
-        FFmpeg.addAudioToVideo(titleBgAudio, titleNoAudio, titlePath)
+        print("Generating title video...")
+        #generate title
+        titlePath:str = genTempPath("mp4", consumers=1)
+        if showTitle:
+            titleBgVideo = preconditioned(titleBgVideo, "video")
+            titleBgAudio = preconditioned(titleBgAudio, "audio")
+            bgVideoInfo:MediaInfo = FFmpeg.probe(titleBgVideo)
+            bgVideoDuration:float = bgVideoInfo.duration
+            bgVideoSize:tuple[int,int] = bgVideoInfo.size
+            bgVideoFramerate:int = round(bgVideoInfo.fps)
+            newsSize = bgVideoSize
+            newsFps = bgVideoFramerate
+            graph = FFmpegGraph()
+            title:MediaHandle = graph.addText(graph.input(titleBgVideo, size=bgVideoSize), newsName, (0.0, bgVideoDuration), position=titleTheme.alignment, margin=int(bgVideoSize[0]/20), font=titleTheme.font, fontSize=titleTheme.fontSize, color=titleTheme.color)
+            graph.render(graph.addAudioToVideo(graph.input(titleBgAudio), title), titlePath, profile="final") #only stream-copied from here on
 
-    #generate individual article videos
-    articleTitles:list[str] = [art.title for art in articles]
-    articleVideoPaths:list[str] = []
-    artNum:int = 0
-    for article in articles:
-        artNum += 1
-        print(f"Generating video for article ({artNum}/{len(articles)}) '{article.title}'. This may take several minutes, please be patient...")
-        #generate tts
-        ttsPath:str = tts.generate(article.text)
-        ttsLenght:float = FFmpeg.getLength(ttsPath)
-        #get list of all article titles except for this one
-        otherArticles:list[str] = articleTitles.copy()
-        otherArticles.remove(article.title)
-        #generate the news overlay
-        print(f"({artNum}) Generating overlay...")
-        overlayPath:str = ""
-        for i in range(seleniumExecutionAttempts):
-            try:
-                overlayPath = record.process_html_to_video(graphicModel, 
-                                                           data={"article_time":time.strftime('%d/%m %H:%M', time.localtime(article.publishTime)),
-                                                                 "article_title":article.title,
-                                                                 "article_source":article.source,
-                                                                 "other_articles":" | ".join(otherArticles)},
-                                                           window_size=newsSize,
-                                                           duration=ttsLenght,
-                                                           fps=newsFps)
-                break
-            except SessionNotCreatedException:
-                print(f"Selenium failed at creating a session. Trying again, {seleniumExecutionAttempts-i} attempts left.")
-        
-        #if there's no image, provide a placeholder image
-        if len(article.images) == 0:
-            print(f"({artNum}) Generating a fallback image...")
-            a:str = ""
+        #generate individual article videos
+        articleTitles:list[str] = [art.title for art in articles]
+        articleVideoPaths:list[str] = []
+        articleFadeDuration:float = 1.0 #duration of the fade in/out effect applied to each article video
+        artNum:int = 0
+        for article in articles:
+            artNum += 1
+            print(f"Generating video for article ({artNum}/{len(articles)}) '{article.title}'. This may take several minutes, please be patient...")
+            #generate tts
+            ttsPath:str = tts.generate(article.text)
+            ttsLenght:float = FFmpeg.getLength(ttsPath)
+            #get list of all article titles except for this one
+            otherArticles:list[str] = articleTitles.copy()
+            otherArticles.remove(article.title)
+            #generate the news overlay
+            print(f"({artNum}) Generating overlay...")
+            overlayPath:str = ""
             for i in range(seleniumExecutionAttempts):
                 try:
-                    a = screenshot.process_html_to_image(config.noMediaHtmlTemplate, {"name":newsName, "message":"No image available."}, window_size=newsSize)
+                    overlayPath = record.process_html_to_video(graphicModel, 
+                                                               data={"article_time":time.strftime('%d/%m %H:%M', time.localtime(article.publishTime)),
+                                                                     "article_title":article.title,
+                                                                     "article_source":article.source,
+                                                                     "other_articles":" | ".join(otherArticles)},
+                                                               window_size=newsSize,
+                                                               duration=ttsLenght,
+                                                               fps=newsFps,
+                                                               loop=True) #a single period of the ticker is recorded, repeated by an ffconcat script
+                    currentWorkspace().track(overlayPath, consumers=1)
                     break
                 except SessionNotCreatedException:
                     print(f"Selenium failed at creating a session. Trying again, {seleniumExecutionAttempts-i} attempts left.")
- 
-            article.images.append(a)
-
-        #resize images
-        print(f"({artNum}) Resizing images...")
-        images:list[str] = []
-        for img in article.images:
-            imgOld:str = img
-            ext = imgOld.split(".")[-1]
-            img:str = genTempPath(ext)
-            ImageProcessing.resize(imgOld, img, newsSize, method="cut")
-            images.append(img)
+        
+            #if there's no image, provide a placeholder image
+            if len(article.images) == 0:
+                print(f"({artNum}) Generating a fallback image...")
+                a:str = screenshot.process_html_to_image(config.noMediaHtmlTemplate, {"name":newsName, "message":"No image available."}, window_size=newsSize) #the screenshot driver pool retries failed sessions itself
+                currentWorkspace().track(a, consumers=1)
+                article.images.append(a)
 
-        #generate video of background images
-        print(f"({artNum}) Generating background video...")
-        singularImageLenght:float = ttsLenght/len(images)
-        fadeDuration:float = 0.8
-        if singularImageLenght <= 8.0:
-            fadeDuration = singularImageLenght/10
-        bgVideo:str = genTempPath("mp4")
-        FFmpeg.imagesToVideo(images, [singularImageLenght]*len(images), fadeDuration, newsFps, bgVideo)
-        #overlay news to background and add audio
-        print(f"({artNum}) Finalizing this article...")
-        articlePathNoAudio:str = genTempPath("mp4")
-        FFmpeg.overlayVideo(bgVideo, overlayPath, articlePathNoAudio)
-        articlePath:str = genTempPath("mp4")
-        FFmpeg.addAudioToVideo(ttsPath, articlePathNoAudio, articlePath)
-        articleVideoPaths.append(articlePath)
+            #resize images
+            print(f"({artNum}) Resizing images...")
+            images:list[str] = [genTempPath("png", consumers=1) for img in article.images] #all in the same format, the slideshow's concat demuxer can't switch decoder between entries
+            ImageProcessing.resizeMany(article.images, images, newsSize, method="cut")
+            currentWorkspace().consumed(*article.images)
 
-    #apply fade effect to individual article videos
-    print("Applying effects...")
-    fadedArticleVideos:list[str] = [genTempPath("mp4") for _ in articleVideoPaths]
-    fadeDuration:float = 1.0
-    for i in range(len(articleVideoPaths)):
-        vidLenght:float = FFmpeg.getLength(articleVideoPaths[i])
-        effect:str = fadeEffect.format(imgDuration=vidLenght, fadeDuration=fadeDuration, imgDurationMinusFadeDuration=vidLenght-fadeDuration)
-        FFmpeg.applyVideoEffect(articleVideoPaths[i], fadedArticleVideos[i], effect)
+            #generate video of background images
+            print(f"({artNum}) Generating background video...")
+            singularImageLenght:float = ttsLenght/len(images)
+            fadeDuration:float = 0.8
+            if singularImageLenght <= 8.0:
+                fadeDuration = singularImageLenght/10
+            articlePath:str = genTempPath("mp4", consumers=1)
+            #the background slideshow is streamed straight into the final render of the article, both FFmpeg processes run at the same time
+            with FFmpeg.streaming() as stream:
+                bgVideo:str = stream.pipe("news")
+                FFmpeg.slideshow(images, [singularImageLenght]*len(images), fadeDuration, newsFps, bgVideo)
+                #overlay news to background, add audio and apply the fade effect in a single FFmpeg run
+                print(f"({artNum}) Finalizing this article...")
+                graph = FFmpegGraph()
+                articleVideo:MediaHandle = graph.overlayVideo(graph.input(bgVideo, size=newsSize), graph.input(overlayPath, options=["-f", "concat", "-safe", "0"]), shortest=True)
+                articleVideo = graph.addAudioToVideo(graph.input(ttsPath), articleVideo)
+                effect:str = fadeEffect.format(imgDuration=ttsLenght, fadeDuration=articleFadeDuration, imgDurationMinusFadeDuration=ttsLenght-articleFadeDuration)
+                articleVideo = graph.applyVideoEffect(articleVideo, effect)
+                graph.render(articleVideo, articlePath, profile="final") #only stream-copied from here on
+            articleVideoPaths.append(articlePath)
 
-    #concatenate everything
-    print("Concatenating...")
-    articlesFull = genTempPath("mp4")
-    FFmpeg.concatenate(fadedArticleVideos,articlesFull,reencode=True)
-    if showTitle:
-        FFmpeg.concatenate([titlePath, articlesFull], endPath, reencode=True, isTemp=False)
-    else:
-        shutil.copyfile(articlesFull,endPath)
-    print("Done!")
-    FFmpeg.clearTemp()
+        #concatenate everything
+        print("Concatenating...")
+        articlesFull = genTempPath("mp4", consumers=1)
+        FFmpeg.concatenate(articleVideoPaths,articlesFull,reencode=True,profile="final")
+        if showTitle:
+            FFmpeg.concatenate([titlePath, articlesFull], endPath, reencode=True, isTemp=False)
+        else:
+            shutil.copyfile(articlesFull,endPath)
+        print(workspace.statsReport())
+        print("Done!")
 
 class NewsVideoGenerator(BaseModule):
     def __init__(self):
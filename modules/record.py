@@ -1,28 +1,79 @@
 import os
 import time
+import math
+import select
+import functools
+import tempfile
+import atexit
+import threading
+import contextlib
 import subprocess
 from pathlib import Path
 from selenium import webdriver
 from selenium.webdriver.chrome.options import Options
+from selenium.webdriver.chrome.service import Service
+from selenium.webdriver.support.ui import WebDriverWait
+from selenium.common.exceptions import WebDriverException
 from basemodule import BaseModule, ModuleResultType
-import random
+import uuid
+import base64
+from lib.workspace import currentWorkspace
+from lib.ffmpeghandler import FFmpeg, FFmpegScheduler, MediaInfo, activePlan, feedFFmpeg, runFFmpeg, runFFprobe
 
-from screenshot import format_html_template
+from screenshot import format_html_template, driverPool
 
 import config
 
-tempFiles: list[str] = []
-tempFolder: str = config.tempFolder
-
-def clearTemp() -> None:
-    """Clean up temporary files created during execution."""
-    for file in tempFiles:
-        try:
-            os.remove(file)
-            print(f"Cleaned up temporary file: {file}")
-        except Exception as e:
-            print(f"WARNING: unable to delete temporary file {file}: {str(e)}")
-    tempFiles.clear()
+#Injected before any script of the recorded page runs: replaces the page's clocks (Date, performance.now, timers and
+#requestAnimationFrame) with a virtual one that only moves when window.__opifexClock.advanceTo(ms) is called.
+#CSS animations and transitions are paused and seeked to the virtual time, so every captured frame is exactly where it should be.
+virtualClockScript:str = """
+(() => {
+    if (window.__opifexClock) return;
+    const RealDate = Date;
+    const origin = RealDate.now();
+    let now = 0;
+    let nextId = 1;
+    const timers = new Map();
+    let frameCallbacks = new Map();
+    const births = new WeakMap();
+    window.Date = class extends RealDate {
+        constructor(...args) { if (args.length === 0) { super(origin + now); } else { super(...args); } }
+        static now() { return origin + now; }
+    };
+    performance.now = () => now;
+    window.setTimeout = (fn, delay = 0, ...args) => { const id = nextId++; timers.set(id, {time: now + Math.max(0, delay), fn, args, interval: null}); return id; };
+    window.setInterval = (fn, delay = 0, ...args) => { const id = nextId++; const step = Math.max(1, delay); timers.set(id, {time: now + step, fn, args, interval: step}); return id; };
+    window.clearTimeout = window.clearInterval = (id) => { timers.delete(id); };
+    window.requestAnimationFrame = (fn) => { const id = nextId++; frameCallbacks.set(id, fn); return id; };
+    window.cancelAnimationFrame = (id) => { frameCallbacks.delete(id); };
+    const call = (fn, args) => { try { if (typeof fn === "function") { fn(...args); } else { (0, eval)(fn); } } catch (e) { console.error(e); } };
+    window.__opifexClock = {
+        advanceTo(target) {
+            for (;;) {
+                let due = null;
+                for (const [id, timer] of timers) {
+                    if (timer.time <= target && (due === null || timer.time < due[1].time)) due = [id, timer];
+                }
+                if (due === null) break;
+                const [id, timer] = due;
+                now = Math.max(now, timer.time);
+                if (timer.interval === null) { timers.delete(id); } else { timer.time += timer.interval; }
+                call(timer.fn, timer.args);
+            }
+            now = Math.max(now, target);
+            const callbacks = frameCallbacks;
+            frameCallbacks = new Map();
+            for (const fn of callbacks.values()) call(fn, [now]);
+            for (const animation of document.getAnimations()) {
+                if (!births.has(animation)) births.set(animation, now);
+                animation.pause();
+                animation.currentTime = now - births.get(animation);
+            }
+        }
+    };
+})();
+"""
 
 def make_size_even(window_size:tuple[int,int]):
     w, h = window_size
@@ -32,143 +83,319 @@ def make_size_even(window_size:tuple[int,int]):
         h += 1
     return (w, h)
             
+@functools.cache
 def find_ffmpeg() -> str: #this is necessary because the conda build of ffmpeg doesn't include x11grab
     # First look for system ffmpeg that supports x11grab
     system_paths = ['/usr/bin/ffmpeg', '/usr/local/bin/ffmpeg']
     for path in system_paths:
         if os.path.exists(path):
             try:
-                # Quick check for x11grab support
-                result = subprocess.run([path, '-demuxers'], capture_output=True, text=True)
-                if 'x11grab' in result.stdout:
+                # Quick check for x11grab support, run as a probe by the FFmpeg scheduler
+                if 'x11grab' in runFFprobe([path, '-hide_banner', '-demuxers']):
                     return path
             except:
                 continue
     # Fallback to any ffmpeg in PATH (but may fail)
     return 'ffmpeg'
 
-def start_virtual_display(width, height) -> tuple[subprocess.Popen, str]:
-    int_display_num:int = 99
-    run:bool = True
-    while run:
-        run = False
-        if int_display_num < 0: raise RuntimeError("No free display found for Xvfb.")
-        display_num = f":{int_display_num}"
-        # Capture stderr so we can see why Xvfb might crash
+def start_virtual_display(width, height, timeout=10.0) -> tuple[subprocess.Popen, str]:
+    """
+    Start Xvfb on the first free display number with a screen of the given size. Xvfb picks the number itself and writes it
+    to a pipe (-displayfd) once it accepts connections, so there's nothing to poll or sleep for.
+    """
+    read_fd, write_fd = os.pipe()
+    # Xvfb's warnings go to an anonymous file, not a pipe: nobody reads a pooled display's output, and a full pipe would block it.
+    # The file is kept to see why Xvfb might crash while starting
+    log = tempfile.TemporaryFile()
+    try:
         xvfb = subprocess.Popen(
-            ["Xvfb", display_num, "-screen", "0", f"{width}x{height}x24", "-ac"],
-            stderr=subprocess.PIPE,
-            stdout=subprocess.DEVNULL
+            ["Xvfb", "-displayfd", str(write_fd), "-screen", "0", f"{width}x{height}x24", "-ac", "-nolisten", "tcp"],
+            stderr=log,
+            stdout=subprocess.DEVNULL,
+            pass_fds=(write_fd,)
         )
-        time.sleep(0.5)
-        
-        # Check if Xvfb died immediately
-        if xvfb.poll() is not None:
-            _, stderr = xvfb.communicate()
-            if "Server is already active for display" in stderr.decode(): #try again with a lower display_num if Xvfb is already active for that display
-                run = True
-                int_display_num += -1
-                print(f"Xvfb server was found active on display {int_display_num+1}, trying again on display {int_display_num}...")
-            else:
-                raise RuntimeError(f"Xvfb failed to start: {stderr.decode()}")
-    
-    return xvfb, display_num
+    except BaseException:
+        log.close()
+        raise
+    finally:
+        os.close(write_fd)
+    try:
+        output:bytes = b""
+        deadline:float = time.monotonic()+timeout
+        while not output.endswith(b"\n"):
+            ready, _, _ = select.select([read_fd], [], [], max(0.0, deadline-time.monotonic()))
+            if len(ready) == 0:
+                xvfb.kill()
+                raise RuntimeError(f"Xvfb didn't start within {timeout} seconds.")
+            chunk:bytes = os.read(read_fd, 64)
+            if len(chunk) == 0: #Xvfb exited without writing a display number
+                xvfb.wait()
+                log.seek(0)
+                raise RuntimeError(f"Xvfb failed to start: {log.read().decode(errors='replace')}")
+            output += chunk
+    finally:
+        os.close(read_fd)
+        log.close() #Xvfb keeps writing to its own copy of the descriptor
+    return xvfb, f":{output.decode().strip()}"
 
-def wait_for_display(display, timeout=5):
-    """Wait until the X display accepts connections."""
-    start = time.time()
-    while time.time() - start < timeout:
+class DisplayPool:
+    """
+    Long-lived Xvfb displays, kept by screen size and handed out to one recording at a time, so consecutive and concurrent
+    recordings don't each start (and wait for) their own X server. Displays whose Xvfb died are replaced, and all of them
+    are stopped when the program exits.
+    """
+    def __init__(self):
+        self.idle:dict[tuple[int,int],list[tuple[subprocess.Popen,str]]] = {}
+        self.running:list[subprocess.Popen] = []
+        self.lock = threading.Lock()
+
+    def acquire(self, width, height) -> tuple[subprocess.Popen, str]:
+        while True:
+            with self.lock:
+                displays = self.idle.get((width, height), [])
+                if len(displays) == 0:
+                    break
+                xvfb, display = displays.pop()
+            if xvfb.poll() is None:
+                return xvfb, display
+            print(f"Xvfb on display {display} died, starting a new one.")
+            with self.lock:
+                self.running.remove(xvfb)
+        xvfb, display = start_virtual_display(width, height)
+        with self.lock:
+            self.running.append(xvfb)
+        return xvfb, display
+
+    def release(self, width, height, xvfb:subprocess.Popen, display:str) -> None:
+        with self.lock:
+            self.idle.setdefault((width, height), []).append((xvfb, display))
+
+    @contextlib.contextmanager
+    def display(self, width, height):
+        """Borrow a display with a screen of the given size for the duration of the block, yields (Xvfb process, display name)."""
+        xvfb, display = self.acquire(width, height)
         try:
-            subprocess.run(
-                ["xdpyinfo", "-display", display],
-                check=True,
-                stdout=subprocess.DEVNULL,
-                stderr=subprocess.DEVNULL
-            )
-            return True
-        except subprocess.CalledProcessError:
-            time.sleep(0.2)
-    return False
+            yield xvfb, display
+        finally:
+            self.release(width, height, xvfb, display)
+
+    def close(self) -> None:
+        with self.lock:
+            running:list[subprocess.Popen] = self.running.copy()
+            self.running.clear()
+            self.idle.clear()
+        for xvfb in running:
+            xvfb.terminate()
+            xvfb.wait()
+
+displayPool:DisplayPool = DisplayPool()
+atexit.register(displayPool.close)
+
+def display_env(display:str) -> dict[str,str]:
+    """Environment for programs drawing on the given X display, without touching os.environ (recordings may run in parallel)."""
+    env:dict[str,str] = os.environ.copy()
+    env["DISPLAY"] = display
+    #wayland fixes
+    env.pop("WAYLAND_DISPLAY", None)
+    env.pop("XDG_SESSION_TYPE", None)
+    return env
+
+def animation_loop(driver, fps, maxPeriod=config.recordLoopMaxPeriod) -> tuple[int,int]|None:
+    """
+    Finds a seamless loop of the loaded page's CSS animations and transitions, returned as (first frame, number of frames):
+    it starts once every finite animation (and the delay of every infinite one) is over, and lasts the least common multiple
+    of the infinite animations' durations, in frames. Returns None if the page has no infinite animation (animations driven
+    by scripts can't be detected) or if the period would be longer than maxPeriod seconds.
+    """
+    timings = driver.execute_script(
+        "return document.getAnimations().filter(a => a.effect).map(a => a.effect.getComputedTiming())"
+        ".map(t => [t.delay || 0, Number(t.duration) || 0, t.iterations === Infinity, Number(t.endTime) || 0]);")
+    start:float = 0.0
+    period:int = 1
+    infinite:bool = False
+    for delay, duration, endless, end in timings:
+        if endless and duration > 0:
+            infinite = True
+            period = math.lcm(period, max(1, round(duration*fps/1000)))
+            start = max(start, delay)
+        elif not endless:
+            start = max(start, end)
+    if not infinite or period > maxPeriod*fps:
+        return None
+    return math.ceil(start*fps/1000), period
+
+def loop_parts(total, period=None):
+    """
+    Splits a recording of total frames into the parts to actually record, as (first frame, number of frames, repeats):
+    the frames before the loop once, then a single period repeated until total is reached. period is (first frame, frames)
+    (see animation_loop); without one, or if it doesn't fit in total, everything is recorded once.
+    """
+    if period is None or period[0]+period[1] >= total:
+        return [(0, total, 1)]
+    first, frames = period
+    parts:list[tuple[int,int,int]] = [(0, first, 1)] if first > 0 else []
+    parts.append((first, frames, math.ceil((total-first)/frames)))
+    return parts
+
+def write_loop_script(videos, script_path):
+    """Write an ffconcat script playing each (video path, repeats) in order, to be read with FFmpegGraph.input(script_path, options=["-f", "concat", "-safe", "0"])."""
+    with open(script_path, "w") as f:
+        f.write("ffconcat version 1.0\n")
+        for video, repeats in videos:
+            f.write(f"file '{os.path.abspath(video)}'\n"*repeats)
+    return script_path
+
+def plan_recording(output_video_path, duration, window_size, fps, operation):
+    """
+    Dry run of a recording (see FFmpeg.planning()): the page isn't loaded, its frames are a planned placeholder
+    and only their encode is planned.
+    """
+    frames:str = currentWorkspace().path("png", "frames")
+    activePlan.get().placeholder(frames, MediaInfo(duration=duration, width=window_size[0], height=window_size[1], fps=fps, videoCodec="png"), operation)
+    runFFmpeg(["ffmpeg", "-v", "error", "-y", "-framerate", str(fps), "-i", frames, *FFmpeg.encoderArgs("intermediate"), output_video_path], background=False, operation=operation)
+    return output_video_path
+
+def record_virtual(html_path, output_video_path, duration=5.0, window_size=(800, 600), fps=30, loop=False):
+    """
+    Record the page in headless Chrome on a virtual clock (see virtualClockScript): time only moves between captures,
+    so the video has exactly round(duration*fps) frames whatever the load, and recording takes as long as capturing them
+    (usually much less than duration). Frames are captured through the DevTools protocol and piped to FFmpeg as PNGs,
+    and the browser session is borrowed from the screenshot driver pool, so no Xvfb is needed.
+    With loop=True, output_video_path is written as an ffconcat script (see write_loop_script) lasting duration, which plays
+    the frames before the page's animations loop once, then a single recorded period over and over (see animation_loop);
+    pages without an exact period are recorded whole. A number records that many seconds instead of the detected period.
+    While planning, pages are planned as recorded whole.
+    """
+    width, height = make_size_even(window_size)
+    total:int = max(1, round(duration*fps))
+    if activePlan.get() is not None:
+        if loop is False:
+            return plan_recording(output_video_path, total/fps, (width, height), fps, "record_virtual")
+        return write_loop_script([(plan_recording(currentWorkspace().path("mp4", "recording"), total/fps, (width, height), fps, "record_virtual"), 1)], output_video_path)
+    ffmpeg_cmd = [
+        "ffmpeg",
+        "-v", "error",
+        "-y",
+        "-f", "image2pipe",
+        "-c:v", "png",
+        "-framerate", str(fps),
+        "-i", "-",
+        *FFmpeg.encoderArgs("intermediate"), #recordings are always overlaid on something else later
+    ]
+
+    with driverPool.driver((width, height)) as driver:
+        driver.execute_cdp_cmd("Emulation.setDeviceMetricsOverride", {"width":width, "height":height, "deviceScaleFactor":1, "mobile":False})
+        script:str = driver.execute_cdp_cmd("Page.addScriptToEvaluateOnNewDocument", {"source":virtualClockScript})["identifier"]
+        try:
+            driver.get(f"file://{os.path.abspath(html_path)}")
+            driver.execute_script("window.__opifexClock.advanceTo(0);") #pauses the animations started by the page load at their beginning
+            period:tuple[int,int]|None = None
+            if loop is True:
+                period = animation_loop(driver, fps)
+            elif loop is not False:
+                period = (0, max(1, round(loop*fps)))
+            parts:list[tuple[int,int,int]] = loop_parts(total, period)
+            videos:list[tuple[str,int]] = []
+            for first, frames, repeats in parts:
+                video:str = output_video_path if loop is False else currentWorkspace().path("mp4", "recording") #parts are kept until the job ends
+                with feedFFmpeg(ffmpeg_cmd + [video], operation="record_virtual") as stdin:
+                    for frame in range(first, first+frames):
+                        driver.execute_script("window.__opifexClock.advanceTo(arguments[0]);", frame*1000/fps)
+                        png = driver.execute_cdp_cmd("Page.captureScreenshot", {"format":"png", "optimizeForSpeed":True})["data"]
+                        stdin.write(base64.b64decode(png))
+                videos.append((video, repeats))
+        finally:
+            try:
+                driver.execute_cdp_cmd("Page.removeScriptToEvaluateOnNewDocument", {"identifier":script})
+                driver.execute_cdp_cmd("Emulation.clearDeviceMetricsOverride", {})
+                driver.get("about:blank") #stops the page, so a pooled session doesn't keep running it
+            except WebDriverException:
+                pass #the session died, the pool replaces it on its next use
+
+    if loop is not False:
+        write_loop_script(videos, output_video_path)
+    return output_video_path
 
 def record_video(
     html_path,
     output_video_path,
     duration=5.0,
     window_size=(800, 600),
-    fps=30
+    fps=30,
+    mode=None,
+    loop=False
 ):
+    """
+    Record the page for the given duration. mode (by default config.recordMode) is either "virtual" (see record_virtual)
+    or "x11grab": a real-time screen recording of a non-headless Chrome in Xvfb.
+    With loop, output_video_path is an ffconcat script repeating a shorter recording, see record_virtual; x11grab can't detect
+    animation periods, so there loop=True records the whole duration.
+    """
+    if (mode or config.recordMode) == "virtual":
+        return record_virtual(html_path, output_video_path, duration, window_size, fps, loop)
+    script_path:str|None = None
+    total:float = duration
+    if loop is not False:
+        script_path = output_video_path
+        output_video_path = currentWorkspace().path("mp4", "recording")
+        if loop is not True:
+            duration = min(duration, loop)
     width, height = make_size_even(window_size)
+    if activePlan.get() is not None:
+        plan_recording(output_video_path, duration, (width, height), fps, "record_video")
+        return output_video_path if script_path is None else write_loop_script([(output_video_path, math.ceil(total/duration))], script_path)
 
-    # Start virtual display
-    xvfb, display = start_virtual_display(width, height)
-    os.environ["DISPLAY"] = display
-    #wayland fixes
-    saved_env = {}
-    if "WAYLAND_DISPLAY" in os.environ:
-        saved_env["WAYLAND_DISPLAY"] = os.environ.pop("WAYLAND_DISPLAY")
-    if "XDG_SESSION_TYPE" in os.environ:
-        saved_env["XDG_SESSION_TYPE"] = os.environ.pop("XDG_SESSION_TYPE")
-
-    if not wait_for_display(display):
-        raise RuntimeError(f"Display {display} not ready after timeout")
-
-    # Start Chrome (NOT headless!)
-    chrome_options = Options()
-    chrome_options.add_argument("--no-sandbox")
-    chrome_options.add_argument("--disable-dev-shm-usage")
-    chrome_options.add_argument(f"--window-size={width},{height}")
-    chrome_options.add_argument("--disable-gpu")
-    chrome_options.add_argument(f"--app=file://{os.path.abspath(html_path)}")
-    chrome_options.add_argument("--disable-infobars")
-    chrome_options.add_argument("--disable-session-crashed-bubble")
-    chrome_options.add_argument("--no-first-run")
-    chrome_options.add_argument("--disable-default-apps")
-    chrome_options.add_argument("--disable-notifications")
-    chrome_options.add_argument("--hide-scrollbars")
-    chrome_options.add_argument("--window-position=0,0")
-    chrome_options.add_argument("--ozone-platform=x11")
-
-    driver = webdriver.Chrome(options=chrome_options)
+    with displayPool.display(width, height) as (xvfb, display):
+        # Start Chrome (NOT headless!)
+        chrome_options = Options()
+        chrome_options.add_argument("--no-sandbox")
+        chrome_options.add_argument("--disable-dev-shm-usage")
+        chrome_options.add_argument(f"--window-size={width},{height}")
+        chrome_options.add_argument("--disable-gpu")
+        chrome_options.add_argument(f"--app=file://{os.path.abspath(html_path)}")
+        chrome_options.add_argument("--disable-infobars")
+        chrome_options.add_argument("--disable-session-crashed-bubble")
+        chrome_options.add_argument("--no-first-run")
+        chrome_options.add_argument("--disable-default-apps")
+        chrome_options.add_argument("--disable-notifications")
+        chrome_options.add_argument("--hide-scrollbars")
+        chrome_options.add_argument("--window-position=0,0")
+        chrome_options.add_argument("--ozone-platform=x11")
 
-    try:
-        time.sleep(1)
-
-        if xvfb.poll() is not None:
-            _, stderr = xvfb.communicate()
-            raise RuntimeError(f"Xvfb died before FFmpeg started: {stderr.decode()}")
-
-        # Start ffmpeg capture from Xvfb
-        ffmpeg_cmd = [
-            find_ffmpeg(),
-            "-v", "info",
-            "-y",
-            "-video_size", f"{width}x{height}",
-            "-framerate", str(fps),
-            "-f", "x11grab",
-            "-draw_mouse", "0",
-            "-i", f"{display}.0",
-            "-t", str(duration),
-            "-c:v", "libx264",
-            "-preset", "veryfast",
-            "-crf", "18",
-            "-pix_fmt", "yuv420p",
-            output_video_path
-        ]
+        driver = webdriver.Chrome(options=chrome_options, service=Service(env=display_env(display))) #chromedriver passes DISPLAY on to Chrome
 
-        result = subprocess.run(ffmpeg_cmd, env=os.environ.copy(), capture_output=True, text=True)
-        if result.returncode != 0:
-            print("FFmpeg stdout:", result.stdout)
-            print("FFmpeg stderr:", result.stderr)
-            raise subprocess.CalledProcessError(result.returncode, ffmpeg_cmd)
-    finally:
-        driver.quit()
-        xvfb.terminate()
-        xvfb.wait()
+        try:
+            # Wait for the page to be loaded instead of a fixed time
+            WebDriverWait(driver, 10).until(lambda d: d.execute_script("return document.readyState") == "complete")
+
+            if xvfb.poll() is not None:
+                raise RuntimeError(f"Xvfb died before FFmpeg started (exit code {xvfb.returncode}).")
+
+            # Start ffmpeg capture from Xvfb
+            ffmpeg_cmd = [
+                find_ffmpeg(),
+                "-v", "error",
+                "-y",
+                "-video_size", f"{width}x{height}",
+                "-framerate", str(fps),
+                "-f", "x11grab",
+                "-draw_mouse", "0",
+                "-i", f"{display}.0",
+                "-t", str(duration),
+                *FFmpeg.encoderArgs("intermediate"), #recordings are always overlaid on something else later
+                output_video_path
+            ]
 
+            runFFmpeg(ffmpeg_cmd, background=False, priority=FFmpegScheduler.INTERMEDIATE, operation="record_video") #errors are printed by FFmpeg itself
+        finally:
+            driver.quit()
+
+    if script_path is not None:
+        return write_loop_script([(output_video_path, math.ceil(total/duration))], script_path)
     return output_video_path
 
 def process_html_to_video(html_template_path, data=None, window_size=(1080, 1080), 
-                          duration=5.0, fps=30):
+                          duration=5.0, fps=30, loop=False):
     """
     Process HTML template to video recording.
     
@@ -178,24 +405,25 @@ def process_html_to_video(html_template_path, data=None, window_size=(1080, 1080
         window_size (tuple): (width, height) of browser window
         duration (float): Duration of recording in seconds
         fps (int): Frames per second
+        loop (bool|float): Record a seamless period of the page's animations only once (True), or that many seconds (a number),
+            and return an ffconcat script repeating it for the whole duration (read it with FFmpegGraph.input(path, options=["-f", "concat", "-safe", "0"])),
+            see record_video
     
     Returns:
-        str: Path to the generated video file in temp folder
+        str: Path to the generated video file (or ffconcat script) in the current workspace (see lib/workspace)
     """
     # Set default data if none provided
     if data is None:
         data = {}
 
     original_path = Path(html_template_path)
-    html_output_path = original_path.parent / "temp_formatted.html"
+    html_output_path = original_path.parent / f"temp_formatted_{uuid.uuid4().hex}.html" #next to the template, so relative paths keep working
   
-    video_output_filename = f"recording_{random.randint(10000,99999)}.mp4"
-    video_output_path = os.path.join(tempFolder, video_output_filename)
+    video_output_path = currentWorkspace().path("mp4" if loop is False else "ffconcat", "recording")
     
     try:
         # Format the HTML template
         format_html_template(html_template_path, html_output_path, data)
-        tempFiles.append(str(html_output_path))  # Track for cleanup
         
         # Record video
         record_video(
@@ -204,17 +432,15 @@ def process_html_to_video(html_template_path, data=None, window_size=(1080, 1080
             duration=duration,
             window_size=window_size,
             fps=fps,
+            loop=loop,
         )
         
-        # Clean up intermediate files
-        clearTemp()
-        
         return video_output_path
     
-    except Exception as e:
-        # Clean up on error
-        clearTemp()
-        raise e
+    finally:
+        # Clean up the formatted HTML (only this call's, other recordings may be running)
+        if html_output_path.exists():
+            html_output_path.unlink()
 
 class RecordPage(BaseModule):
     """
@@ -222,7 +448,7 @@ class RecordPage(BaseModule):
     """
     def __init__(self):
         self.name = "RecordPage"
-        self.description = "Module that records a video of an HTML template with given parameter values.\nParameters:\n- template: Path to the HTML template\n- data: Dictionary with parameters that should be filled in the template {'Parameter name':Value}\n- size: Tuple (width, height), in pixel, that indicate the web window size\n- duration: Duration of the recording in seconds\n- fps: Frames per second"
+        self.description = "Module that records a video of an HTML template with given parameter values.\nParameters:\n- template: Path to the HTML template\n- data: Dictionary with parameters that should be filled in the template {'Parameter name':Value}\n- size: Tuple (width, height), in pixel, that indicate the web window size\n- duration: Duration of the recording in seconds\n- fps: Frames per second\n- loop (optional): True to record only once a seamless period of the page's animations (or a number of seconds), the destination is then an ffconcat script repeating it for the whole duration"
         self.requiredArgs = [
             ("template", Path),
             ("data", dict), 
@@ -251,11 +477,10 @@ class RecordPage(BaseModule):
                 kwargs["data"], 
                 kwargs["size"], 
                 kwargs["duration"], 
-                kwargs["fps"]
+                kwargs["fps"],
+                kwargs.get("loop", False)
             )
             
             return ModuleResultType(None, {"destination":Path(output_path)}) 
         except Exception as e:
-            # Clean up any remaining temp files on error
-            clearTemp()
             return ModuleResultType(e, {}) 
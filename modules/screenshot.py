@@ -1,10 +1,22 @@
 import os
+import math
+import time
+import base64
+import atexit
+import threading
+import contextlib
 from pathlib import Path
 from selenium import webdriver
 from selenium.webdriver.chrome.options import Options
+from selenium.common.exceptions import WebDriverException, SessionNotCreatedException
+import numpy
 from PIL import Image
 from basemodule import BaseModule, ModuleResultType
-import random
+import uuid
+from lib.workspace import currentWorkspace
+from lib.ffmpeghandler import activePlan
+from lib.cardrenderer import CardRenderer, cardRenderer
+import config
 
 def format_html_template(template_path, output_path, data):
     """
@@ -28,9 +40,266 @@ def format_html_template(template_path, output_path, data):
     
     return output_path
 
+class DriverPool:
+    """
+    Pool of headless Chrome sessions, so that Chrome and chromedriver start once for a whole batch of screenshots
+    instead of once per image.
+
+    Sessions are created on demand, up to maxSize at the same time, and keyed by their window size and options.
+    Each one is health-checked before being handed out, and replaced if it died (a session that fails while in use is thrown away).
+    Sessions unused for idleTimeout seconds are closed by a background thread, and every session is closed when the program exits.
+
+        with driverPool.driver((1080, 1080)) as driver:
+            driver.get(url)
+    """
+    def __init__(self, maxSize:int=config.chromePoolSize, idleTimeout:float=config.chromeIdleTimeout, startAttempts:int=config.chromeStartAttempts):
+        self.maxSize:int = max(1, maxSize)
+        self.idleTimeout:float = idleTimeout
+        self.startAttempts:int = max(1, startAttempts)
+        self.idle:list[tuple[tuple,webdriver.Chrome,float]] = [] #(key, driver, time it was released)
+        self.busy:int = 0 #sessions currently handed out
+        self.keys:dict[webdriver.Chrome,tuple] = {} #settings of every open session
+        self.condition = threading.Condition()
+        self.reaper:threading.Thread|None = None
+        self.closed:bool = False
+
+    @staticmethod
+    def create(window_size:tuple[int,int], transparent_bg:bool) -> webdriver.Chrome:
+        # Set up Chrome options
+        chrome_options = Options()
+        chrome_options.add_argument("--hide-scrollbars")  # Hide scrollbars
+        chrome_options.add_argument("--force-device-scale-factor=1")  # Prevent scaling issues
+        chrome_options.add_argument("--headless")
+        chrome_options.add_argument(f"--window-size={window_size[0]},{window_size[1]}")
+
+        if transparent_bg:
+            chrome_options.add_argument("--disable-gpu")
+
+        return webdriver.Chrome(options=chrome_options)
+
+    @staticmethod
+    def isAlive(driver:webdriver.Chrome) -> bool:
+        try:
+            driver.execute_script("return 1")
+            return True
+        except WebDriverException:
+            return False
+
+    def quit(self, driver:webdriver.Chrome) -> None:
+        with self.condition:
+            self.keys.pop(driver, None)
+        try:
+            driver.quit()
+        except Exception:
+            pass #the session is already dead
+
+    def start(self, window_size:tuple[int,int], transparent_bg:bool) -> webdriver.Chrome:
+        """Start a new session, trying again up to startAttempts times when Chrome fails to create it."""
+        for attempt in range(self.startAttempts):
+            try:
+                return DriverPool.create(window_size, transparent_bg)
+            except SessionNotCreatedException:
+                if attempt == self.startAttempts-1:
+                    raise
+                print(f"Selenium failed at creating a session. Trying again, {self.startAttempts-attempt-1} attempts left.")
+
+    def acquire(self, window_size:tuple[int,int], transparent_bg:bool=True) -> webdriver.Chrome:
+        key:tuple = (tuple(window_size), transparent_bg)
+        while True:
+            evicted:webdriver.Chrome|None = None
+            with self.condition:
+                if self.closed:
+                    raise RuntimeError("The Chrome driver pool has been closed.")
+                match:int|None = next((i for i, (k, _, _) in enumerate(self.idle) if k == key), None)
+                if match is None and self.busy+len(self.idle) >= self.maxSize:
+                    if len(self.idle) == 0:
+                        self.condition.wait()
+                        continue
+                    evicted = self.idle.pop(0)[1] #oldest session with other settings makes room for this one
+                self.busy += 1
+                driver:webdriver.Chrome|None = self.idle.pop(match)[1] if match is not None else None
+                if self.reaper is None:
+                    self.reaper = threading.Thread(target=self.reap, name="chrome-pool", daemon=True)
+                    self.reaper.start()
+            if evicted is not None:
+                self.quit(evicted)
+            try:
+                if driver is not None and not DriverPool.isAlive(driver):
+                    print("A Chrome session died, replacing it.")
+                    self.quit(driver)
+                    driver = None
+                if driver is None:
+                    driver = self.start(window_size, transparent_bg)
+                    with self.condition:
+                        self.keys[driver] = key
+                return driver
+            except BaseException:
+                with self.condition:
+                    self.busy -= 1
+                    self.condition.notify()
+                raise
+
+    def release(self, driver:webdriver.Chrome, broken:bool=False) -> None:
+        """Give a session back to the pool. Broken sessions (and sessions released after close()) are quit instead."""
+        with self.condition:
+            self.busy -= 1
+            keep:bool = not broken and not self.closed
+            if keep:
+                self.idle.append((self.keys[driver], driver, time.monotonic()))
+            self.condition.notify()
+        if not keep:
+            self.quit(driver)
+
+    @contextlib.contextmanager
+    def driver(self, window_size:tuple[int,int], transparent_bg:bool=True):
+        """Borrow a session with the given window size for the duration of the block."""
+        driver:webdriver.Chrome = self.acquire(window_size, transparent_bg)
+        broken:bool = False
+        try:
+            yield driver
+        except WebDriverException:
+            broken = True
+            raise
+        finally:
+            self.release(driver, broken)
+
+    def reap(self) -> None:
+        """Close sessions that have been idle for longer than idleTimeout."""
+        while True:
+            expired:list[webdriver.Chrome] = []
+            with self.condition:
+                if self.closed:
+                    return
+                now:float = time.monotonic()
+                for entry in self.idle.copy():
+                    if now-entry[2] >= self.idleTimeout:
+                        self.idle.remove(entry)
+                        expired.append(entry[1])
+                oldest:float = min((entry[2] for entry in self.idle), default=now)
+            for driver in expired:
+                self.quit(driver)
+            time.sleep(max(1.0, oldest+self.idleTimeout-now))
+
+    def close(self) -> None:
+        """Quit every idle session. Sessions in use are quit when they're released."""
+        with self.condition:
+            self.closed = True
+            drivers:list[webdriver.Chrome] = [driver for _, driver, _ in self.idle]
+            self.idle.clear()
+            self.condition.notify_all()
+        for driver in drivers:
+            self.quit(driver)
+
+driverPool:DriverPool = DriverPool()
+atexit.register(driverPool.close)
+
+#Run by process_html_to_images on a template loaded as it is: fills the {parameter} placeholders of its text and attributes
+#with the given data (keeping the originals, so it can be filled again), or calls window.opifexRender(data) if the page defines it,
+#then waits for fonts, images and two animation frames so the layout is complete. Values are inserted as text, not as HTML.
+fillTemplateScript:str = """
+const data = arguments[0];
+const done = arguments[arguments.length - 1];
+const missing = new Set();
+let rendered;
+if (typeof window.opifexRender === "function") {
+    rendered = Promise.resolve(window.opifexRender(data));
+} else {
+    if (!window.__opifexSlots) {
+        const slots = [];
+        const walker = document.createTreeWalker(document.documentElement, NodeFilter.SHOW_TEXT);
+        for (let node = walker.nextNode(); node; node = walker.nextNode()) {
+            const parent = node.parentNode ? node.parentNode.nodeName : "";
+            if (parent !== "SCRIPT" && parent !== "STYLE" && node.nodeValue.includes("{")) slots.push([node, null, node.nodeValue]);
+        }
+        for (const element of document.querySelectorAll("*")) {
+            for (const attribute of element.attributes) {
+                if (attribute.value.includes("{")) slots.push([element, attribute.name, attribute.value]);
+            }
+        }
+        window.__opifexSlots = slots;
+    }
+    const fill = (text) => text.replace(/\\{\\{|\\}\\}|\\{(\\w+)\\}/g, (match, name) => {
+        if (match === "{{") return "{";
+        if (match === "}}") return "}";
+        if (name in data) return String(data[name]);
+        missing.add(name);
+        return match;
+    });
+    for (const [node, attribute, text] of window.__opifexSlots) {
+        if (attribute === null) { node.nodeValue = fill(text); } else { node.setAttribute(attribute, fill(text)); }
+    }
+    rendered = Promise.resolve();
+}
+rendered
+    .then(() => document.fonts.ready)
+    .then(() => Promise.all([...document.images].map((img) => img.complete ? null : new Promise((resolve) => { img.onload = img.onerror = resolve; }))))
+    .then(() => requestAnimationFrame(() => requestAnimationFrame(() => done([...missing]))));
+"""
+
+#Bounding box [left, top, right, bottom] of all the visible elements matching the CSS selector arguments[0], clipped to the window, or null
+elementBoundsScript:str = """
+let left = Infinity, top = Infinity, right = -Infinity, bottom = -Infinity;
+for (const element of document.querySelectorAll(arguments[0])) {
+    const rect = element.getBoundingClientRect();
+    if (rect.width === 0 || rect.height === 0) continue;
+    left = Math.min(left, rect.left); top = Math.min(top, rect.top);
+    right = Math.max(right, rect.right); bottom = Math.max(bottom, rect.bottom);
+}
+left = Math.max(left, 0); top = Math.max(top, 0);
+right = Math.min(right, window.innerWidth); bottom = Math.min(bottom, window.innerHeight);
+return right > left && bottom > top ? [left, top, right, bottom] : null;
+"""
+
+def save_screenshot(driver, output_png_path, selector=None):
+    """
+    Save a screenshot of the page open in driver. If selector is given, only the bounding box of the elements matching it
+    is captured (all of them, rounded out to whole pixels), so a small card in a big window makes a small image.
+    
+    Returns:
+        tuple: (x, y) of the top-left corner of the captured area in the window, (0, 0) for the whole window
+    """
+    if selector is not None:
+        bounds = driver.execute_script(elementBoundsScript, selector)
+        if bounds is not None:
+            x, y = math.floor(bounds[0]), math.floor(bounds[1])
+            clip:dict = {"x":x, "y":y, "width":math.ceil(bounds[2])-x, "height":math.ceil(bounds[3])-y, "scale":1}
+            png = driver.execute_cdp_cmd("Page.captureScreenshot", {"format":"png", "clip":clip, "optimizeForSpeed":True})["data"]
+            with open(output_png_path, "wb") as f:
+                f.write(base64.b64decode(png))
+            return (x, y)
+        print(f"WARNING: nothing visible matches '{selector}', capturing the whole window")
+    driver.save_screenshot(output_png_path)
+    return (0, 0)
+
+def crop_to_content(png_path):
+    """
+    Crop a transparent PNG to the bounding box of its non-transparent pixels, the equivalent of a selector for images drawn
+    without a browser (see lib/cardrenderer).
+    
+    Returns:
+        tuple: (x, y) of the top-left corner of the kept area in the original image
+    """
+    with Image.open(png_path) as img:
+        img = img.convert("RGBA")
+    box = img.getchannel("A").getbbox()
+    if box is None or box == (0, 0) + img.size: #empty or already tight
+        return (0, 0)
+    img.crop(box).save(png_path, "PNG", compress_level=1)
+    return box[:2]
+
+def offset_from_center(png_path, offset, window_size):
+    """
+    Shift of a clipped screenshot (taken at offset in a window_size window) from the center of the window: overlaying it
+    centered and moved by this shift puts it exactly where it was in the whole window (see FFmpegGraph.overlayImage, with scale 1).
+    """
+    with Image.open(png_path) as img:
+        width, height = img.size
+    return (offset[0]-(window_size[0]-width)/2, offset[1]-(window_size[1]-height)/2)
+
 def take_screenshot(html_path, output_png_path, window_size=(800, 600), transparent_bg=True):
     """
     Take screenshot of HTML file and save as PNG with transparent background.
+    The browser session is borrowed from driverPool, so consecutive screenshots don't start Chrome again.
     
     Args:
         html_path (str): Path to HTML file to screenshot
@@ -41,67 +310,68 @@ def take_screenshot(html_path, output_png_path, window_size=(800, 600), transpar
     Returns:
         str: Path to the screenshot PNG file
     """
-    # Set up Chrome options
-    chrome_options = Options()
-    chrome_options.add_argument("--hide-scrollbars")  # Hide scrollbars
-    chrome_options.add_argument("--force-device-scale-factor=1")  # Prevent scaling issues
-    chrome_options.add_argument("--headless")
-    chrome_options.add_argument(f"--window-size={window_size[0]},{window_size[1]}")
-    
-    if transparent_bg:
-        chrome_options.add_argument("--disable-gpu")
-    
-    # Initialize WebDriver
-    driver = webdriver.Chrome(options=chrome_options)
+    return take_clip(html_path, output_png_path, window_size, transparent_bg)[0]
+
+def take_clip(html_path, output_png_path, window_size=(800, 600), transparent_bg=True, selector=None):
+    """
+    Like take_screenshot, but only captures the elements matching selector (see save_screenshot), or the whole window if it's None.
     
-    try:
+    Returns:
+        tuple: (path, (x, y)) with the path to the PNG file and the position of the captured area in the window
+    """
+    with driverPool.driver(window_size, transparent_bg) as driver:
         # Open the HTML file
         driver.get(f"file://{os.path.abspath(html_path)}")
         
         # Take screenshot
-        driver.save_screenshot(output_png_path)
+        offset = save_screenshot(driver, output_png_path, selector)
         
-        # If transparent background requested, process the image
-        if transparent_bg:
-            make_background_transparent(output_png_path, output_png_path)
-            
-    finally:
-        driver.quit()
+    # If transparent background requested, process the image
+    if transparent_bg:
+        make_background_transparent(output_png_path, output_png_path)
     
-    return output_png_path
+    return (output_png_path, offset)
 
-def make_background_transparent(input_path, output_path):
+def make_background_transparent(input_path, output_path, tolerance=0, despill=False, compress_level=1):
     """
     Make green background transparent in an image.
     
     Args:
         input_path (str): Path to input image
         output_path (str): Path to save output image
+        tolerance (int): Widens the key: pixels with red and blue below 20+tolerance and green above 230-tolerance become transparent
+        despill (bool): Also remove the green tint left on anti-aliased edges, by capping green to the highest of red and blue
+        compress_level (int): PNG compression level, from 0 (none) to 9 (smallest): screenshots are temporary, so it defaults to fast
     
     Returns:
         str: Path to the processed image file
     """
-    img = Image.open(input_path)
-    img = img.convert("RGBA")
-    
-    datas = img.getdata()
-    new_data = []
+    with Image.open(input_path) as img:
+        pixels = numpy.asarray(img.convert("RGBA")).copy() #height x width x 4 array of uint8
     
-    # Make green (and near-green) pixels transparent
-    for item in datas:
-        # Change all green (also shades of green) pixels to transparent
-        if item[0] < 20 and item[1] > 230 and item[2] < 20:
-            new_data.append((255, 255, 255, 0))
-        else:
-            new_data.append(item)
+    red, green, blue = pixels[..., 0], pixels[..., 1], pixels[..., 2]
+    # Change all green (also shades of green) pixels to transparent
+    key = (red < 20+tolerance) & (green > 230-tolerance) & (blue < 20+tolerance)
+    if despill:
+        limit = numpy.maximum(red, blue)
+        spill = ~key & (green > limit)
+        green[spill] = limit[spill]
+    pixels[key] = (255, 255, 255, 0)
     
-    img.putdata(new_data)
-    img.save(output_path, "PNG")
+    Image.fromarray(pixels).save(output_path, "PNG", compress_level=compress_level)
     return output_path
 
+def placeholder_image(window_size):
+    """Blank transparent PNG of the given size in the current workspace, drawn instead of screenshots while planning (see FFmpeg.planning())."""
+    png_output_path = currentWorkspace().path("png", "placeholder")
+    Image.new("RGBA", tuple(window_size), (0, 0, 0, 0)).save(png_output_path, "PNG", compress_level=1)
+    return png_output_path
+
 def process_html_to_image(html_template_path, data=None, window_size=(1080, 1080)):
     """
     Process HTML template to transparent PNG image.
+    If the template has a card spec next to it (see lib/cardrenderer) and config.nativeCardRenderer is enabled,
+    the image is drawn directly with Pillow instead, without a browser; Chrome is still used if the spec can't be rendered.
     
     Args:
         html_template_path (str): Path to HTML template file
@@ -109,57 +379,121 @@ def process_html_to_image(html_template_path, data=None, window_size=(1080, 1080
         window_size (tuple): (width, height) of browser window (default: (800, 800))
     
     Returns:
-        str: Path to the generated PNG file in temp folder
-    
-    Raises:
-        ValueError: If temp directory cannot be created
+        str: Path to the generated PNG file in the current workspace (see lib/workspace)
     """
-    # Create temp directory if it doesn't exist
-    temp_dir = Path("temp")
-    try:
-        temp_dir.mkdir(exist_ok=True)
-    except Exception as e:
-        raise ValueError(f"Could not create temp directory: {e}")
+    return process_html_to_clip(html_template_path, data, window_size)[0]
+
+def process_html_to_clip(html_template_path, data=None, window_size=(1080, 1080), selector=None):
+    """
+    Process HTML template to transparent PNG image, like process_html_to_image (card specs included), capturing only the elements matching selector.
+    
+    Args:
+        html_template_path (str): Path to HTML template file
+        data (dict): Dictionary of values to substitute in template (default: {})
+        window_size (tuple): (width, height) of browser window (default: (800, 800))
+        selector (str): CSS selector of the elements to capture, instead of the whole window (card specs are cropped to their content), or None
     
+    Returns:
+        tuple: (path, (x, y)) with the path to the generated PNG file in the current workspace (see lib/workspace)
+        and the position of the captured area in the window, (0, 0) for the whole window
+    """
     # Set default data if none provided
     if data is None:
         data = {}
     
+    if activePlan.get() is not None: #dry run, the browser isn't started
+        return (placeholder_image(window_size), (0, 0))
+    
+    if config.nativeCardRenderer and CardRenderer.hasSpec(html_template_path):
+        png_output_path = currentWorkspace().path("png", "card")
+        try:
+            cardRenderer.renderTemplate(html_template_path, data, window_size, png_output_path)
+            return (png_output_path, (0, 0) if selector is None else crop_to_content(png_output_path))
+        except ValueError as e:
+            print(f"WARNING: unable to draw the card spec of '{html_template_path}', using Chrome: {e}")
+    
     # Generate unique filenames
     original_path = Path(html_template_path)
-    html_output_path = original_path.parent / "temp_formatted.html"
-    png_output_path = temp_dir / f"screenshot_{random.randint(10000,99999)}.png"
+    html_output_path = original_path.parent / f"temp_formatted_{uuid.uuid4().hex}.html" #next to the template, so relative paths keep working
+    png_output_path = currentWorkspace().path("png", "screenshot")
     
     try:
         # Format the HTML template
         format_html_template(html_template_path, str(html_output_path), data)
         
         # Take screenshot
-        take_screenshot(
+        return take_clip(
             str(html_output_path),
             str(png_output_path),
             window_size=window_size,
-            transparent_bg=True
+            transparent_bg=True,
+            selector=selector
         )
-        
-        return str(png_output_path)
     
     finally:
         # Clean up temporary HTML file
         if html_output_path.exists() and html_output_path != original_path:
             html_output_path.unlink()
 
+def process_html_to_images(html_template_path, data_list, window_size=(1080, 1080)):
+    """
+    Process an HTML template to one transparent PNG image per data dictionary, loading the page only once (see process_html_to_clips).
+    
+    Returns:
+        list[str]: Paths to the generated PNG files in the current workspace (see lib/workspace), in the same order as data_list
+    """
+    return [path for path, _ in process_html_to_clips(html_template_path, data_list, window_size)]
+
+def process_html_to_clips(html_template_path, data_list, window_size=(1080, 1080), selector=None):
+    """
+    Process an HTML template to one transparent PNG image per data dictionary, loading the page only once:
+    the template is opened as it is (no formatted copy is written) and each data dictionary is filled in by fillTemplateScript,
+    so templates can also define window.opifexRender(data) to update themselves. Placeholder values are inserted as text.
+    Like process_html_to_image, templates with a card spec are drawn with Pillow instead (see lib/cardrenderer).
+    
+    Args:
+        html_template_path (str): Path to HTML template file
+        data_list (list[dict]): Dictionaries of values to substitute in template, one per image
+        window_size (tuple): (width, height) of browser window
+        selector (str): CSS selector of the elements to capture, like in process_html_to_clip, or None
+    
+    Returns:
+        list[tuple]: (path, (x, y)) for each generated PNG file in the current workspace (see lib/workspace), in the same order as data_list
+    """
+    if activePlan.get() is not None or (config.nativeCardRenderer and CardRenderer.hasSpec(html_template_path)): #no browser needed
+        return [process_html_to_clip(html_template_path, data, window_size, selector) for data in data_list]
+    
+    png_output_paths:list[str] = []
+    offsets:list[tuple[int,int]] = []
+    with driverPool.driver(window_size) as driver:
+        driver.get(f"file://{os.path.abspath(html_template_path)}")
+        for data in data_list:
+            missing:list[str] = driver.execute_async_script(fillTemplateScript, data)
+            if len(missing) > 0:
+                raise KeyError(f"Missing values for the template parameters: {', '.join(missing)}")
+            png_output_path = currentWorkspace().path("png", "screenshot")
+            offsets.append(save_screenshot(driver, png_output_path, selector))
+            png_output_paths.append(png_output_path)
+    
+    for png_output_path in png_output_paths:
+        make_background_transparent(png_output_path, png_output_path)
+    return list(zip(png_output_paths, offsets))
+
 class ScreenshotPage(BaseModule):
     def __init__(self):
         self.name = "ScreenshotPage"
-        self.description = "Module that screenshots an HTML template with given parameter values to fill it and cleans it to be a transparent PNG. Note that model should not contain any '{' or '}' characters, if not for the parameters. Use separate stylesheet file to include CSS. Returns the path to the generated image.\n\nParameters:\n-template: Path to the HTML template\n-data: Dictionary with parameters that should be filled in the template {'Parameter name':Value}\n-size: Tuple (width, height), in pixel, that indicate the web window size to visualize the HTML template"
+        self.description = "Module that screenshots an HTML template with given parameter values to fill it and cleans it to be a transparent PNG. Note that model should not contain any '{' or '}' characters, if not for the parameters. Use separate stylesheet file to include CSS. Returns the path to the generated image.\n\nParameters:\n-template: Path to the HTML template\n-data: Dictionary with parameters that should be filled in the template {'Parameter name':Value}, or a list of them to render many images with a single page load (returned as 'destinations')\n-size: Tuple (width, height), in pixel, that indicate the web window size to visualize the HTML template\n-selector (optional): CSS selector of the elements to capture instead of the whole window, the position of the captured area is returned as 'offset' (or 'offsets') (x, y)"
         self.requiredArgs = [("template",Path),("data",dict),("size",tuple[int,int])]
         self.returnedDataTypes = [("destination",Path)]
         self.dependencies = []
     
     def execute(self, version:str, **kwargs):
         try:
-            a:str = process_html_to_image(str(kwargs["template"].absolute()),kwargs["data"],kwargs["size"])
-            return ModuleResultType(None,{"destination":Path(a)})
+            selector:str|None = kwargs.get("selector")
+            if isinstance(kwargs["data"], list): #many images from a single page load, see process_html_to_clips
+                clips = process_html_to_clips(str(kwargs["template"].absolute()),kwargs["data"],kwargs["size"],selector)
+                return ModuleResultType(None,{"destinations":[Path(a) for a, _ in clips], "offsets":[offset for _, offset in clips]})
+            a, offset = process_html_to_clip(str(kwargs["template"].absolute()),kwargs["data"],kwargs["size"],selector)
+            return ModuleResultType(None,{"destination":Path(a), "offset":offset})
         except Exception as e:
             return ModuleResultType(e,{})
@@ -1,9 +1,11 @@
 import video
+import screenshot
 import alignSRT
 import tts
 import time
 import pathlib
 import config
+from lib.workspace import Workspace
 from basemodule import BaseModule, ModuleResultType
 import traceback
 
@@ -12,15 +14,18 @@ def generate(titlesAndTexts:dict[str,str], accountName:str, verboseName:bool=Tru
         print("SIMPLE VIDEO GENERATOR")
     initTime = time.time()
     paths:list[str] = []
-    for title, desc in titlesAndTexts.items():
-        loc:tuple[str,str] = (tts.generate(title),tts.generate(desc))
-        print(f"Saved files in {loc[0]} and {loc[1]}")
-        parentDir:str = str(pathlib.Path(loc[1]).parents[0])
-        sub:str = alignSRT.generateSubtitles(loc[1],tts.cleanText(desc),parentDir)[1]
-        print(f"Saved subtitles in {sub}")
-        outputFile:str = config.videoOutputFolder+pathlib.Path(parentDir).name+".mp4"
-        video.computeVideo(outputFile,title,sub,loc[0],loc[1],name=accountName)
-        paths.append(outputFile)
+    with Workspace("cards"): #splash images of videos that failed are deleted on exit
+        print("Generating splash images...")
+        cards:list[tuple[str,tuple[int,int]]] = screenshot.process_html_to_clips(config.titleHtmlTemplate, [{"username":accountName,"content":title} for title in titlesAndTexts], video.titleWindowSize, config.titleCardSelector) #a single page load for all of them
+        for (title, desc), (card, offset) in zip(titlesAndTexts.items(), cards):
+            loc:tuple[str,str] = (tts.generate(title),tts.generate(desc))
+            print(f"Saved files in {loc[0]} and {loc[1]}")
+            parentDir:str = str(pathlib.Path(loc[1]).parents[0])
+            sub:str = alignSRT.generateSubtitles(loc[1],tts.cleanText(desc),parentDir)[1]
+            print(f"Saved subtitles in {sub}")
+            outputFile:str = config.videoOutputFolder+pathlib.Path(parentDir).name+".mp4"
+            video.computeVideo(outputFile,title,sub,loc[0],loc[1],name=accountName,titleImage=card,titleOffset=screenshot.offset_from_center(card, offset, video.titleWindowSize))
+            paths.append(outputFile)
     print(f"\n\nTask completed successfully in {time.time()-initTime} seconds.\nAverage time per video: {(time.time()-initTime)/len(titlesAndTexts)}")
     return paths
 
@@ -3,6 +3,8 @@ from pathlib import Path
 import subprocess
 import time
 from lib.textprocessing import cleanText
+from lib.ffmpeghandler import MediaInfo, activePlan
+from lib.assetcache import ttsAudioFormat
 import config
 from basemodule import BaseModule, ModuleResultType
 
@@ -11,16 +13,24 @@ p = os.path.abspath(__file__).replace(os.path.basename(__file__),"")
 piperLocation: str = config.piperLocation
 model: str = config.piperModel
 destinationPath: str = config.audioOutputPath
+planSpeechRate: float = 15.0 #characters of text spoken per second (at lengthScale 1), used to estimate the length of speech while planning
 
 def generate(text: str, clean:bool = True, textVoice: str = model, destination: str = destinationPath, piper: str = piperLocation, cleanIterations:int = 2, speed:float = 0.9, noiseScale:float = 0.667, lengthScale:float = 1.2) -> str:
     timestamp: int = int(time.time())
     
+    textDestination: str = destination.format(time=timestamp, fileName=f"speech{int(time.time()*1000)%1000}")
+    
+    plan = activePlan.get()
+    if plan is not None: #dry run (see FFmpeg.planning()): piper isn't run, the length of the speech is estimated from the text
+        sampleRate, channels = ttsAudioFormat(textVoice)
+        seconds: float = len(cleanText(text, forceAllowed=True) if clean else text)/planSpeechRate*lengthScale
+        plan.placeholder(textDestination, MediaInfo(duration=seconds, audioCodec="pcm_s16le", sampleRate=sampleRate, channels=channels), "tts", int(seconds*sampleRate*channels*2))
+        return textDestination
+    
     # Create the output directory
     output_dir = destination.format(time=timestamp, fileName="").rsplit('/', 1)[0]
     os.makedirs(output_dir, exist_ok=True)
     
-    textDestination: str = destination.format(time=timestamp, fileName=f"speech{int(time.time()*1000)%1000}")
-    
     print(f"piper: '{piper}' clean: '{clean}' textVoice: '{textVoice}' destination: '{destination}' cleanIterations: {cleanIterations} speed: {speed} noiseScale: {noiseScale} lengthScale: {lengthScale}")
 
     if clean:
@@ -1,4 +1,7 @@
+import os
 import random
+import bisect
+import contextvars
 import screenshot
 import time
 from pathlib import Path
@@ -6,6 +9,10 @@ import config
 from config import Theme
 from basemodule import BaseModule, ModuleResultType
 from lib.ffmpeghandler import *
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from lib.workspace import Workspace, currentWorkspace
+from lib.assetcache import preconditioned, preconditionedPool
 
 accountName:str = config.accountName
 
@@ -14,32 +21,93 @@ subtitlesTheme:Theme = config.subtitlesTheme
 backgroundVideoSourcePool:list[str] = config.videoPool
 dingSound:str = config.dingSound
 htmlTemplate:str = config.titleHtmlTemplate
+titleCardSelector:str|None = config.titleCardSelector
+titleWindowSize:tuple[int,int] = (1080,1080) #browser window the splash image is rendered in
 
 def Print(message:str,verbose:bool=True,last:str="\n"):
     if verbose:
         print(message,end=last)
 
-def getBackgroundVideo(audioPath:str,sourcePool:list[str]) -> str:
-    audioLenght:float = FFmpeg.getLength(audioPath)
-    videoPath:str = sourcePool[random.randint(0,len(sourcePool)-1)]
+class BackgroundAllocator:
+    """
+    Picks random background clips from a pool of videos without copying any footage.
+    The duration, size and keyframes of every pool video are probed once (and cached on disk, see lib/mediacache);
+    each clip is then a "virtual" video: a concat demuxer script listing pieces of pool videos with keyframe-aligned
+    inpoint/outpoint directives, which the next FFmpeg stage reads directly (see FFmpegGraph.input()).
+    """
+    def __init__(self, pool:list[str]):
+        self.pool:list[str] = pool
+        self.durations:list[float]|None = None
+        self.sizes:list[tuple[int,int]] = []
+        self.keyframes:list[array] = []
+
+    def load(self) -> None:
+        if self.durations is not None:
+            return
+        if len(self.pool) == 0:
+            raise ValueError("The background video pool is empty.")
+        infos:list[MediaInfo] = FFmpeg.probeMany(self.pool)
+        with ThreadPoolExecutor(max_workers=min(8, len(self.pool))) as executor:
+            futures = [executor.submit(contextvars.copy_context().run, FFmpeg.getKeyframes, path) for path in self.pool] #keeps the job's workspace (and plan) in worker threads
+            self.keyframes = [future.result() for future in futures]
+        for path, info in zip(self.pool, infos):
+            if not info.duration or info.size is None:
+                raise ValueError(f"Background video '{path}' has no duration or no video stream.")
+        self.sizes = [info.size for info in infos]
+        self.durations = [info.duration for info in infos]
+
+    def allocate(self, length:float) -> tuple[str,tuple[int,int]]:
+        """
+        Returns the path of a concat script (in the current workspace, deleted after its first reader) describing a random clip
+        at least length seconds long, and the clip's resolution.
+        Like before, random pool videos are chained (never the same one twice in a row) until they're long enough, and a random
+        window is taken from them; its bounds are rounded outwards to keyframes, so nothing before the window has to be decoded.
+        """
+        self.load()
+        chain:list[int] = [random.randint(0, len(self.pool)-1)]
+        total:float = self.durations[chain[0]]
+        while total <= length:
+            nextVideo:int = random.randint(0, len(self.pool)-1)
+            if nextVideo != chain[-1] or len(self.pool) == 1:
+                chain.append(nextVideo)
+                total += self.durations[nextVideo]
+        begin:float = random.uniform(0, total-length)
+        end:float = begin+length
 
-    #concatenate videos until video is longer than audio
-    while FFmpeg.getLength(videoPath) <= audioLenght:
-        videoPathOld = videoPath
-        videoPathNew = sourcePool[random.randint(0,len(sourcePool)-1)]
-        if videoPathNew != videoPathOld:
-            videoPath = f"{tempFolder}bg_{random.randint(10000,99999)}.mp4"
-            FFmpeg.concatenate([videoPathOld,videoPathNew],videoPath)
+        entries:list[str] = ["ffconcat version 1.0"]
+        used:list[int] = []
+        position:float = 0.0 #start of the current video in the chain
+        for video in chain:
+            duration:float = self.durations[video]
+            if position+duration > begin and position < end:
+                used.append(video)
+                entries.append(f"file '{os.path.abspath(self.pool[video])}'")
+                if begin > position:
+                    entries.append(f"inpoint {FFmpeg.getClosestKeyframe(self.keyframes[video], begin-position, direction='down')}")
+                if end < position+duration:
+                    i:int = bisect.bisect_left(self.keyframes[video], end-position)
+                    if i < len(self.keyframes[video]):
+                        entries.append(f"outpoint {self.keyframes[video][i]}")
+            position += duration
 
-    videoLenght:float = FFmpeg.getLength(videoPath)
-    begin:float = random.uniform(0,videoLenght-audioLenght)
+        clip:str = currentWorkspace().path("txt", "bg", consumers=1)
+        with open(clip, "w") as f:
+            f.write("\n".join(entries) + "\n")
+        return clip, self.sizes[used[0]]
 
-    #cut video lenght to be close to audio, for faster processing
-    endPath:str = f"{tempFolder}bg_{random.randint(10000,99999)}.mp4"
-    FFmpeg.cut(videoPath,begin,begin+audioLenght,endPath,reencode=False,roundUpOrDown=(False,True))
-    return endPath
+backgroundAllocators:dict[tuple,BackgroundAllocator] = {}
+
+def getBackgroundVideo(audioPath:str,sourcePool:list[str]) -> tuple[str,tuple[int,int]]:
+    """
+    Returns a virtual background clip (concat script, see BackgroundAllocator) as long as the given audio, and its resolution.
+    Read it with FFmpegGraph.input(clip, options=["-f", "concat", "-safe", "0"]).
+    """
+    key:tuple = (tuple(sourcePool), activePlan.get() is not None) #a dry run may see planned pool videos, whose keyframes are only estimated
+    if key not in backgroundAllocators:
+        backgroundAllocators[key] = BackgroundAllocator(sourcePool)
+    return backgroundAllocators[key].allocate(FFmpeg.getLength(audioPath))
 
-def computeVideo(endPath:str, title:str, subtitlesPath:str, titleAudioPath:str, textAudioPath:str, name:str=accountName, videoPool:list[str]=backgroundVideoSourcePool, ding:str=dingSound, sTheme:Theme=subtitlesTheme, html:str=htmlTemplate, verbose:bool=True) -> None:
+def computeVideo(endPath:str, title:str, subtitlesPath:str, titleAudioPath:str, textAudioPath:str, name:str=accountName, videoPool:list[str]=backgroundVideoSourcePool, ding:str=dingSound, sTheme:Theme=subtitlesTheme, html:str=htmlTemplate, verbose:bool=True, titleImage:str|None=None, titleOffset:tuple[float,float]=(0,0)) -> None:
     """
     Any file format for audio and video is allowed, as long as the format and the sampling rate are the same between each other. 
     For example, it's fine to have titleAudioPath's and textAudioPath's extensions as '.wav' and sampling rate 40kHz, as well as '.mp3' with rate 25kHz, 
@@ -47,33 +115,44 @@ def computeVideo(endPath:str, title:str, subtitlesPath:str, titleAudioPath:str,
     Also, audio files should also have the same number of audio channels (all mono or all stereo, no in between)
     The same is valid for videoPool too: all contained videos must have the same extension.
     This is because, to save time, a lot of operations are done without any re-encoding.
-    Converting files is simple, using FFmpeg:
+    If config.preconditionAssets is enabled (the default), ding and videoPool are converted once to match the TTS voice's format (see lib/assetcache),
+    so only titleAudioPath and textAudioPath need to match each other, which is always the case for audio generated by the TTS module.
+    Otherwise, converting files is simple, using FFmpeg:
     'ffmpeg -i input.mp3 -ar 22050 -ac 1 output.wav' will, for example, convert input.mp3 to output.wav with a sample rate of 20050 Hz and set its number of audio channels to 1 (mono)
+    titleImage can be an already rendered splash image (e.g. from screenshot.process_html_to_clips), which gets deleted once used,
+    overlaid centered and moved by titleOffset (see screenshot.offset_from_center); otherwise it's rendered from html with name and title,
+    in a titleWindowSize window, capturing only the elements matching config.titleCardSelector (the whole window if it's None).
     """
     startTime:float = time.time()
     Print("CREATING VIDEO", verbose=verbose)
-    Print("Generating splash image...", verbose=verbose, last=" ")
-    image:str = screenshot.process_html_to_image(html,data={"username":name,"content":title})
-    tempFiles.append(image)
-    titleLenght:float = FFmpeg.getLength(titleAudioPath)
-    dingLenght:float = FFmpeg.getLength(ding)
-    textLenght:float = FFmpeg.getLength(textAudioPath)
-    finalAudio:str = f"{tempFolder}audio.wav"
-    tempUncut:str = f"{tempFolder}uncut_{random.randint(10000,99999)}.mp4"
-    tempCut:str = f"{tempFolder}cut_{random.randint(10000,99999)}.mp4"
-    tempSubtitles:str = f"{tempFolder}srt_{random.randint(10000,99999)}.mp4"
-    Print("Concatenating audio...", verbose=verbose)
-    FFmpeg.concatenate([titleAudioPath,ding,textAudioPath],finalAudio)
-    Print("Overlaying splash image, this might take a while...", verbose=verbose, last=" ")
-    FFmpeg.overlayImage(getBackgroundVideo(finalAudio,videoPool),image,tempUncut, duration=(0,titleLenght+dingLenght), scale=1.0, center=True)
-    Print("Cutting video...", verbose=verbose)
-    FFmpeg.cut(tempUncut,0,titleLenght+dingLenght+textLenght,tempCut,reencode=False,roundUpOrDown=(False,True))
-    Print("Adding subtitles, this might take a while, be patient...", verbose=verbose)
-    FFmpeg.addSubtitles(tempCut,subtitlesPath,sTheme,tempSubtitles,offset=titleLenght+dingLenght)
-    Print("Merging audio and video...", verbose=verbose, last=" ")
-    FFmpeg.addAudioToVideo(finalAudio,tempSubtitles,endPath,isTemp=False)
-    Print("Clearing temporary files...", verbose=verbose)
-    FFmpeg.clearTemp()
+    with Workspace("video") as workspace:
+        ding = preconditioned(ding, "audio")
+        videoPool = preconditionedPool(videoPool)
+        if titleImage is None:
+            Print("Generating splash image...", verbose=verbose, last=" ")
+            titleImage, offset = screenshot.process_html_to_clip(html,data={"username":name,"content":title},window_size=titleWindowSize,selector=titleCardSelector)
+            titleOffset = screenshot.offset_from_center(titleImage, offset, titleWindowSize)
+        image:str = titleImage
+        workspace.track(image, consumers=1)
+        titleLenght:float = FFmpeg.getLength(titleAudioPath)
+        dingLenght:float = FFmpeg.getLength(ding)
+        textLenght:float = FFmpeg.getLength(textAudioPath)
+        finalAudio:str = workspace.path("wav", "audio", consumers=1)
+        Print("Concatenating audio...", verbose=verbose)
+        FFmpeg.concatenate([titleAudioPath,ding,textAudioPath],finalAudio)
+        #overlay, cut and subtitles are compiled into a single FFmpeg run together with the final audio
+        graph = FFmpegGraph()
+        Print("Preparing background video...", verbose=verbose)
+        background, backgroundSize = getBackgroundVideo(finalAudio,videoPool)
+        video:MediaHandle = graph.input(background, options=["-f", "concat", "-safe", "0"], size=backgroundSize)
+        video = graph.overlayImage(video, image, duration=(0,titleLenght+dingLenght), position=titleOffset, scale=1.0, center=True) #the image is only as big as the card, so it's moved back where it was in the page
+        video = graph.cut(video, 0, titleLenght+dingLenght+textLenght)
+        video = graph.addSubtitles(video, subtitlesPath, sTheme, offset=titleLenght+dingLenght)
+        Print("Rendering video (splash image, subtitles and audio), this might take a while, be patient...", verbose=verbose)
+        with FFmpeg.progressListener(FFmpeg.printProgress if verbose else lambda event: None):
+            graph.render(graph.addAudioToVideo(graph.input(finalAudio), video), endPath, isTemp=False)
+        Print(workspace.statsReport(), verbose=verbose)
+        Print("Clearing temporary files...", verbose=verbose)
     Print(f"Saved to {endPath}. Done in {round(time.time()-startTime,2)} seconds!", verbose=verbose)
 
 class VideoGenerator(BaseModule):